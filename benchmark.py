@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark transcription with small Whisper models on the CPU, to see whether a
+change makes run_whisper faster or slower. Each case (a model, an input and a
+set of job options) is run in a fresh process, and its wall time, real-time
+factor, peak memory and word error rate are added to a history file. The
+benchmark fails if a case is slower than its previous runs by more than a
+threshold.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy
+import torch
+import whisper
+
+import speech_to_text
+
+MODELS = ["tiny", "base"]
+
+INPUTS = ["en", "en_x10", "tones_speech"]
+
+OPTIONS: dict[str, list] = {
+    "word_timestamps": [False, True],
+    "beam_size": [None, 5],
+    "condition_on_previous_text": [True, False],
+    "quantize": [None, "int8"],
+}
+
+# what is said in tests/data/en.wav
+EN_TEXT = "This is a test for whisper reading in English."
+
+# the number of times en.wav is repeated in each input
+REPEATS = {"en": 1, "en_x10": 10, "tones_speech": 8}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="benchmark")
+    parser.add_argument(
+        "--models", default=",".join(MODELS), help="Comma separated Whisper models"
+    )
+    parser.add_argument(
+        "--inputs", default=",".join(INPUTS), help="Comma separated inputs"
+    )
+    parser.add_argument(
+        "--history",
+        default="benchmark-history.json",
+        help="The JSON file to add the results to",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fail when a case's real-time factor is this fraction worse than before",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Use the fastest of this many runs"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="The number of CPU threads to use"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Don't add the results to the history"
+    )
+    args = parser.parse_args()
+
+    history_path = Path(args.history)
+    history = json.loads(history_path.read_text()) if history_path.is_file() else []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inputs = make_inputs(Path(tmp_dir), args.inputs.split(","))
+
+        results = []
+        for model_name, input_name, options in cases(args.models.split(",")):
+            if input_name not in inputs:
+                continue
+            result = min(
+                (
+                    run_case(model_name, inputs[input_name], options, args.threads)
+                    for _ in range(args.repeat)
+                ),
+                key=lambda r: r["seconds"],
+            )
+            result.update(
+                {
+                    "case": case_key(model_name, input_name, options, args.threads),
+                    "model": model_name,
+                    "input": input_name,
+                    "options": options,
+                    "threads": args.threads,
+                }
+            )
+            results.append(result)
+            print(
+                f"{result['case']}: {result['seconds']}s "
+                f"rtf={result['real_time_factor']} max_rss={result['max_rss_mb']}MB "
+                f"wer={result['word_error_rate']}"
+            )
+
+    regressions = find_regressions(results, history, args.threshold)
+
+    if not args.dry_run:
+        run_info = {
+            "date": datetime.datetime.now(datetime.UTC).isoformat(),
+            "commit": git_commit(),
+            "machine": platform.machine(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "whisper": whisper.version.__version__,
+            "torch": torch.__version__,
+        }
+        history += [{**run_info, **result} for result in results]
+        history_path.write_text(json.dumps(history, indent=2))
+        print(f"added {len(results)} results to {history_path}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    sys.exit(1 if regressions else 0)
+
+
+def cases(models: list[str]):
+    """
+    Yields the (model, input, options) combinations to benchmark.
+    """
+    names = list(OPTIONS.keys())
+    for model_name in models:
+        for input_name in INPUTS:
+            for values in itertools.product(*OPTIONS.values()):
+                options = {
+                    name: value
+                    for name, value in zip(names, values)
+                    if value is not None
+                }
+                yield model_name, input_name, options
+
+
+def case_key(model_name: str, input_name: str, options: dict, threads: int) -> str:
+    options_str = ",".join(f"{k}={v}" for k, v in sorted(options.items()))
+    return f"{model_name}/{input_name}/{options_str}/threads={threads}"
+
+
+def make_inputs(tmp_dir: Path, names: list[str]) -> dict[str, Path]:
+    """
+    Write the inputs as WAV files: tests/data/en.wav, ten copies of it with a
+    second of silence between them, and two minutes of tones, speech and
+    silence. The synthetic inputs are generated the same way every time.
+    """
+    rate = whisper.audio.SAMPLE_RATE
+    speech = whisper.audio.load_audio("tests/data/en.wav")
+    silence = numpy.zeros(rate, dtype=numpy.float32)
+    tone = (
+        0.1 * numpy.sin(2 * numpy.pi * 440 * numpy.arange(10 * rate) / rate)
+    ).astype(numpy.float32)
+
+    audio = {
+        "en": speech,
+        "en_x10": numpy.concatenate([speech, silence] * REPEATS["en_x10"]),
+        "tones_speech": numpy.concatenate(
+            [tone, speech, silence * 5] * REPEATS["tones_speech"]
+        ),
+    }
+
+    inputs = {}
+    for name in names:
+        path = tmp_dir / f"{name}.wav"
+        with wave.open(str(path), "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes((numpy.clip(audio[name], -1, 1) * 32767).astype("<i2"))
+        inputs[name] = path
+
+    return inputs
+
+
+def run_case(model_name: str, path: Path, options: dict, threads: int) -> dict:
+    # a new process for each run means the peak memory is for just that run
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(transcribe, model_name, path, options, threads).result()
+
+
+def transcribe(model_name: str, path: Path, options: dict, threads: int) -> dict:
+    """
+    Time run_whisper for a media file, after the model has been loaded and the
+    media decoded.
+    """
+    torch.set_num_threads(threads)
+    speech_to_text.get_whisper_model(model_name)
+
+    job = {
+        "id": str(path.parent / f"job-{time.monotonic_ns()}"),
+        "media": [{"name": str(path)}],
+        "options": {"model": model_name, **options},
+    }
+    audio = speech_to_text.load_audio(job, str(path))
+    duration = len(audio) / whisper.audio.SAMPLE_RATE
+
+    start = time.monotonic()
+    speech_to_text.run_whisper(job)
+    seconds = time.monotonic() - start
+
+    output_dir = speech_to_text.get_output_dir(job)
+    output = json.loads((output_dir / f"{path.stem}.json").read_text())
+    reference = " ".join([EN_TEXT] * REPEATS[path.stem])
+
+    return {
+        "duration": round(duration, 3),
+        "seconds": round(seconds, 3),
+        "real_time_factor": round(seconds / duration, 4),
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        "word_error_rate": round(word_error_rate(reference, output["text"]), 4),
+    }
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """
+    The number of word substitutions, deletions and insertions needed to turn
+    the reference into the hypothesis, divided by the number of reference words.
+    Case and punctuation are ignored.
+    """
+    ref = re.sub(r"[^\w\s']", "", reference.lower()).split()
+    hyp = re.sub(r"[^\w\s']", "", hypothesis.lower()).split()
+
+    # the edit distances from the reference so far to each prefix of hyp
+    distances = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, start=1):
+        previous, distances[0] = distances[0], i
+        for j, hyp_word in enumerate(hyp, start=1):
+            previous, distances[j] = (
+                distances[j],
+                min(
+                    distances[j] + 1,
+                    distances[j - 1] + 1,
+                    previous + (ref_word != hyp_word),
+                ),
+            )
+
+    return distances[-1] / max(1, len(ref))
+
+
+def find_regressions(results: list[dict], history: list[dict], threshold: float):
+    """
+    Compare each result with the median real-time factor of the last five runs
+    of the same case on the same kind of machine.
+    """
+    regressions = []
+    for result in results:
+        previous = [
+            run["real_time_factor"]
+            for run in history
+            if run["case"] == result["case"]
+            and run.get("machine") == platform.machine()
+            and run.get("cpu_count") == multiprocessing.cpu_count()
+        ][-5:]
+        if not previous:
+            continue
+
+        baseline = statistics.median(previous)
+        if result["real_time_factor"] > baseline * (1 + threshold):
+            regressions.append(
+                f"{result['case']}: real-time factor {result['real_time_factor']} "
+                f"is more than {threshold:.0%} worse than {baseline}"
+            )
+
+    return regressions
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
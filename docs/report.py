@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
+import bisect
 import datetime
-import difflib
+import html
 import json
 import re
 from collections.abc import Iterator
-from io import StringIO
 from pathlib import Path
 
+import numpy
 import requests
 
 # These are media items set up in SDR's QA environment to use for testing.
@@ -97,6 +98,11 @@ def write_report(date: str, baseline_dir: Path, current_dir: Path) -> None:
     output_file = current_dir / "index.md"
     with output_file.open("w") as output:
         output.write(f"# Benchmark Comparison {date}\n")
+        output.write(
+            f"\nTranscripts pass when their word error rate against the baseline is"
+            f" at most {MAX_WER:.0%} and their cues have drifted by at most"
+            f" {MAX_DRIFT}s on average.\n"
+        )
 
         for druid in druids:
             output.write(f"\n## {druid}\n\n")
@@ -111,6 +117,11 @@ def write_report(date: str, baseline_dir: Path, current_dir: Path) -> None:
         readme.write(f"- [{date}](reports/{date}/)")
 
 
+# the most a transcript can differ from the baseline and still pass
+MAX_WER = 0.05
+MAX_DRIFT = 0.5
+
+
 def compare_item(
     date: str, druid: str, baseline_dir: Path, current_dir: Path
 ) -> list[tuple[str, bool]]:
@@ -136,82 +147,354 @@ def compare_item(
     )
 
     for vtt in vtts_b:
-        vtt_b = baseline_dir / vtt
-        vtt_c = current_dir / vtt
-
-        msg = f"{vtt} size ({vtt_b.stat().st_size} == {vtt_c.stat().st_size})"
-        same_size = vtt_b.stat().st_size == vtt_c.stat().st_size
-
-        # if the file sizes aren't the same generate a diff HTML file and link it
-        if not same_size:
-            diff_filename = f"{vtt_b.name}-diff.html"
-            write_diff(druid, vtt_b, vtt_c, current_dir / diff_filename)
+        comparison = compare_vtt(
+            read_cues(baseline_dir / vtt), read_cues(current_dir / vtt)
+        )
+
+        msg = (
+            f"{vtt} WER {comparison['wer']:.2%}"
+            f" ({comparison['substitutions']} substituted, {comparison['deletions']}"
+            f" deleted, {comparison['insertions']} inserted of"
+            f" {comparison['words']} words), cue drift mean"
+            f" {comparison['mean_drift']:.2f}s max {comparison['max_drift']:.2f}s"
+        )
+
+        # if the transcripts differ generate a diff HTML file and link it
+        if comparison["regions"]:
+            diff_filename = f"{vtt.name}-diff.html"
+            write_diff(druid, comparison, current_dir / diff_filename)
             msg += f" [diff](https://sul-dlss.github.io/speech-to-text/reports/{date}/{diff_filename})"
 
-        checks.append((msg, same_size))
+        passed = comparison["wer"] <= MAX_WER and comparison["mean_drift"] <= MAX_DRIFT
+        checks.append((msg, passed))
 
     return checks
 
 
-def write_diff(druid: str, vtt1: Path, vtt2: Path, output_file: Path) -> None:
+def read_cues(vtt_file: Path) -> list[dict]:
     """
-    Writes an HTML diff for two given VTT files. The HTML is written to the
-    output_path location. The druid is passed in for use in the report.
+    Returns the cues in a VTT file, with their start and end times in seconds
+    and their text. Cue identifiers, and the header, NOTE, STYLE and REGION
+    blocks (which have no timings) are ignored.
     """
-    lines1 = split_sentences(lines(vtt1))
-    lines2 = split_sentences(lines(vtt2))
+    cues: list[dict] = []
+    for block in re.split(r"\n\s*\n", vtt_file.read_text()):
+        lines = [line.strip() for line in block.strip().splitlines()]
 
-    diff = difflib.HtmlDiff(wrapcolumn=80).make_file(
-        lines1, lines2, "reference", "transcript"
-    )
+        # the timings come first, or after the cue's identifier
+        timing = next((i for i, line in enumerate(lines[:2]) if " --> " in line), None)
+        if timing is None:
+            continue
 
-    output = StringIO()
-    output.writelines(diff)
-    html = output.getvalue()
+        start, end = lines[timing].split(" --> ")[:2]
+        cues.append(
+            {
+                "start": seconds(start),
+                "end": seconds(end.split()[0]),
+                "text": " ".join(line for line in lines[timing + 1 :] if line),
+            }
+        )
 
-    # embed the media player for this item
-    html = html.replace(
-        "<body>",
-        f'<body style="margin: 0px;">\n\n    <div style="height: 200px;"><iframe style="position: fixed;" src="https://embed-stage.stanford.edu/iframe?url=https://sul-purl-stage.stanford.edu/{druid}" height="200px" width="100%" title="Media viewer" frameborder="0" marginwidth="0" marginheight="0" scrolling="no" allowfullscreen="allowfullscreen" allow="clipboard-write"></iframe></div>',
-    )
+    return cues
+
+
+def seconds(timestamp: str) -> float:
+    """
+    Convert a VTT timestamp like 01:02.500 or 1:01:02.500 to seconds.
+    """
+    total = 0.0
+    for part in timestamp.split(":"):
+        total = total * 60 + float(part)
+
+    return total
+
+
+def tokenize(cues: list[dict]) -> tuple[list[str], list[float], list[int]]:
+    """
+    Split the cues into words, ignoring case and punctuation. Each word is
+    returned with the time it was spoken, assuming the words of a cue are
+    evenly spaced across it, and the index of its cue.
+    """
+    words, times, cue_indexes = [], [], []
+    for i, cue in enumerate(cues):
+        cue_words = re.sub(r"[^\w\s']", "", cue["text"].lower()).split()
+        for j, word in enumerate(cue_words):
+            words.append(word)
+            times.append(
+                cue["start"] + (cue["end"] - cue["start"]) * j / len(cue_words)
+            )
+            cue_indexes.append(i)
 
-    output_file.open("w").write(html)
+    return words, times, cue_indexes
 
 
-def lines(vtt_file: Path) -> list[str]:
+def compare_vtt(cues1: list[dict], cues2: list[dict]) -> dict:
     """
-    Returns a list of just the text lines from the VTT file.
+    Align the words of a reference and a transcript (see align) and return the
+    word error rate, the number of substitutions, deletions and insertions, how
+    far the transcript's cues have drifted from the reference's, and the
+    regions that differ.
     """
-    results = []
-    for line in vtt_file.open():
-        line = line.strip()
-        if line and line != "WEBVTT" and " --> " not in line:
-            results.append(line)
+    words1, times1, cues_of1 = tokenize(cues1)
+    words2, times2, cues_of2 = tokenize(cues2)
+
+    comparison: dict = {
+        "words": len(words1),
+        "substitutions": 0,
+        "deletions": 0,
+        "insertions": 0,
+        "regions": [],
+    }
+
+    # the time differences of matching words in each of the reference's cues
+    drifts: dict[int, list[float]] = {}
+
+    # the words of the region that differs, and where it starts in words1
+    reference: list[str] = []
+    transcript: list[str] = []
+    region_start = 0
+    position = 0
+
+    def add_region() -> None:
+        comparison["regions"].append(
+            {
+                "time": times1[min(region_start, len(times1) - 1)] if times1 else 0.0,
+                "before": words1[max(0, region_start - 5) : region_start],
+                "reference": reference.copy(),
+                "transcript": transcript.copy(),
+                "after": words1[position : position + 5],
+            }
+        )
+        reference.clear()
+        transcript.clear()
+
+    for i, j in align(words1, words2):
+        if i is not None and j is not None and words1[i] == words2[j]:
+            if reference or transcript:
+                add_region()
+            drifts.setdefault(cues_of1[i], []).append(times2[j] - times1[i])
+        else:
+            if not (reference or transcript):
+                region_start = position
+            if i is not None and j is not None:
+                comparison["substitutions"] += 1
+            elif i is not None:
+                comparison["deletions"] += 1
+            else:
+                comparison["insertions"] += 1
+            if i is not None:
+                reference.append(words1[i])
+            if j is not None:
+                transcript.append(words2[j])
+
+        if i is not None:
+            position = i + 1
+
+    if reference or transcript:
+        add_region()
+
+    errors = comparison["substitutions"] + comparison["deletions"]
+    errors += comparison["insertions"]
+    comparison["wer"] = errors / max(1, len(words1))
+
+    cue_drifts = [abs(sum(d) / len(d)) for d in drifts.values()]
+    comparison["mean_drift"] = sum(cue_drifts) / len(cue_drifts) if cue_drifts else 0
+    comparison["max_drift"] = max(cue_drifts, default=0)
+
+    return comparison
+
+
+# the length of the runs of words that are used to anchor alignments
+ANCHOR_WORDS = 4
+
+
+def align(words1: list[str], words2: list[str]) -> list[tuple[int | None, int | None]]:
+    """
+    Returns the cheapest way of turning words1 into words2 as a list of (i, j)
+    pairs of their positions, in order: (i, j) for a matched or substituted
+    word, (i, None) for a deletion and (None, j) for an insertion.
+
+    Runs of words that are found once in each transcript, in the same order,
+    are used as fixed points (see anchors), and the words between them are
+    aligned with Hirschberg's algorithm, which finds an optimal alignment in
+    linear memory. For similar transcripts the gaps between the fixed points
+    are short, which keeps the comparison fast for transcripts that are hours
+    long. Transcripts that have little in common are aligned in one go, which
+    takes time proportional to the product of their lengths.
+    """
+    ids: dict[str, int] = {}
+    seq1 = numpy.array([ids.setdefault(w, len(ids)) for w in words1], dtype=numpy.int64)
+    seq2 = numpy.array([ids.setdefault(w, len(ids)) for w in words2], dtype=numpy.int64)
 
-    return results
+    pairs: list[tuple[int | None, int | None]] = []
+    i, j = 0, 0
+    for a1, a2 in anchors(words1, words2):
+        hirschberg(seq1[i:a1], seq2[j:a2], i, j, pairs)
+        pairs.append((a1, a2))
+        i, j = a1 + 1, a2 + 1
+    hirschberg(seq1[i:], seq2[j:], i, j, pairs)
 
+    return pairs
 
-sentence_endings = re.compile(r"(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s")
 
+def anchors(words1: list[str], words2: list[str]) -> list[tuple[int, int]]:
+    """
+    Returns the positions of runs of ANCHOR_WORDS words that are found once in
+    each transcript, as (i, j) pairs that increase in both i and j.
+    """
+
+    def unique_runs(words: list[str]) -> dict[tuple[str, ...], int]:
+        positions: dict[tuple[str, ...], int] = {}
+        repeated = set()
+        for i in range(len(words) - ANCHOR_WORDS + 1):
+            run = tuple(words[i : i + ANCHOR_WORDS])
+            if run in positions:
+                repeated.add(run)
+            positions[run] = i
+        return {run: i for run, i in positions.items() if run not in repeated}
+
+    runs2 = unique_runs(words2)
+    candidates = sorted(
+        (i, runs2[run]) for run, i in unique_runs(words1).items() if run in runs2
+    )
 
-def split_sentences(lines) -> list[str]:
+    # keep the longest run of candidates that are in the same order in both
+    # (patience sorting)
+    tails: list[int] = []
+    tail_indexes: list[int] = []
+    previous: list[int | None] = []
+    for index, (_, j) in enumerate(candidates):
+        k = bisect.bisect_left(tails, j)
+        previous.append(tail_indexes[k - 1] if k > 0 else None)
+        if k == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[k] = j
+            tail_indexes[k] = index
+
+    result = []
+    last = tail_indexes[-1] if tail_indexes else None
+    while last is not None:
+        result.append(candidates[last])
+        last = previous[last]
+
+    return result[::-1]
+
+
+def hirschberg(
+    seq1: numpy.ndarray,
+    seq2: numpy.ndarray,
+    offset1: int,
+    offset2: int,
+    pairs: list[tuple[int | None, int | None]],
+) -> None:
+    """
+    Append an optimal alignment of two sequences of word ids to pairs (see
+    align), with positions starting at the offsets.
+    """
+    if len(seq1) == 0:
+        pairs.extend((None, offset2 + j) for j in range(len(seq2)))
+    elif len(seq2) == 0:
+        pairs.extend((offset1 + i, None) for i in range(len(seq1)))
+    elif len(seq1) == 1:
+        # match the word if it's there, otherwise substitute the first word
+        matches = numpy.flatnonzero(seq2 == seq1[0])
+        match = int(matches[0]) if len(matches) > 0 else 0
+        pairs.extend((None, offset2 + j) for j in range(match))
+        pairs.append((offset1, offset2 + match))
+        pairs.extend((None, offset2 + j) for j in range(match + 1, len(seq2)))
+    else:
+        middle = len(seq1) // 2
+        forward = edit_distances(seq1[:middle], seq2)
+        backward = edit_distances(seq1[middle:][::-1], seq2[::-1])[::-1]
+        split = int(numpy.argmin(forward + backward))
+        hirschberg(seq1[:middle], seq2[:split], offset1, offset2, pairs)
+        hirschberg(
+            seq1[middle:], seq2[split:], offset1 + middle, offset2 + split, pairs
+        )
+
+
+def edit_distances(seq1: numpy.ndarray, seq2: numpy.ndarray) -> numpy.ndarray:
     """
-    Split lines with multiple sentences into multiple lines. So,
+    Returns the edit distance between seq1 and each prefix of seq2. Only one
+    row of the edit distance table is kept at a time, and each row is worked
+    out with numpy: the cost of an insertion depends on the cell to the left,
+    which is a running minimum.
+    """
+    steps = numpy.arange(len(seq2) + 1)
+    row = steps.copy()
+    for word in seq1:
+        candidates = numpy.empty_like(row)
+        candidates[0] = row[0] + 1
+        candidates[1:] = numpy.minimum(row[1:] + 1, row[:-1] + (seq2 != word))
+        row = numpy.minimum.accumulate(candidates - steps) + steps
 
-        To be or not to be. That is the question.
+    return row
 
-    will become:
 
-        To be or not to be.
-        That is the question.
+def edit_counts(words1: list[str], words2: list[str]) -> tuple[int, int, int]:
+    """
+    Returns the number of substitutions, deletions and insertions in the
+    cheapest way of turning words1 into words2.
     """
-    text = " ".join(lines)
-    text = text.replace("\n", " ")
-    text = re.sub(r" +", " ", text)
-    sentences = sentence_endings.split(text.strip())
-    sentences = [sentence.strip() for sentence in sentences]
+    subs, dels, ins = 0, 0, 0
+    for i, j in align(words1, words2):
+        if i is not None and j is not None:
+            subs += words1[i] != words2[j]
+        elif i is not None:
+            dels += 1
+        else:
+            ins += 1
+
+    return subs, dels, ins
+
 
-    return sentences
+def write_diff(druid: str, comparison: dict, output_file: Path) -> None:
+    """
+    Writes an HTML page listing the regions where a transcript differs from the
+    reference (see compare_vtt), with a few words of context around each. The
+    HTML is written to the output_path location. The druid is passed in for use
+    in the report.
+    """
+    rows = []
+    for region in comparison["regions"]:
+        minutes, secs = divmod(int(region["time"]), 60)
+        rows.append(
+            f"<tr><td>{minutes // 60}:{minutes % 60:02d}:{secs:02d}</td><td>"
+            + html.escape(" ".join(region["before"]))
+            + f" <del>{html.escape(' '.join(region['reference']))}</del>"
+            + f" <ins>{html.escape(' '.join(region['transcript']))}</ins> "
+            + html.escape(" ".join(region["after"]))
+            + "</td></tr>"
+        )
+
+    output_file.open("w").write(
+        f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{druid}</title>
+<style>
+  table {{ border-collapse: collapse; font-family: sans-serif; }}
+  td {{ border-bottom: 1px solid #ddd; padding: 4px 8px; vertical-align: top; }}
+  del {{ background-color: #fbb; }}
+  ins {{ background-color: #bfb; text-decoration: none; }}
+</style>
+</head>
+<body style="margin: 0px;">
+
+    <div style="height: 200px;"><iframe style="position: fixed;" src="https://embed-stage.stanford.edu/iframe?url=https://sul-purl-stage.stanford.edu/{druid}" height="200px" width="100%" title="Media viewer" frameborder="0" marginwidth="0" marginheight="0" scrolling="no" allowfullscreen="allowfullscreen" allow="clipboard-write"></iframe></div>
+
+<p>WER {comparison["wer"]:.2%} ({comparison["substitutions"]} substituted, {comparison["deletions"]} deleted, {comparison["insertions"]} inserted of {comparison["words"]} reference words). Removed reference words are <del>red</del> and added transcript words are <ins>green</ins>.</p>
+
+<table>
+{chr(10).join(rows)}
+</table>
+</body>
+</html>
+"""
+    )
 
 
 if __name__ == "__main__":
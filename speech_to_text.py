@@ -1,37 +1,77 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import csv
+import dataclasses
 import datetime
+import gc
+import hashlib
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import queue
+import random
+import re
 import shutil
+import statistics
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
 from pathlib import Path
+from typing import Any
 
 import boto3
+import botocore.config
 import dotenv
+import numpy
 import torch
 import whisper
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from honeybadger import honeybadger
 from mypy_boto3_s3.service_resource import Bucket, S3ServiceResource
-from mypy_boto3_sqs.service_resource import Queue
-from whisper.utils import get_writer
+from mypy_boto3_sqs.service_resource import Message, Queue
+from mypy_boto3_sqs.type_defs import DeleteMessageBatchRequestEntryTypeDef
+from whisper.utils import format_timestamp
 
 
-def main(job: dict) -> None:
+def main(job: dict, prefetched: Future | None = None) -> None:
+    """
+    Run a job. If the job's media has already been (or is being) downloaded
+    in the background the prefetched Future for that download can be passed in.
+    """
     try:
         if job is None:
             logging.info("no jobs waiting in the todo queue")
         else:
             logging.info(f"starting job {job}")
-            job = download_media(job)
-            job = run_whisper(job)
+            if "shards" in job:
+                job = get_shard(job)
+            if prefetched is None:
+                # transcription starts as soon as the first file is downloaded
+                with closing(iter_media(job)) as media:
+                    job = run_whisper(job, media)
+            else:
+                # a prefetched shard only has its own media (see download_media)
+                job = run_whisper(prefetched.result())
             job = upload_results(job)
-            job = finish_job(job)
+            # the done message for a shard is sent once they are aggregated
+            if "shard" not in job:
+                job = finish_job(job)
+            export_metrics(job)
             logging.info(f"finished job {job}")
     except SpeechToTextException as e:
         report_error(f"Unexpected error while processing job: {e}", job, e)
@@ -39,274 +79,4177 @@ def main(job: dict) -> None:
         report_error(f"Unexpected error: {e}", job, e)
 
 
-def download_media(job: dict) -> dict:
-    bucket = get_bucket()
+def worker(max_jobs: int | None = None) -> int:
+    """
+    Process jobs from the todo SQS queue until it is empty, or max_jobs have
+    been processed. Whisper models stay loaded between jobs, and the media for
+    the next job is downloaded while the current job is being transcribed.
+    Returns the number of jobs that were processed.
+    """
+    queue = get_todo_queue()
+    count = 0
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        message = receive_job_message(queue, wait=20)
+        download = prefetch_media(prefetcher, message)
+
+        while message is not None and download is not None:
+            count += 1
+
+            # peek at the queue for the next job so its media can be fetched
+            # in the background while this one is transcribed
+            next_message = None
+            if max_jobs is None or count < max_jobs:
+                next_message = receive_job_message(queue, wait=0)
+            next_download = prefetch_media(prefetcher, next_message)
+
+            # the messages are kept hidden from other workers until their jobs
+            # have finished (or the worker dies)
+            with keep_hidden([message] + ([next_message] if next_message else [])):
+                try:
+                    main(json.loads(message.body), download)
+                    finished = True
+                except Exception as e:
+                    logging.error(f"job failed for message {message.message_id}")
+                    finished = was_reported(e)
+
+            if finished:
+                # the job is either done or errored, so don't let it be retried
+                message.delete()
+            else:
+                # the error couldn't be sent to the done queue, so leave the job
+                # to be received again (or moved to a dead letter queue)
+                logging.error(f"leaving message {message.message_id} in the queue")
+
+            if next_message is None and (max_jobs is None or count < max_jobs):
+                next_message = receive_job_message(queue, wait=20)
+                next_download = prefetch_media(prefetcher, next_message)
+
+            message, download = next_message, next_download
+
+    logging.info(f"worker finished after processing {count} jobs")
+    return count
+
+
+@contextmanager
+def keep_hidden(messages: list[Message]) -> Generator[None, None, None]:
+    """
+    Extend the visibility timeout of SQS messages every so often while their
+    jobs are being worked on, so that long jobs aren't received by another
+    worker. If the worker dies the messages become visible again once
+    SPEECH_TO_TEXT_VISIBILITY_TIMEOUT seconds have passed.
+    """
+    timeout = int(os.environ.get("SPEECH_TO_TEXT_VISIBILITY_TIMEOUT", "300"))
+    stopped = threading.Event()
+
+    def extend() -> None:
+        while True:
+            for message in messages:
+                try:
+                    retry(message.change_visibility, VisibilityTimeout=timeout)
+                except Exception as e:
+                    logging.warning(f"unable to extend {message.message_id}: {e}")
+            if stopped.wait(timeout / 2):
+                break
+
+    extender = threading.Thread(target=extend, daemon=True)
+    extender.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        extender.join()
+
+
+def was_reported(e: Exception) -> bool:
+    """
+    Whether an error was sent to the done queue by report_error.
+    """
+    return REPORTED in getattr(e, "__notes__", [])
+
+
+def receive_job_message(queue: Queue, wait: int) -> Message | None:
+    """
+    Receive a job from the todo queue. Messages that aren't a JSON job are
+    logged and skipped, leaving them in the queue to be moved to the dead
+    letter queue once they have been received too many times.
+    """
+    while True:
+        messages = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=wait)
+        if len(messages) == 0:
+            return None
+
+        message = messages[0]
+        try:
+            if isinstance(json.loads(message.body), dict):
+                return message
+        except ValueError:
+            pass
+        logging.error(
+            f"skipping invalid job message {message.message_id}: {message.body}"
+        )
+
+
+def prefetch_media(
+    prefetcher: ThreadPoolExecutor, message: Message | None
+) -> Future | None:
+    if message is None:
+        return None
+    return prefetcher.submit(download_media, json.loads(message.body))
+
+
+def download_media(job: dict) -> dict:
+    """
+    Download all the media for a job, or for this shard of a sharded job.
+    """
+    if "shards" in job:
+        job = get_shard(job)
+
+    for _ in iter_media(job):
+        pass
+
+    return job
+
+
+def iter_media(job: dict) -> Generator[tuple[int, dict], None, None]:
+    """
+    A generator of (index, media) tuples which downloads the job's media
+    concurrently and yields each file as soon as it has been downloaded and
+    inspected. The files are yielded in the order that they land, and the index
+    is the file's position in job["media"].
+
+    At most SPEECH_TO_TEXT_DOWNLOAD_CONCURRENCY files are downloaded at once, and
+    downloading pauses when that many files are waiting to be transcribed. The
+    downloads start when the first file is asked for, so that closing the
+    generator always stops them, even if it was never iterated.
+    """
+    output_dir = get_output_dir(job)
+    if not output_dir.is_dir():
+        output_dir.mkdir()
+
+    concurrency = int(os.environ.get("SPEECH_TO_TEXT_DOWNLOAD_CONCURRENCY", "4"))
+    landed: queue.Queue = queue.Queue(maxsize=concurrency)
+    cancelled = threading.Event()
+
+    def fetch(index: int, media: dict) -> None:
+        error = None
+        try:
+            # note the media_file is expected to be the full path in the bucket
+            # e.g. pg879tb2706-v2/video_1.mp4
+            media_file = media["name"]
+            # media with a cached transcript doesn't need its audio
+            if has_cached_transcript(job, media):
+                logging.info(f"not downloading {media_file}, it has been transcribed")
+            else:
+                media_info = fetch_media(job, media_file)
+                logging.info(f"downloaded {media_file}: {json.dumps(media_info)}")
+        except Exception as e:
+            error = e
+
+        # wait for room in the queue unless the consumer has gone away
+        while not cancelled.is_set():
+            try:
+                landed.put((index, media, error), timeout=1)
+                break
+            except queue.Full:
+                continue
+
+    downloader = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for index, media in enumerate(job["media"]):
+            downloader.submit(fetch, index, media)
+
+        for _ in range(len(job["media"])):
+            index, media, error = landed.get()
+            if error is not None:
+                raise error
+            yield index, media
+    finally:
+        cancelled.set()
+        downloader.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_media(job: dict, media_file: str) -> dict:
+    """
+    Get the decoded audio for a media file in the bucket into the job's scratch
+    directory, and return information about the media.
+
+    When SPEECH_TO_TEXT_STREAM_MEDIA is enabled the S3 object is piped straight
+    into ffmpeg so that the original file is never written to disk. Files that
+    ffmpeg needs to seek around in (like MP4s with the moov atom at the end) are
+    downloaded first, as are files that fail to decode when streamed.
+    """
+    scratch_dir = get_scratch_dir(job)
+
+    if os.environ.get("SPEECH_TO_TEXT_STREAM_MEDIA", "").lower() in ["1", "true"]:
+        s3 = get_client("s3")
+        bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET", "")
+
+        def stream() -> Iterable[bytes]:
+            response = retry(s3.get_object, Bucket=bucket_name, Key=media_file)
+            received = 0
+            for chunk in response["Body"].iter_chunks(1024 * 1024):
+                received += len(chunk)
+                yield chunk
+
+            # make sure the connection didn't end early
+            if received != response["ContentLength"]:
+                raise SpeechToTextException(
+                    f"Received {received} of {response['ContentLength']} bytes of {media_file}"
+                )
+
+        with measure(job, "probe"):
+            seekable = needs_seeking(bucket_name, media_file)
+
+        if seekable:
+            logging.info(f"{media_file} can't be streamed, downloading it instead")
+        else:
+            try:
+                # the media is downloaded while it is being decoded
+                with measure(job, "decode"):
+                    media_info, _ = decode_media(media_file, scratch_dir, stream)
+                return media_info
+            except SpeechToTextException:
+                logging.warning(
+                    f"unable to stream {media_file}, downloading it instead"
+                )
+
+    with measure(job, "download"):
+        get_bucket().download_file(media_file, media_file, Config=get_transfer_config())
+    with measure(job, "decode"):
+        media_info, _ = decode_media(media_file, scratch_dir)
+
+    return media_info
+
+
+def needs_seeking(bucket_name: str, key: str) -> bool:
+    """
+    MP4 style containers can only be decoded from a pipe if the moov atom, which
+    describes the streams, comes before the mdat atom with the media data. The
+    top level atoms are read with range requests to see which comes first.
+    """
+    if Path(key).suffix.lower() not in [".mp4", ".m4a", ".m4v", ".mov", ".3gp"]:
+        return False
+
+    s3 = get_client("s3")
+    size = s3.head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+
+    offset = 0
+    while offset + 8 <= size:
+        header = s3.get_object(
+            Bucket=bucket_name, Key=key, Range=f"bytes={offset}-{offset + 15}"
+        )["Body"].read()
+        atom_size = int.from_bytes(header[0:4], "big")
+        atom_type = header[4:8]
+
+        if atom_type == b"moov":
+            return False
+        if atom_type == b"mdat":
+            return True
+
+        if atom_size == 1:
+            # a 64-bit size follows the type
+            atom_size = int.from_bytes(header[8:16], "big")
+        elif atom_size == 0:
+            # the atom runs to the end of the file
+            atom_size = size - offset
+        if atom_size < 8:
+            break
+
+        offset += atom_size
+
+    # we couldn't tell, so be safe
+    return True
+
+
+def run_whisper(
+    job: dict, media_files: Iterable[tuple[int, dict]] | None = None
+) -> dict:
+    """
+    Transcribe the job's media. By default the media is expected to already be
+    downloaded, but an iterable of (index, media) tuples can be passed in so
+    that files are transcribed as they become available (see iter_media). The
+    runs in the job log are in the same order as job["media"] regardless.
+    """
+    # the code for interacting with whisper here was adapted from
+    # https://github.com/openai/whisper/blob/main/whisper/transcribe.py
+
+    options = job.get("options", {}).copy()
+
+    requested_model_name = options.get("model", "large")
+
+    # the engine that is used for the job as a whole (media can override it)
+    job_engine = get_engine(options.get("engine", "whisper"))
+
+    # how long transcription is expected to take is recorded in the log with
+    # how long it actually took, to calibrate later estimates
+    job_started = time.monotonic()
+    calibration = get_calibration()
+
+    # the whisper JSON output is written out in other formats like vtt, txt, etc
+    output_dir = get_output_dir(job)
+
+    if media_files is None:
+        media_files = enumerate(job["media"])
+
+    # accumulate the options that were used for transcription and writing,
+    # keyed by the position of the media in the job
+    runs = {}
+
+    # long media is transcribed a few windows at a time, saving the progress
+    # to the bucket so that an interrupted job can pick up where it left off
+    checkpoint_windows = int(os.environ.get("SPEECH_TO_TEXT_CHECKPOINT_WINDOWS", "0"))
+
+    # short media waiting to be transcribed together, grouped by options
+    batches: dict[str, list[dict]] = {}
+
+    # media waiting to be transcribed by a pool of CPU model replicas
+    scheduled: list[dict] = []
+
+    # the transcription time for each media file, keyed by its position
+    media_metrics = {}
+
+    def write(item: dict, result: dict) -> None:
+        if item.get("align"):
+            with measure(job, "align"):
+                item["run"]["alignment"] = align_words(
+                    get_whisper_model(item["model_name"]),
+                    item["audio"],
+                    result,
+                    item["writer_options"],
+                    item["whisper_options"],
+                )
+
+        if item["speech"] is not None:
+            result = restore_timestamps(result, item["speech"])
+
+        if item["run"].get("cache") == "miss":
+            put_cached_transcript(item["cache_key"], item["transcribe_options"], result)
+
+        logging.info(f"whisper result for {item['media_file']}: {summarize(result)}")
+
+        logging.info(f"writing output using writer_options: {item['writer_options']}")
+        with measure(job, "write"):
+            write_transcript(
+                output_dir, item["media_file"], result, item["writer_options"]
+            )
+
+        runs[item["index"]] = {
+            "media": item["media_file"],
+            "transcribe": item["transcribe_options"],
+            "write": item["writer_options"],
+            **item["run"],
+        }
+
+    def transcribed(item: dict, seconds: float) -> None:
+        item["run"]["runtime"]["actual"] = round(seconds, 3)
+        media_metrics[item["index"]] = {
+            "media": item["media_file"],
+            "duration": round(item["duration"], 3),
+            "seconds": round(seconds, 3),
+            "real_time_factor": round(seconds / max(item["duration"], 0.001), 4),
+        }
+
+    def transcribe_batched(batch: list[dict]) -> None:
+        logging.info(f"running {batch[0]['engine']} on a batch of {len(batch)} files")
+        started = time.monotonic()
+        engine = get_engine(batch[0]["engine"])
+        with measure(job, "transcribe"):
+            results = engine.transcribe_batch(
+                get_whisper_model(batch[0]["model_name"], engine.name),
+                [item["audio"] for item in batch],
+                batch[0]["whisper_options"],
+            )
+        # share the time for the batch between the files in it
+        seconds = (time.monotonic() - started) / len(batch)
+        for item, result in zip(batch, results):
+            item["run"]["batch"] = len(batch)
+            transcribed(item, seconds)
+            write(item, result)
+
+    def transcribe_scheduled() -> None:
+        # the longest files are started first so that the replicas all finish
+        # at about the same time
+        groups: dict[tuple[str, str, int], list[dict]] = {}
+        for item in sorted(scheduled, key=lambda item: -item["duration"]):
+            key = (
+                item["engine"],
+                item["model_name"],
+                item["transcribe_options"]["replicas"],
+            )
+            groups.setdefault(key, []).append(item)
+
+        for (engine_name, model_name, replicas), group in groups.items():
+            logging.info(
+                f"running {engine_name} on {len(group)} files with {replicas} replicas"
+            )
+            pool = get_replica_pool(engine_name, model_name, replicas)
+            with measure(job, "transcribe"):
+                futures = [
+                    pool.submit(
+                        time_with_replica, item["audio"], item["whisper_options"]
+                    )
+                    for item in group
+                ]
+                results = [
+                    (item, *future.result())
+                    for item, future in sorted(
+                        zip(group, futures), key=lambda pair: pair[0]["index"]
+                    )
+                ]
+            for item, result, seconds in results:
+                transcribed(item, seconds)
+                write(item, result)
+
+    try:
+        for index, media in media_files:
+            media_file = media["name"]
+
+            whisper_options = media_options(job, media)
+
+            writer_options = whisper_options.get("writer", {})
+
+            # a cached transcript is written out without decoding the media or
+            # identifying its language
+            cache_key = transcript_cache_key(media_file, whisper_options)
+            if cache_key is not None:
+                cached = get_cached_transcript(cache_key)
+                if cached is not None:
+                    logging.info(f"using cached transcript for {media_file}")
+                    write(
+                        {
+                            "index": index,
+                            "media_file": media_file,
+                            "writer_options": writer_options,
+                            "transcribe_options": cached["transcribe"],
+                            "run": {"cache": "hit"},
+                            "speech": None,
+                        },
+                        cached["result"],
+                    )
+                    continue
+
+            if len(writer_options) > 0:
+                whisper_options["word_timestamps"] = True
+
+            # remove model and writer from options that are passed to whisper
+            whisper_options.pop("model", None)
+            whisper_options.pop("writer", None)
+            engine = get_engine(whisper_options.pop("engine", "whisper"))
+            chunking = get_chunking_options(whisper_options.pop("chunking", None))
+            batch_size = whisper_options.pop("batch_size", None)
+            skip_silence = get_skip_silence_options(
+                whisper_options.pop("skip_silence", None)
+            )
+            quantize = get_quantize_option(whisper_options.pop("quantize", None))
+            replicas = whisper_options.pop("replicas", None)
+            alignment = get_alignment_option(whisper_options.pop("alignment", None))
+
+            # the cached transcript may have expired since the media was skipped
+            if not is_decoded(job, media_file):
+                fetch_media(job, media_file)
+
+            audio = load_audio(job, media_file)
+            duration = len(audio) / whisper.audio.SAMPLE_RATE
+
+            run: dict = {}
+            speech = None
+            if skip_silence:
+                speech = find_speech(audio, **skip_silence)
+                run["skipped"] = round(
+                    1 - sum(end - start for start, end in speech) / max(1, len(audio)),
+                    4,
+                )
+                logging.info(f"skipping {run['skipped']:.1%} of {media_file}")
+                audio = keep_speech(audio, speech)
+
+            checkpointed = (
+                checkpoint_windows
+                and len(audio) > checkpoint_windows * whisper.audio.N_SAMPLES
+                and "clip_timestamps" not in whisper_options
+            )
+
+            # with selective alignment the words are aligned after Whisper has
+            # transcribed the media in one go, which rules out the options that
+            # split it up or need the words while transcribing, and is only
+            # worth doing when some segments don't need their words
+            selective = (
+                alignment == "selective"
+                and len(writer_options) > 0
+                and not needs_all_words(writer_options)
+                and engine.name == "whisper"
+                and not (chunking or checkpointed)
+                and not (replicas and not torch.cuda.is_available())
+                and "clip_timestamps" not in whisper_options
+                and whisper_options.get("hallucination_silence_threshold") is None
+            )
+            if selective:
+                whisper_options["word_timestamps"] = False
+
+            model_name = requested_model_name
+            if "language" not in whisper_options:
+                language = identify_language(audio)
+                if language is not None:
+                    run["language"] = language
+                    model_name = route_model(model_name, language)
+                    if model_name != requested_model_name:
+                        whisper_options["language"] = "en"
+
+            transcribe_options = {"model": model_name, **whisper_options}
+            if engine.name != "whisper":
+                transcribe_options["engine"] = engine.name
+            if chunking:
+                transcribe_options["chunking"] = chunking
+            if batch_size:
+                transcribe_options["batch_size"] = batch_size
+            if replicas:
+                transcribe_options["replicas"] = replicas
+            if skip_silence:
+                transcribe_options["skip_silence"] = skip_silence
+            if selective:
+                transcribe_options["alignment"] = alignment
+
+            # quantized models are cached (and loaded by replicas) under their
+            # own names, and are only used on the CPU
+            if quantize and engine.name == "whisper" and not torch.cuda.is_available():
+                transcribe_options["quantize"] = quantize
+                model_name = f"{model_name}:{quantize}"
+
+            item = {
+                "index": index,
+                "media_file": media_file,
+                "model_name": model_name,
+                "engine": engine.name,
+                "whisper_options": whisper_options,
+                "writer_options": writer_options,
+                "transcribe_options": transcribe_options,
+                "run": run,
+                "speech": speech,
+                "duration": duration,
+                "cache_key": cache_key,
+            }
+
+            if cache_key is not None:
+                run["cache"] = "miss"
+
+            if selective:
+                item["align"] = True
+                item["audio"] = audio
+
+            run["runtime"] = {
+                "duration": round(duration, 3),
+                "estimated": round(
+                    estimate_seconds(duration, transcribe_options, calibration), 3
+                ),
+            }
+
+            batched = (
+                len(audio) > 0 and batch_size and can_batch(audio, whisper_options)
+            )
+
+            # media that would otherwise be transcribed here on the CPU is left
+            # until all the media has arrived, and is then spread across the
+            # replicas
+            if (
+                replicas
+                and len(audio) > 0
+                and not (chunking or checkpointed or batched)
+                and not torch.cuda.is_available()
+            ):
+                item["audio"] = audio
+                scheduled.append(item)
+                continue
+
+            logging.info(
+                f"running {engine.name} on {media_file} with model={model_name} options={whisper_options}"
+            )
+            # chunks of long media are transcribed on the CPU by the replicas,
+            # which load their own models
+            model = None
+            if not (chunking and chunked_on_replicas(audio, chunking)):
+                with measure(job, "model_load"):
+                    model = get_whisper_model(model_name, engine.name)
+
+            if batched:
+                item["audio"] = audio
+                key = json.dumps(
+                    [engine.name, model_name, whisper_options], sort_keys=True
+                )
+                batches.setdefault(key, []).append(item)
+                if len(batches[key]) >= batch_size:
+                    transcribe_batched(batches.pop(key))
+                continue
+
+            started = time.monotonic()
+            with measure(job, "transcribe"):
+                if len(audio) == 0:
+                    # there was no speech to transcribe
+                    result: dict = {
+                        "text": "",
+                        "segments": [],
+                        "language": whisper_options.get("language"),
+                    }
+                elif chunking:
+                    result, item["run"]["chunks"] = transcribe_chunked(
+                        model, model_name, audio, whisper_options, chunking, engine.name
+                    )
+                elif checkpointed:
+                    result, resumed = transcribe_checkpointed(
+                        model,
+                        audio,
+                        whisper_options,
+                        checkpoint_windows,
+                        f"{job['id']}/checkpoints/{checkpoint_name(job, index)}.json",
+                        transcribe_options,
+                        engine.name,
+                    )
+                    if resumed:
+                        item["run"]["resumed"] = resumed
+                else:
+                    result = engine.transcribe(model, audio, whisper_options)
+            transcribed(item, time.monotonic() - started)
+            write(item, result)
+
+        for batch in batches.values():
+            transcribe_batched(batch)
+
+        transcribe_scheduled()
+    except SpeechToTextException:
+        raise
+    except Exception as e:
+        raise SpeechToTextException(str(e))
+
+    job["finished"] = now()
+
+    actual = time.monotonic() - job_started
+    timed_runs = [run["runtime"] for run in runs.values() if "runtime" in run]
+    overhead = actual - sum(runtime["actual"] for runtime in timed_runs)
+
+    job["log"] = {
+        "name": job_engine.name,
+        "version": job_engine.version(),
+        "runs": [runs[index] for index in sorted(runs)],
+        "runtime": {
+            "estimated": round(
+                calibration.get("overhead_seconds", 0)
+                + sum(runtime["estimated"] for runtime in timed_runs),
+                3,
+            ),
+            "actual": round(actual, 3),
+            "overhead": round(overhead, 3),
+        },
+    }
+
+    job.setdefault("metrics", {})["media"] = [
+        media_metrics[index] for index in sorted(media_metrics)
+    ]
+
+    return job
+
+
+def media_options(job: dict, media: dict) -> dict:
+    """
+    Returns the options for a media file in the job, which are the job's options
+    with any that were given for the media file itself.
+    """
+    return {**job.get("options", {}), **media.get("options", {})}
+
+
+def transcript_cache_key(media_file: str, options: dict) -> str | None:
+    """
+    When SPEECH_TO_TEXT_CACHE_PREFIX is set, returns the key in the bucket for
+    the cached transcript of a media file. The key is made from the media's S3
+    ETag, which is the same for identical content, the engine's version and the
+    options that were asked for. Since the key has to be known before the media
+    is decoded, media without a language option also includes the settings that
+    route it to a model once its language has been identified.
+    """
+    prefix = os.environ.get("SPEECH_TO_TEXT_CACHE_PREFIX")
+    if not prefix:
+        return None
+
+    head = retry(
+        get_client("s3").head_object,
+        Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"),
+        Key=media_file,
+    )
+    # batching and replicas don't change the transcript
+    options = {k: v for k, v in options.items() if k not in ["batch_size", "replicas"]}
+    options.setdefault("model", "large")
+    version = get_engine(options.get("engine", "whisper")).version()
+
+    routing = None
+    if "language" not in options:
+        routing = [
+            os.environ.get(name)
+            for name in [
+                "SPEECH_TO_TEXT_LANGUAGE_MODEL",
+                "SPEECH_TO_TEXT_ENGLISH_MODEL",
+                "SPEECH_TO_TEXT_ENGLISH_MIN_PROBABILITY",
+            ]
+        ]
+
+    digest = hashlib.sha256(
+        json.dumps([head["ETag"], version, options, routing], sort_keys=True).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+
+    return f"{prefix.rstrip('/')}/{digest}.json"
+
+
+def get_cached_transcript(key: str) -> dict | None:
+    """
+    Returns the cached Whisper result and the options that were used to
+    transcribe it, unless they are missing or older than
+    SPEECH_TO_TEXT_CACHE_TTL_DAYS.
+    """
+    response = get_object(key)
+    if response is None or response["LastModified"] < cache_expiry():
+        return None
+
+    return json.loads(response["Body"].read())
+
+
+def has_cached_transcript(job: dict, media: dict) -> bool:
+    """
+    Whether there is an unexpired cached transcript for the media, which is
+    checked without fetching it, since run_whisper will.
+    """
+    key = transcript_cache_key(media["name"], media_options(job, media))
+    if key is None:
+        return False
+
+    head = head_object(key)
+    return head is not None and head["LastModified"] >= cache_expiry()
+
+
+def put_cached_transcript(key: str, transcribe_options: dict, result: dict) -> None:
+    retry(
+        get_client("s3").put_object,
+        Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"),
+        Key=key,
+        Body=json.dumps({"transcribe": transcribe_options, "result": result}).encode(
+            "utf-8"
+        ),
+        ContentType="application/json",
+    )
+
+
+def prune_cache() -> int:
+    """
+    Delete cached transcripts that have expired, and return how many there were.
+    """
+    prefix = os.environ.get("SPEECH_TO_TEXT_CACHE_PREFIX")
+    if not prefix:
+        return 0
+
+    s3 = get_client("s3")
+    bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET")
+    expiry = cache_expiry()
+
+    deleted = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{prefix.rstrip('/')}/"):
+        expired = [
+            {"Key": obj["Key"]}
+            for obj in page.get("Contents", [])
+            if obj["LastModified"] < expiry
+        ]
+        if expired:
+            retry(
+                s3.delete_objects,
+                Bucket=bucket_name,
+                Delete={"Objects": expired, "Quiet": True},
+            )
+            deleted += len(expired)
+
+    logging.info(f"deleted {deleted} expired transcripts from the cache")
+
+    return deleted
+
+
+def cache_expiry() -> datetime.datetime:
+    ttl = float(os.environ.get("SPEECH_TO_TEXT_CACHE_TTL_DAYS", "90"))
+    return now_dt() - datetime.timedelta(days=ttl)
+
+
+def can_batch(audio: numpy.ndarray, options: dict) -> bool:
+    """
+    Media that fits in a single 30 second window can be transcribed in a batch
+    with other media, unless options that need the full transcribe loop are used.
+    """
+    return (
+        len(audio) <= whisper.audio.N_SAMPLES
+        and "clip_timestamps" not in options
+        and options.get("hallucination_silence_threshold") is None
+    )
+
+
+def transcribe_batch(
+    model: whisper.model.Whisper, audios: list[numpy.ndarray], options: dict
+) -> list[dict]:
+    """
+    Transcribe several short pieces of audio (30 seconds or less) that use the
+    same options at once, by running the encoder and decoder on a batch of mel
+    windows. This follows what whisper.transcribe does for the first window of
+    audio, and the results are the same as it would return. Audio that Whisper
+    wouldn't finish in one window is transcribed with whisper.transcribe.
+    """
+    decode_options = options.copy()
+    temperature = decode_options.pop("temperature", (0.0, 0.2, 0.4, 0.6, 0.8, 1.0))
+    compression_ratio_threshold = decode_options.pop("compression_ratio_threshold", 2.4)
+    logprob_threshold = decode_options.pop("logprob_threshold", -1.0)
+    no_speech_threshold = decode_options.pop("no_speech_threshold", 0.6)
+    initial_prompt = decode_options.pop("initial_prompt", None)
+    word_timestamps = decode_options.pop("word_timestamps", False)
+    prepend_punctuations = decode_options.pop("prepend_punctuations", "\"'“¿([{-")
+    append_punctuations = decode_options.pop(
+        "append_punctuations", "\"'.。,，!！?？:：”)]}、"
+    )
+    # these only matter after the first window, or are only used by
+    # whisper.transcribe when they are set (which can_batch rules out)
+    for name in [
+        "verbose",
+        "condition_on_previous_text",
+        "carry_initial_prompt",
+        "clip_timestamps",
+        "hallucination_silence_threshold",
+    ]:
+        decode_options.pop(name, None)
+
+    if model.device.type == "cpu":
+        decode_options["fp16"] = False
+    dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
+
+    content_frames = []
+    mel_segments = []
+    for audio in audios:
+        mel = whisper.log_mel_spectrogram(
+            audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES
+        )
+        frames = mel.shape[-1] - whisper.audio.N_FRAMES
+        content_frames.append(frames)
+        mel_segments.append(
+            whisper.pad_or_trim(mel[:, :frames], whisper.audio.N_FRAMES)
+        )
+    mel_batch = torch.stack(mel_segments).to(model.device).to(dtype)
+
+    # detect the language of each item when it isn't given
+    if decode_options.get("language") is not None:
+        languages = [decode_options["language"]] * len(audios)
+    elif not model.is_multilingual:
+        languages = ["en"] * len(audios)
+    else:
+        _, probs = model.detect_language(mel_batch)
+        languages = [max(p, key=p.get) for p in probs]
+
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
+    results: list[dict | None] = [None] * len(audios)
+
+    # items with different languages need separate decoding passes
+    for language in sorted(set(languages)):
+        indexes = [i for i, lang in enumerate(languages) if lang == language]
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            model.is_multilingual,
+            num_languages=model.num_languages,
+            language=language,
+            task=decode_options.get("task", "transcribe"),
+        )
+
+        prompt = []
+        if initial_prompt is not None:
+            prompt = tokenizer.encode(" " + initial_prompt.strip())
+
+        decoded: dict[int, whisper.DecodingResult] = {}
+        pending = indexes
+        for t in temperatures:
+            kwargs = {**decode_options, "language": language, "prompt": prompt}
+            if t > 0:
+                # disable beam_size and patience when t > 0
+                kwargs.pop("beam_size", None)
+                kwargs.pop("patience", None)
+            else:
+                # disable best_of when t == 0
+                kwargs.pop("best_of", None)
+
+            decode_results = model.decode(
+                mel_batch[pending], whisper.DecodingOptions(**kwargs, temperature=t)
+            )
+
+            retry_indexes = []
+            for i, decode_result in zip(pending, decode_results):
+                decoded[i] = decode_result
+                if needs_fallback(
+                    decode_result,
+                    compression_ratio_threshold,
+                    logprob_threshold,
+                    no_speech_threshold,
+                ):
+                    retry_indexes.append(i)
+
+            pending = retry_indexes
+            if len(pending) == 0:
+                break
+
+        for i in indexes:
+            segments, seek, single_timestamp_ending = window_segments(
+                decoded[i],
+                tokenizer,
+                content_frames[i],
+                logprob_threshold,
+                no_speech_threshold,
+            )
+
+            if word_timestamps and len(segments) > 0:
+                whisper.timing.add_word_timestamps(
+                    segments=segments,
+                    model=model,
+                    tokenizer=tokenizer,
+                    mel=mel_batch[i],
+                    num_frames=content_frames[i],
+                    prepend_punctuations=prepend_punctuations,
+                    append_punctuations=append_punctuations,
+                    last_speech_timestamp=0.0,
+                )
+                last_word_end = whisper.utils.get_end(segments)
+                if (
+                    not single_timestamp_ending
+                    and last_word_end is not None
+                    and last_word_end > 0
+                ):
+                    seek = round(last_word_end * whisper.audio.FRAMES_PER_SECOND)
+
+            if seek < content_frames[i]:
+                # whisper would carry on with another window
+                logging.info(f"batch item {i} needs more than one window")
+                results[i] = whisper.transcribe(
+                    audio=audios[i], model=model, **{**options, "language": language}
+                )
+                continue
+
+            # if a segment is instantaneous or does not contain text, clear it
+            for segment in segments:
+                if segment["start"] == segment["end"] or segment["text"].strip() == "":
+                    segment["text"] = ""
+                    segment["tokens"] = []
+                    segment["words"] = []
+
+            tokens = [token for segment in segments for token in segment["tokens"]]
+            results[i] = {
+                "text": tokenizer.decode(tokens),
+                "segments": [
+                    {"id": id, **segment} for id, segment in enumerate(segments)
+                ],
+                "language": language,
+            }
+
+    return [result for result in results if result is not None]
+
+
+def can_batch_windows(options: dict) -> bool:
+    """
+    Audio of any length can be transcribed in a batch a window at a time with
+    transcribe_windows when its language is known, unless options that need
+    the full transcribe loop are used.
+    """
+    return (
+        options.get("language") is not None
+        and "clip_timestamps" not in options
+        and options.get("hallucination_silence_threshold") is None
+    )
+
+
+def transcribe_windows(
+    model: whisper.model.Whisper, audios: list[numpy.ndarray], options: dict
+) -> list[dict]:
+    """
+    Transcribe several pieces of audio of any length at once by stepping
+    through their 30 second windows together. At each step the encoder is run
+    on a batch with the next window of every piece of audio that isn't
+    finished, and the windows that have the same prompt are decoded together.
+    This follows the whisper.transcribe loop, and the results are the same as
+    it would return.
+    """
+    decode_options = options.copy()
+    temperature = decode_options.pop("temperature", (0.0, 0.2, 0.4, 0.6, 0.8, 1.0))
+    compression_ratio_threshold = decode_options.pop("compression_ratio_threshold", 2.4)
+    logprob_threshold = decode_options.pop("logprob_threshold", -1.0)
+    no_speech_threshold = decode_options.pop("no_speech_threshold", 0.6)
+    condition_on_previous_text = decode_options.pop("condition_on_previous_text", True)
+    initial_prompt = decode_options.pop("initial_prompt", None)
+    carry_initial_prompt = decode_options.pop("carry_initial_prompt", False)
+    word_timestamps = decode_options.pop("word_timestamps", False)
+    prepend_punctuations = decode_options.pop("prepend_punctuations", "\"'“¿([{-")
+    append_punctuations = decode_options.pop(
+        "append_punctuations", "\"'.。,，!！?？:：”)]}、"
+    )
+    # whisper.transcribe only uses these when they are set, which
+    # can_batch_windows rules out
+    for name in ["verbose", "clip_timestamps", "hallucination_silence_threshold"]:
+        decode_options.pop(name, None)
+
+    if model.device.type == "cpu":
+        decode_options["fp16"] = False
+    dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
+
+    language = decode_options["language"]
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual,
+        num_languages=model.num_languages,
+        language=language,
+        task=decode_options.get("task", "transcribe"),
+    )
+
+    initial_prompt_tokens = []
+    if initial_prompt is not None:
+        initial_prompt_tokens = tokenizer.encode(" " + initial_prompt.strip())
+    remaining_prompt_length = (
+        model.dims.n_text_ctx // 2 - 1 - len(initial_prompt_tokens)
+    )
+
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
+
+    items = []
+    for audio in audios:
+        mel = whisper.log_mel_spectrogram(
+            audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES
+        )
+        items.append(
+            {
+                "mel": mel,
+                "content_frames": mel.shape[-1] - whisper.audio.N_FRAMES,
+                "seek": 0,
+                "tokens": list(initial_prompt_tokens),
+                "segments": [],
+                "prompt_reset_since": 0,
+                "last_speech_timestamp": 0.0,
+            }
+        )
+
+    def prompt(item: dict) -> tuple[int, ...]:
+        if carry_initial_prompt:
+            ignored = max(len(initial_prompt_tokens), item["prompt_reset_since"])
+            remaining = item["tokens"][ignored:][-remaining_prompt_length:]
+            return tuple(initial_prompt_tokens + remaining)
+        return tuple(item["tokens"][item["prompt_reset_since"] :])
+
+    while active := [item for item in items if item["seek"] < item["content_frames"]]:
+        sizes = [
+            min(whisper.audio.N_FRAMES, item["content_frames"] - item["seek"])
+            for item in active
+        ]
+        mel_segments = torch.stack(
+            [
+                whisper.pad_or_trim(
+                    item["mel"][:, item["seek"] : item["seek"] + size],
+                    whisper.audio.N_FRAMES,
+                )
+                for item, size in zip(active, sizes)
+            ]
+        )
+        mel_segments = mel_segments.to(model.device).to(dtype)
+        with torch.no_grad():
+            audio_features = model.encoder(mel_segments)
+
+        # windows are decoded together when they have the same prompt, which
+        # is mostly when the previous text isn't used as the prompt
+        prompts = [prompt(item) for item in active]
+        decoded: dict[int, whisper.DecodingResult] = {}
+        for window_prompt in dict.fromkeys(prompts):
+            pending = [i for i, p in enumerate(prompts) if p == window_prompt]
+            for t in temperatures:
+                kwargs = {**decode_options, "prompt": list(window_prompt)}
+                if t > 0:
+                    # disable beam_size and patience when t > 0
+                    kwargs.pop("beam_size", None)
+                    kwargs.pop("patience", None)
+                else:
+                    # disable best_of when t == 0
+                    kwargs.pop("best_of", None)
+
+                decode_results = model.decode(
+                    audio_features[pending],
+                    whisper.DecodingOptions(**kwargs, temperature=t),
+                )
+
+                retry_indexes = []
+                for i, decode_result in zip(pending, decode_results):
+                    decoded[i] = decode_result
+                    if needs_fallback(
+                        decode_result,
+                        compression_ratio_threshold,
+                        logprob_threshold,
+                        no_speech_threshold,
+                    ):
+                        retry_indexes.append(i)
+
+                pending = retry_indexes
+                if len(pending) == 0:
+                    break
+
+        for i, (item, size) in enumerate(zip(active, sizes)):
+            seek = item["seek"]
+            segments, advance, single_timestamp_ending = window_segments(
+                decoded[i], tokenizer, size, logprob_threshold, no_speech_threshold
+            )
+            item["seek"] = seek + advance
+            if len(segments) == 0:
+                # there is no speech in the window
+                continue
+
+            time_offset = float(
+                seek * whisper.audio.HOP_LENGTH / whisper.audio.SAMPLE_RATE
+            )
+            for segment in segments:
+                segment["seek"] = seek
+                segment["start"] = time_offset + segment["start"]
+                segment["end"] = time_offset + segment["end"]
+
+            if word_timestamps:
+                whisper.timing.add_word_timestamps(
+                    segments=segments,
+                    model=model,
+                    tokenizer=tokenizer,
+                    mel=mel_segments[i],
+                    num_frames=size,
+                    prepend_punctuations=prepend_punctuations,
+                    append_punctuations=append_punctuations,
+                    last_speech_timestamp=item["last_speech_timestamp"],
+                )
+                last_word_end = whisper.utils.get_end(segments)
+                if (
+                    not single_timestamp_ending
+                    and last_word_end is not None
+                    and last_word_end > time_offset
+                ):
+                    item["seek"] = round(
+                        last_word_end * whisper.audio.FRAMES_PER_SECOND
+                    )
+                if last_word_end is not None:
+                    item["last_speech_timestamp"] = last_word_end
+
+            # if a segment is instantaneous or does not contain text, clear it
+            for segment in segments:
+                if segment["start"] == segment["end"] or segment["text"].strip() == "":
+                    segment["text"] = ""
+                    segment["tokens"] = []
+                    segment["words"] = []
+
+            item["segments"].extend(
+                {"id": id, **segment}
+                for id, segment in enumerate(segments, start=len(item["segments"]))
+            )
+            item["tokens"].extend(
+                token for segment in segments for token in segment["tokens"]
+            )
+
+            if not condition_on_previous_text or decoded[i].temperature > 0.5:
+                # do not feed the prompt tokens if a high temperature was used
+                item["prompt_reset_since"] = len(item["tokens"])
+
+    return [
+        {
+            "text": tokenizer.decode(item["tokens"][len(initial_prompt_tokens) :]),
+            "segments": item["segments"],
+            "language": language,
+        }
+        for item in items
+    ]
+
+
+def needs_fallback(
+    result: whisper.DecodingResult,
+    compression_ratio_threshold: float | None,
+    logprob_threshold: float | None,
+    no_speech_threshold: float | None,
+) -> bool:
+    """
+    Whether a decoding result should be retried at a higher temperature, as in
+    whisper.transcribe.
+    """
+    needs_fallback = False
+    if (
+        compression_ratio_threshold is not None
+        and result.compression_ratio > compression_ratio_threshold
+    ):
+        needs_fallback = True  # too repetitive
+    if logprob_threshold is not None and result.avg_logprob < logprob_threshold:
+        needs_fallback = True  # average log probability is too low
+    if (
+        no_speech_threshold is not None
+        and result.no_speech_prob > no_speech_threshold
+        and logprob_threshold is not None
+        and result.avg_logprob < logprob_threshold
+    ):
+        needs_fallback = False  # silence
+
+    return needs_fallback
+
+
+def get_alignment_option(alignment: str | None) -> str:
+    """
+    Word timestamps are needed to write subtitles with writer options, and by
+    default Whisper aligns every word as it transcribes. With the alignment
+    option "selective" only the segments that the writer has to split are
+    aligned, after transcription (see align_words).
+    """
+    if alignment is None or alignment == "full":
+        return "full"
+    if alignment == "selective":
+        return alignment
+
+    raise SpeechToTextException(f"Unsupported alignment option: {alignment}")
+
+
+def needs_all_words(writer_options: dict) -> bool:
+    """
+    Whether the writer needs the time of every word, to highlight the words or
+    because lines are made from words regardless of the segments: max_line_count
+    runs lines on from one segment to the next, and max_words_per_line breaks
+    them after a number of words.
+    """
+    return bool(
+        writer_options.get("highlight_words")
+        or writer_options.get("max_line_count")
+        or writer_options.get("max_words_per_line")
+    )
+
+
+def needs_words(segment: dict, writer_options: dict) -> bool:
+    """
+    Whether the writer needs the time of each word in a segment, to split it
+    into lines or highlight its words.
+    """
+    if needs_all_words(writer_options):
+        return True
+
+    max_line_width = writer_options.get("max_line_width") or 1000
+
+    return len(segment["text"].strip()) > max_line_width
+
+
+def align_words(
+    model: whisper.model.Whisper,
+    audio: numpy.ndarray,
+    result: dict,
+    writer_options: dict,
+    options: dict,
+) -> dict:
+    """
+    Add word timestamps to a result that was transcribed without them, for the
+    segments that need them (see needs_words). Whisper aligns the words of all
+    the segments in each 30 second window it decodes, so the windows that have
+    a segment that needs words are aligned in the same way, several at a time,
+    and the other segments are left without words. Returns the number of
+    windows and segments that were aligned, how long it took, and roughly how
+    long aligning the other windows would have taken.
+    """
+    started = time.monotonic()
+
+    windows: dict[int, list[dict]] = {}
+    for segment in result["segments"]:
+        windows.setdefault(segment["seek"], []).append(segment)
+
+    aligned = [
+        seek
+        for seek, segments in windows.items()
+        if any(needs_words(segment, writer_options) for segment in segments)
+    ]
+    alignments: dict[int, list[whisper.timing.WordTiming]] = {}
+    if aligned:
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            model.is_multilingual,
+            num_languages=model.num_languages,
+            language=result.get("language") or "en",
+            task=options.get("task", "transcribe"),
+        )
+        mel = whisper.log_mel_spectrogram(
+            audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES
+        )
+        content_frames = mel.shape[-1] - whisper.audio.N_FRAMES
+        dtype = torch.float16 if options.get("fp16", True) else torch.float32
+        if model.device.type == "cpu":
+            dtype = torch.float32
+
+        batch_size = int(os.environ.get("SPEECH_TO_TEXT_ALIGNMENT_BATCH_SIZE", "8"))
+        for start in range(0, len(aligned), batch_size):
+            seeks = aligned[start : start + batch_size]
+            num_frames = [
+                min(whisper.audio.N_FRAMES, content_frames - seek) for seek in seeks
+            ]
+            mels = torch.stack(
+                [
+                    whisper.pad_or_trim(
+                        mel[:, seek : seek + frames], whisper.audio.N_FRAMES
+                    )
+                    for seek, frames in zip(seeks, num_frames)
+                ]
+            )
+            text_tokens = [
+                [
+                    token
+                    for segment in windows[seek]
+                    for token in segment["tokens"]
+                    if token < tokenizer.eot
+                ]
+                for seek in seeks
+            ]
+            alignments.update(
+                zip(
+                    seeks,
+                    find_alignments(
+                        model,
+                        tokenizer,
+                        text_tokens,
+                        mels.to(model.device).to(dtype),
+                        num_frames,
+                    ),
+                )
+            )
+
+    # whisper passes on the end of the last word of each window, which for the
+    # windows that aren't aligned is where their last segment ends
+    last_speech_timestamp = 0.0
+    for seek, segments in windows.items():
+        if seek in alignments:
+            add_word_timings(
+                segments,
+                alignments[seek],
+                tokenizer,
+                last_speech_timestamp,
+                options.get("prepend_punctuations", "\"'“¿([{-"),
+                options.get("append_punctuations", "\"'.。,，!！?？:：”)]}、"),
+            )
+            last_word_end = whisper.utils.get_end(segments)
+            if last_word_end is not None:
+                last_speech_timestamp = last_word_end
+        else:
+            last_speech_timestamp = segments[-1]["end"]
+
+    seconds = time.monotonic() - started
+    skipped = len(windows) - len(aligned)
+
+    return {
+        "windows": len(aligned),
+        "skipped_windows": skipped,
+        "segments": sum(len(windows[seek]) for seek in aligned),
+        "seconds": round(seconds, 3),
+        "saved_seconds": round(seconds / len(aligned) * skipped, 3) if aligned else 0,
+    }
+
+
+def find_alignments(
+    model: whisper.model.Whisper,
+    tokenizer: whisper.tokenizer.Tokenizer,
+    text_tokens: list[list[int]],
+    mels: torch.Tensor,
+    num_frames: list[int],
+) -> list[list[whisper.timing.WordTiming]]:
+    """
+    Align the text tokens of several windows with their audio at once. This is
+    whisper.timing.find_alignment with the model run on a batch of windows. The
+    token sequences are padded at the end, which doesn't change the attention
+    weights of the tokens before the padding.
+    """
+    sequences = [
+        [*tokenizer.sot_sequence, tokenizer.no_timestamps, *tokens, tokenizer.eot]
+        for tokens in text_tokens
+    ]
+    length = max(len(sequence) for sequence in sequences)
+    tokens = torch.tensor(
+        [
+            sequence + [tokenizer.eot] * (length - len(sequence))
+            for sequence in sequences
+        ]
+    ).to(model.device)
+
+    # install hooks on the cross attention layers to retrieve the attention weights
+    qks: list[Any] = [None] * model.dims.n_text_layer
+    hooks = [
+        block.cross_attn.register_forward_hook(
+            lambda _, ins, outs, index=i: qks.__setitem__(index, outs[-1])
+        )
+        for i, block in enumerate(model.decoder.blocks)
+    ]
+    try:
+        with torch.no_grad(), whisper.model.disable_sdpa():
+            logits = model(mels, tokens)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    alignments: list[list[whisper.timing.WordTiming]] = []
+    for i, (window_tokens, frames) in enumerate(zip(text_tokens, num_frames)):
+        if len(window_tokens) == 0:
+            alignments.append([])
+            continue
+
+        sot_length = len(tokenizer.sot_sequence)
+        sampled_logits = logits[i, sot_length:, : tokenizer.eot]
+        token_probs = sampled_logits.softmax(dim=-1)
+        text_token_probs = token_probs[
+            numpy.arange(len(window_tokens)), window_tokens
+        ].tolist()
+
+        # heads * tokens * frames
+        weights = torch.stack(
+            [
+                qks[layer][i, head, : len(sequences[i])]
+                for layer, head in model.alignment_heads.indices().T
+            ]
+        )
+        weights = weights[:, :, : frames // 2]
+        weights = weights.softmax(dim=-1)
+        std, mean = torch.std_mean(weights, dim=-2, keepdim=True, unbiased=False)
+        weights = (weights - mean) / std
+        weights = whisper.timing.median_filter(weights, 7)
+
+        matrix = weights.mean(axis=0)
+        matrix = matrix[sot_length:-1]
+        text_indices, time_indices = whisper.timing.dtw(-matrix)
+
+        words, word_tokens = tokenizer.split_to_word_tokens(
+            window_tokens + [tokenizer.eot]
+        )
+        if len(word_tokens) <= 1:
+            alignments.append([])
+            continue
+        word_boundaries = numpy.pad(
+            numpy.cumsum([len(t) for t in word_tokens[:-1]]), (1, 0)
+        )
+
+        jumps = numpy.pad(numpy.diff(text_indices), (1, 0), constant_values=1)
+        jump_times = time_indices[jumps.astype(bool)] / whisper.timing.TOKENS_PER_SECOND
+        start_times = jump_times[word_boundaries[:-1]]
+        end_times = jump_times[word_boundaries[1:]]
+        word_probabilities = [
+            numpy.mean(text_token_probs[first:last])
+            for first, last in itertools.pairwise(word_boundaries)
+        ]
+
+        alignments.append(
+            [
+                whisper.timing.WordTiming(word, tokens, start, end, probability)
+                for word, tokens, start, end, probability in zip(
+                    words, word_tokens, start_times, end_times, word_probabilities
+                )
+            ]
+        )
+
+    return alignments
+
+
+def add_word_timings(
+    segments: list[dict],
+    alignment: list[whisper.timing.WordTiming],
+    tokenizer: whisper.tokenizer.Tokenizer,
+    last_speech_timestamp: float,
+    prepend_punctuations: str,
+    append_punctuations: str,
+) -> None:
+    """
+    Add the words from the alignment of a window to its segments, adjusting the
+    times of long words and of the segments as whisper.timing.add_word_timestamps
+    does.
+    """
+    word_durations = numpy.array([t.end - t.start for t in alignment])
+    word_durations = word_durations[word_durations.nonzero()]
+    median_duration = min(
+        0.7, float(numpy.median(word_durations)) if len(word_durations) > 0 else 0.0
+    )
+    max_duration = median_duration * 2
+
+    # truncate long words at sentence boundaries
+    if len(word_durations) > 0:
+        sentence_end_marks = ".。!！?？"
+        for i in range(1, len(alignment)):
+            if alignment[i].end - alignment[i].start > max_duration:
+                if alignment[i].word in sentence_end_marks:
+                    alignment[i].end = alignment[i].start + max_duration
+                elif alignment[i - 1].word in sentence_end_marks:
+                    alignment[i].start = alignment[i].end - max_duration
+
+    whisper.timing.merge_punctuations(
+        alignment, prepend_punctuations, append_punctuations
+    )
+
+    time_offset = (
+        segments[0]["seek"] * whisper.audio.HOP_LENGTH / whisper.audio.SAMPLE_RATE
+    )
+    word_index = 0
+
+    for segment in segments:
+        text_tokens = [token for token in segment["tokens"] if token < tokenizer.eot]
+        saved_tokens = 0
+        words = []
+
+        while word_index < len(alignment) and saved_tokens < len(text_tokens):
+            timing = alignment[word_index]
+            if timing.word:
+                words.append(
+                    {
+                        "word": timing.word,
+                        "start": round(time_offset + timing.start, 2),
+                        "end": round(time_offset + timing.end, 2),
+                        "probability": timing.probability,
+                    }
+                )
+            saved_tokens += len(timing.tokens)
+            word_index += 1
+
+        # truncate long words at segment boundaries
+        if len(words) > 0:
+            # the first and second word after a pause shouldn't be longer than
+            # twice the median word duration
+            if words[0]["end"] - last_speech_timestamp > median_duration * 4 and (
+                words[0]["end"] - words[0]["start"] > max_duration
+                or (
+                    len(words) > 1
+                    and words[1]["end"] - words[0]["start"] > max_duration * 2
+                )
+            ):
+                if (
+                    len(words) > 1
+                    and words[1]["end"] - words[1]["start"] > max_duration
+                ):
+                    boundary = max(words[1]["end"] / 2, words[1]["end"] - max_duration)
+                    words[0]["end"] = words[1]["start"] = boundary
+                words[0]["start"] = max(0, words[0]["end"] - max_duration)
+
+            # prefer the segment-level start timestamp if the first word is too long
+            if (
+                segment["start"] < words[0]["end"]
+                and segment["start"] - 0.5 > words[0]["start"]
+            ):
+                words[0]["start"] = max(
+                    0, min(words[0]["end"] - median_duration, segment["start"])
+                )
+            else:
+                segment["start"] = words[0]["start"]
+
+            # prefer the segment-level end timestamp if the last word is too long
+            if (
+                segment["end"] > words[-1]["start"]
+                and segment["end"] + 0.5 < words[-1]["end"]
+            ):
+                words[-1]["end"] = max(
+                    words[-1]["start"] + median_duration, segment["end"]
+                )
+            else:
+                segment["end"] = words[-1]["end"]
+
+            last_speech_timestamp = segment["end"]
+
+        segment["words"] = words
+
+
+def window_segments(
+    result: whisper.DecodingResult,
+    tokenizer: whisper.tokenizer.Tokenizer,
+    content_frames: int,
+    logprob_threshold: float | None,
+    no_speech_threshold: float | None,
+) -> tuple[list[dict], int, bool]:
+    """
+    Turn the decoding result for the first window of audio into segments, the
+    way whisper.transcribe does. Returns the segments, the frame that
+    transcription would continue from, and whether the tokens ended with a
+    single timestamp (meaning there is no speech after it).
+    """
+    if no_speech_threshold is not None:
+        should_skip = result.no_speech_prob > no_speech_threshold
+        if logprob_threshold is not None and result.avg_logprob > logprob_threshold:
+            should_skip = False
+        if should_skip:
+            return [], content_frames, True
+
+    input_stride = whisper.audio.N_FRAMES // 1500  # mel frames per output token
+    time_precision = input_stride * whisper.audio.HOP_LENGTH / whisper.audio.SAMPLE_RATE
+
+    def new_segment(start: float, end: float, tokens: torch.Tensor) -> dict:
+        token_list = tokens.tolist()
+        text_tokens = [token for token in token_list if token < tokenizer.eot]
+        return {
+            "seek": 0,
+            "start": start,
+            "end": end,
+            "text": tokenizer.decode(text_tokens),
+            "tokens": token_list,
+            "temperature": result.temperature,
+            "avg_logprob": result.avg_logprob,
+            "compression_ratio": result.compression_ratio,
+            "no_speech_prob": result.no_speech_prob,
+        }
+
+    tokens = torch.tensor(result.tokens)
+    segments = []
+    timestamp_tokens = tokens.ge(tokenizer.timestamp_begin)
+    single_timestamp_ending = timestamp_tokens[-2:].tolist() == [False, True]
+
+    consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0]
+    consecutive.add_(1)
+    if len(consecutive) > 0:
+        slices = consecutive.tolist()
+        if single_timestamp_ending:
+            slices.append(len(tokens))
+
+        last_slice = 0
+        for current_slice in slices:
+            sliced_tokens = tokens[last_slice:current_slice]
+            start_pos = sliced_tokens[0].item() - tokenizer.timestamp_begin
+            end_pos = sliced_tokens[-1].item() - tokenizer.timestamp_begin
+            segments.append(
+                new_segment(
+                    start_pos * time_precision, end_pos * time_precision, sliced_tokens
+                )
+            )
+            last_slice = current_slice
+
+        if single_timestamp_ending:
+            seek = content_frames
+        else:
+            last_timestamp_pos = (
+                tokens[last_slice - 1].item() - tokenizer.timestamp_begin
+            )
+            seek = last_timestamp_pos * input_stride
+    else:
+        duration = content_frames * whisper.audio.HOP_LENGTH / whisper.audio.SAMPLE_RATE
+        timestamps = tokens[timestamp_tokens.nonzero().flatten()]
+        if len(timestamps) > 0 and timestamps[-1].item() != tokenizer.timestamp_begin:
+            last_timestamp_pos = timestamps[-1].item() - tokenizer.timestamp_begin
+            duration = last_timestamp_pos * time_precision
+
+        segments.append(new_segment(0.0, duration, tokens))
+        seek = content_frames
+
+    return segments, seek, single_timestamp_ending
+
+
+def transcribe_checkpointed(
+    model: Any,
+    audio: numpy.ndarray,
+    options: dict,
+    windows: int,
+    checkpoint_key: str,
+    transcribe_options: dict,
+    engine_name: str = "whisper",
+) -> tuple[dict, float]:
+    """
+    Transcribe the audio windows 30 second windows at a time, and save the
+    segments so far to a checkpoint in the bucket after each span. If a
+    checkpoint for the same options exists the transcription resumes from it.
+    Returns the result and the time in seconds it resumed from.
+
+    Only the audio for each span (and a little after it, so that the edge of the
+    spectrogram is the same) is given to Whisper, with clip_timestamps to stop
+    it at the end of the span, and the timestamps are then moved along by the
+    start of the span. Passing all of the audio would compute the spectrogram
+    of the whole file again for every span.
+
+    Each span (except the last) ends at the end of its last whole segment, since
+    the final segment may have been cut off by the end of the clip. The text of
+    the previous segments is used as the prompt for the next span, the way
+    Whisper conditions each window on the previous text.
+    """
+    engine = get_engine(engine_name)
+    duration = len(audio) / whisper.audio.SAMPLE_RATE
+    span = windows * whisper.audio.CHUNK_LENGTH
+
+    segments: list[dict] = []
+    start = 0.0
+    language = options.get("language")
+
+    checkpoint = get_checkpoint(checkpoint_key)
+    if checkpoint is not None and checkpoint["options"] == transcribe_options:
+        logging.info(f"resuming transcription at {checkpoint['seek']} seconds")
+        segments = checkpoint["segments"]
+        start = checkpoint["seek"]
+        language = checkpoint["language"]
+    resumed = start
+
+    while start < duration:
+        end = min(duration, start + span)
+        first = round(start * whisper.audio.SAMPLE_RATE)
+        last = round(end * whisper.audio.SAMPLE_RATE)
+        span_audio = audio[first : last + whisper.audio.N_FFT]
+        span_options = {**options, "clip_timestamps": [0, end - start]}
+        if language is not None:
+            span_options["language"] = language
+        if segments:
+            if options.get("condition_on_previous_text", True):
+                span_options["initial_prompt"] = (
+                    options.get("initial_prompt") or ""
+                ) + "".join(segment["text"] for segment in segments[-20:])
+            else:
+                span_options.pop("initial_prompt", None)
+
+        result = engine.transcribe(model, span_audio, span_options)
+        language = result["language"]
+
+        span_segments = [
+            shift_segment(segment, start) for segment in result["segments"]
+        ]
+        if end < duration and len(span_segments) > 1:
+            span_segments = span_segments[:-1]
+            start = max(span_segments[-1]["end"], start + 1)
+        else:
+            start = end
+
+        for segment in span_segments:
+            segments.append({**segment, "id": len(segments)})
+
+        if start < duration:
+            put_checkpoint(
+                checkpoint_key,
+                {
+                    "options": transcribe_options,
+                    "seek": start,
+                    "language": language,
+                    "segments": segments,
+                },
+            )
+
+    delete_checkpoint(checkpoint_key)
+
+    result = {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": language,
+    }
+
+    return result, resumed
+
+
+def checkpoint_name(job: dict, index: int) -> str:
+    # the media in each shard of a job is numbered from zero
+    return f"{job['shard']}-{index}" if "shard" in job else str(index)
+
+
+def get_checkpoint(key: str) -> dict | None:
+    response = get_object(key)
+    if response is None:
+        return None
+
+    return json.loads(response["Body"].read())
+
+
+def put_checkpoint(key: str, checkpoint: dict) -> None:
+    logging.info(f"saving checkpoint at {checkpoint['seek']} seconds to {key}")
+    retry(
+        get_client("s3").put_object,
+        Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"),
+        Key=key,
+        Body=json.dumps(checkpoint).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def delete_checkpoint(key: str) -> None:
+    retry(
+        get_client("s3").delete_object,
+        Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"),
+        Key=key,
+    )
+
+
+def get_quantize_option(quantize: bool | str | None) -> str | None:
+    """
+    Models can be quantized to run faster on the CPU. The quantize option is
+    either true or "int8", which quantizes the weights of the model's linear
+    layers to 8 bit integers.
+    """
+    if not quantize:
+        return None
+    if quantize is True or quantize == "int8":
+        return "int8"
+
+    raise SpeechToTextException(f"Unsupported quantize option: {quantize}")
+
+
+def get_skip_silence_options(skip_silence: bool | dict | None) -> dict | None:
+    """
+    Silence, music and dead air can be left out of transcription using a simple
+    energy based voice activity detector. The skip_silence option is either true
+    (to use the defaults) or a dictionary with any of:
+
+    - threshold: the loudness (dBFS) below which audio is considered silent
+    - min_silence: only skip silences that last at least this many seconds
+    - min_speech: ignore sounds shorter than this many seconds
+    - padding: seconds of audio to keep either side of the speech
+    """
+    if not skip_silence:
+        return None
+
+    defaults = {
+        "threshold": -45.0,
+        "min_silence": 1.0,
+        "min_speech": 0.25,
+        "padding": 0.25,
+    }
+    if skip_silence is True:
+        return defaults
+
+    return {**defaults, **skip_silence}
+
+
+def find_speech(
+    audio: numpy.ndarray,
+    threshold: float = -45.0,
+    min_silence: float = 1.0,
+    min_speech: float = 0.25,
+    padding: float = 0.25,
+) -> list[tuple[int, int]]:
+    """
+    Returns the (start, end) sample positions of the parts of the audio that
+    are loud enough to contain speech, measured in 30ms frames.
+    """
+    frame = whisper.audio.SAMPLE_RATE * 3 // 100
+    seconds = whisper.audio.SAMPLE_RATE / frame
+
+    loudness = frame_loudness(audio, frame)
+    if len(loudness) == 0:
+        return []
+
+    voiced = loudness > threshold
+
+    # find the runs of voiced frames
+    edges = numpy.diff(voiced.astype(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+
+    spans: list[list[int]] = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if spans and start - spans[-1][1] < min_silence * seconds:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+
+    pad = round(padding * seconds)
+    speech: list[tuple[int, int]] = []
+    for start, end in spans:
+        if end - start < min_speech * seconds:
+            continue
+        start = max(0, start - pad) * frame
+        end = min(len(audio), (end + pad) * frame)
+        if speech and start <= speech[-1][1]:
+            speech[-1] = (speech[-1][0], end)
+        else:
+            speech.append((start, end))
+
+    return speech
+
+
+def frame_loudness(audio: numpy.ndarray, frame: int) -> numpy.ndarray:
+    """
+    Returns the loudness (dBFS) of each frame of the audio. It is measured a
+    block at a time, since the audio for a long recording is memory-mapped.
+    """
+    block = frame * 1000
+    loudness = []
+    for start in range(0, len(audio), block):
+        samples = numpy.asarray(audio[start : start + block], dtype=numpy.float32)
+        samples = numpy.pad(samples, (0, -len(samples) % frame))
+        power = numpy.mean(samples.reshape(-1, frame) ** 2, axis=1)
+        loudness.append(10 * numpy.log10(power + 1e-10))
+
+    return numpy.concatenate(loudness) if loudness else numpy.array([])
+
+
+def keep_speech(audio: numpy.ndarray, speech: list[tuple[int, int]]) -> numpy.ndarray:
+    """
+    Returns just the speech parts of the audio, one after another.
+    """
+    if len(speech) == 1 and speech[0] == (0, len(audio)):
+        return audio
+
+    return numpy.concatenate([audio[start:end] for start, end in speech] or [audio[:0]])
+
+
+def restore_timestamps(result: dict, speech: list[tuple[int, int]]) -> dict:
+    """
+    Move the timestamps in a Whisper result for audio returned by keep_speech
+    back to where they are in the original audio.
+    """
+    originals: list[float] = []
+    kept: list[float] = []
+    samples = 0
+    for first, last in speech:
+        originals.append(first / whisper.audio.SAMPLE_RATE)
+        kept.append(samples / whisper.audio.SAMPLE_RATE)
+        samples += last - first
+
+    def restore(t: float, end: bool = False) -> float:
+        # a time at the join between two parts belongs to the earlier part
+        # when it is the end of something
+        if end:
+            i = bisect.bisect_left(kept, t) - 1
+        else:
+            i = bisect.bisect_right(kept, t) - 1
+        i = max(0, i)
+        return round(originals[i] + t - kept[i], 3)
+
+    segments = []
+    for segment in result["segments"]:
+        start = restore(segment["start"])
+        segment = {
+            **segment,
+            "seek": segment["seek"]
+            + round((start - segment["start"]) * whisper.audio.FRAMES_PER_SECOND),
+            "start": start,
+            "end": restore(segment["end"], end=True),
+        }
+        if "words" in segment:
+            segment["words"] = [
+                {
+                    **word,
+                    "start": restore(word["start"]),
+                    "end": restore(word["end"], end=True),
+                }
+                for word in segment["words"]
+            ]
+        segments.append(segment)
+
+    return {**result, "segments": segments}
+
+
+def get_chunking_options(chunking: bool | dict | None) -> dict | None:
+    """
+    Long recordings can be split into chunks at silences and the chunks
+    transcribed in parallel. The chunking option is either true (to use the
+    defaults) or a dictionary with any of:
+
+    - min_duration: only split media longer than this many seconds
+    - chunk_duration: the target length of a chunk in seconds
+    - processes: the number of CPU model replicas transcribing chunks
+    - batch_size: the number of chunks transcribed at once on GPU
+    """
+    if not chunking:
+        return None
+
+    defaults = {
+        "min_duration": 1200,
+        "chunk_duration": 600,
+        "processes": max(1, min(4, (os.cpu_count() or 1) // 4)),
+        "batch_size": 8,
+    }
+    if chunking is True:
+        return defaults
+
+    return {**defaults, **chunking}
+
+
+def transcribe_chunked(
+    model: Any,
+    model_name: str,
+    audio: numpy.ndarray,
+    options: dict,
+    chunking: dict,
+    engine_name: str = "whisper",
+) -> tuple[dict, int]:
+    """
+    Transcribe the audio for a long media file by splitting it at silences and transcribing
+    the chunks in parallel, then stitching the results back together into a
+    single Whisper result. Returns the result and the number of chunks.
+
+    On CPU the chunks are spread across a pool of processes that each have their
+    own model replica, and the model isn't needed here (it can be None). On GPU
+    the windows of batch_size chunks are transcribed at once with the model.
+    """
+    engine = get_engine(engine_name)
+    duration = len(audio) / whisper.audio.SAMPLE_RATE
+
+    if duration < chunking["min_duration"]:
+        return engine.transcribe(model, audio, options), 1
+
+    chunks = chunk_boundaries(
+        duration, find_silences(audio), chunking["chunk_duration"]
+    )
+    logging.info(f"split audio into {len(chunks)} chunks: {chunks}")
+
+    audio_chunks = [
+        audio[
+            round(start * whisper.audio.SAMPLE_RATE) : round(
+                end * whisper.audio.SAMPLE_RATE
+            )
+        ]
+        for start, end in chunks
+    ]
+
+    # detect the language once so that every chunk uses the same language
+    options = options.copy()
+    if chunked_on_replicas(audio, chunking):
+        pool = get_replica_pool(engine.name, model_name, chunking["processes"])
+        if options.get("language") is None:
+            options["language"] = pool.submit(
+                detect_language_with_replica, audio[: whisper.audio.N_SAMPLES]
+            ).result()
+        results = list(
+            pool.map(transcribe_with_replica, audio_chunks, [options] * len(chunks))
+        )
+    else:
+        if options.get("language") is None:
+            options["language"] = engine.detect_language(model, audio)
+        results = []
+        for i in range(0, len(audio_chunks), chunking["batch_size"]):
+            results.extend(
+                engine.transcribe_batch(
+                    model, audio_chunks[i : i + chunking["batch_size"]], options
+                )
+            )
+
+    return stitch_results(results, [start for start, _ in chunks]), len(chunks)
+
+
+def chunked_on_replicas(audio: numpy.ndarray, chunking: dict) -> bool:
+    """
+    Whether the audio is long enough to be chunked, and the chunks will be
+    transcribed by CPU model replicas.
+    """
+    return (
+        len(audio) / whisper.audio.SAMPLE_RATE >= chunking["min_duration"]
+        and not torch.cuda.is_available()
+    )
+
+
+def find_silences(
+    audio: numpy.ndarray, noise: float = -30.0, min_silence: float = 0.5
+) -> list[tuple[float, float]]:
+    """
+    Returns the (start, end) times of the silences in decoded audio: runs of
+    10ms frames that are quieter than noise (dBFS) lasting at least min_silence
+    seconds.
+    """
+    frame = whisper.audio.SAMPLE_RATE // 100
+    seconds = frame / whisper.audio.SAMPLE_RATE
+
+    quiet = frame_loudness(audio, frame) < noise
+    edges = numpy.diff(quiet.astype(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    duration = len(audio) / whisper.audio.SAMPLE_RATE
+
+    return [
+        (start * seconds, min(duration, end * seconds))
+        for start, end in zip(starts.tolist(), ends.tolist())
+        if (end - start) * seconds >= min_silence
+    ]
+
+
+def chunk_boundaries(
+    duration: float, silences: list[tuple[float, float]], chunk_duration: float
+) -> list[tuple[float, float]]:
+    """
+    Returns (start, end) times for chunks of roughly chunk_duration seconds.
+    Each chunk is cut in the middle of the silence closest to its target
+    length, or at the target length if there is no silence nearby.
+    """
+    chunks = []
+    start = 0.0
+    while duration - start > chunk_duration:
+        target = start + chunk_duration
+        candidates = [
+            (silence_start + silence_end) / 2
+            for silence_start, silence_end in silences
+            if abs((silence_start + silence_end) / 2 - target) <= chunk_duration / 2
+            and (silence_start + silence_end) / 2 > start
+        ]
+        end = min(candidates, key=lambda t: abs(t - target), default=target)
+        chunks.append((start, end))
+        start = end
+
+    chunks.append((start, duration))
+
+    return chunks
+
+
+def detect_language(model: whisper.model.Whisper, audio) -> str:
+    """
+    Detect the language using the first 30 seconds of the audio.
+    """
+    language, _ = language_probability(model, audio)
+
+    return language
+
+
+def language_probability(model: whisper.model.Whisper, audio) -> tuple[str, float]:
+    """
+    Detect the language using the first 30 seconds of the audio, and return it
+    along with its probability.
+    """
+    if not model.is_multilingual:
+        return "en", 1.0
+
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels).to(
+        model.device
+    )
+    _, probs = model.detect_language(mel)
+    language = max(probs, key=probs.get)
+
+    return language, float(probs[language])
+
+
+def identify_language(audio) -> dict | None:
+    """
+    When SPEECH_TO_TEXT_LANGUAGE_MODEL names a (small) Whisper model, use it to
+    identify the language of the audio before it is transcribed.
+    """
+    language_model_name = os.environ.get("SPEECH_TO_TEXT_LANGUAGE_MODEL")
+    if not language_model_name:
+        return None
+
+    language, probability = language_probability(
+        get_language_model(language_model_name), audio
+    )
+    logging.info(f"{language_model_name} model detected {language} ({probability:.2f})")
+
+    return {
+        "model": language_model_name,
+        "detected": language,
+        "probability": round(probability, 4),
+    }
+
+
+def route_model(model_name: str, language: dict) -> str:
+    """
+    Returns the model to use for audio in the identified language. Audio that
+    is confidently English is sent to SPEECH_TO_TEXT_ENGLISH_MODEL if it is set.
+    """
+    english_model_name = os.environ.get("SPEECH_TO_TEXT_ENGLISH_MODEL")
+    min_probability = float(
+        os.environ.get("SPEECH_TO_TEXT_ENGLISH_MIN_PROBABILITY", "0.9")
+    )
+
+    if (
+        english_model_name
+        and language["detected"] == "en"
+        and language["probability"] >= min_probability
+    ):
+        return english_model_name
+
+    return model_name
+
+
+def stitch_results(results: list[dict], offsets: list[float]) -> dict:
+    """
+    Combine the Whisper results for consecutive chunks of a media file into one
+    result, shifting the timestamps of each chunk by its offset in seconds.
+    """
+    segments: list[dict] = []
+    for result, offset in zip(results, offsets):
+        for segment in result["segments"]:
+            segment = shift_segment(segment, offset)
+            segment["id"] = len(segments)
+            segments.append(segment)
+
+    return {
+        "text": "".join(result["text"] for result in results),
+        "segments": segments,
+        "language": results[0]["language"] if results else None,
+    }
+
+
+def shift_segment(segment: dict, offset: float) -> dict:
+    """
+    Returns a copy of a Whisper segment with its timestamps moved by offset
+    seconds.
+    """
+    segment = {
+        **segment,
+        "seek": segment["seek"] + round(offset * whisper.audio.FRAMES_PER_SECOND),
+        "start": round(segment["start"] + offset, 3),
+        "end": round(segment["end"] + offset, 3),
+    }
+    if "words" in segment:
+        segment["words"] = [
+            {
+                **word,
+                "start": round(word["start"] + offset, 3),
+                "end": round(word["end"] + offset, 3),
+            }
+            for word in segment["words"]
+        ]
+
+    return segment
+
+
+# A pool of processes that each have their own CPU model replica, and the
+# (engine_name, model_name, processes) it was started for. It is kept between
+# jobs in worker mode so that the replicas stay loaded.
+replica_pool: ProcessPoolExecutor | None = None
+replica_pool_key: tuple[str, str, int] | None = None
+
+# the engine and model loaded in a replica process
+replica_engine: "Engine | None" = None
+replica_model: Any = None
+
+
+def get_replica_pool(
+    engine_name: str, model_name: str, processes: int
+) -> ProcessPoolExecutor:
+    global replica_pool, replica_pool_key
+
+    key = (engine_name, model_name, processes)
+    if replica_pool is not None and replica_pool_key != key:
+        replica_pool.shutdown()
+        replica_pool = None
+
+    if replica_pool is None:
+        # split the CPU threads evenly between the replicas
+        threads = max(1, (os.cpu_count() or 1) // processes)
+        logging.info(
+            f"starting {processes} {model_name} model replicas with {threads} threads each"
+        )
+        replica_pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_replica,
+            initargs=key[:2] + (threads,),
+        )
+        replica_pool_key = key
+
+    return replica_pool
+
+
+def start_replica(engine_name: str, model_name: str, threads: int) -> None:
+    global replica_engine, replica_model
+    torch.set_num_threads(threads)
+    replica_engine = get_engine(engine_name)
+    replica_model = replica_engine.load(model_name)
+
+
+def transcribe_with_replica(audio, options: dict) -> dict:
+    assert replica_engine is not None
+    return replica_engine.transcribe(replica_model, audio, options)
+
+
+def detect_language_with_replica(audio) -> str:
+    assert replica_engine is not None
+    return replica_engine.detect_language(replica_model, audio)
+
+
+def time_with_replica(audio, options: dict) -> tuple[dict, float]:
+    """
+    Transcribe with the replica, and return the result along with how many
+    seconds it took.
+    """
+    start = time.monotonic()
+    result = transcribe_with_replica(audio, options)
+
+    return result, time.monotonic() - start
+
+
+def upload_results(job: dict) -> dict:
+    """
+    Upload the Whisper output to S3, and put the job file there too. The job
+    file will have the output key added to it, which will contain a list of
+    bucket path names for the results.
+
+    The output files are uploaded concurrently, and each upload is retried
+    with backoff if it fails. The job file is only written once every output
+    file has been uploaded.
+    """
+    bucket = get_bucket()
+    output_dir = get_output_dir(job)
+
+    paths = output_files(job)
+    keys = [f"{job['id']}/output/{path.name}" for path in paths]
+
+    # the uploads share the client, since unlike resources it is thread safe
+    s3 = get_client("s3")
+    config = get_transfer_config()
+
+    def upload(path: Path, key: str) -> None:
+        retry(s3.upload_file, str(path), bucket.name, key, Config=config)
+        logging.info(f"wrote whisper result to s3://{bucket.name}/{key}")
+
+    concurrency = int(os.environ.get("SPEECH_TO_TEXT_UPLOAD_CONCURRENCY", "8"))
+    with (
+        measure(job, "upload") as upload_metrics,
+        ThreadPoolExecutor(max_workers=concurrency) as uploader,
+    ):
+        uploads = [uploader.submit(upload, path, key) for path, key in zip(paths, keys)]
+
+        # raise the first error, if any, so the job is not marked as done
+        for future in uploads:
+            future.result()
+
+        upload_metrics["files"] = len(keys)
+
+    job["output"] = keys
+
+    # the job files for shards are combined into the job's job.json by aggregate
+    if "shard" in job:
+        job_key = f"{job['id']}/shards/{job['shard']}.json"
+    else:
+        job_key = f"{job['id']}/job.json"
+    retry(bucket.put_object, Key=job_key, Body=json.dumps(job, indent=2))
+
+    # the files have landed in s3 so the local copies can be deleted so they
+    # don't accumulate in the docker container over time
+    logging.info(f"deleting local files for job: {output_dir}")
+    shutil.rmtree(output_dir)
+
+    return job
+
+
+def summarize(result: dict) -> str:
+    """
+    Describe a Whisper result briefly for logging, since the whole result for
+    a long recording can be many megabytes.
+    """
+    segments = result["segments"]
+    end = segments[-1]["end"] if segments else 0
+    text = result["text"].strip()
+    if len(text) > 80:
+        text = text[:77] + "..."
+
+    return (
+        f"language={result['language']} segments={len(segments)} end={end}s "
+        f"characters={len(result['text'])} text={text!r}"
+    )
+
+
+def write_transcript(
+    output_dir: Path, media_file: str, result: dict, options: dict | None = None
+) -> None:
+    """
+    Write a Whisper result to VTT, SRT, TXT, TSV and JSON files, making one pass
+    over the segments and appending each one to all the files. The files are
+    the same as the ones Whisper's writers produce (see whisper.utils), but the
+    segments are only read once, and output is buffered instead of being
+    flushed after every line.
+    """
+    stem = Path(media_file).stem
+
+    with ExitStack() as stack:
+        vtt, srt, txt, tsv, json_file = (
+            stack.enter_context(
+                open(output_dir / f"{stem}.{ext}", "w", encoding="utf-8")
+            )
+            for ext in ["vtt", "srt", "txt", "tsv", "json"]
+        )
+
+        cue_count = 0
+
+        def write_cues(cues: Iterable[tuple[float, float, str]]) -> None:
+            nonlocal cue_count
+            for start, end, text in cues:
+                cue_count += 1
+                vtt.write(
+                    f"{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n"
+                )
+                srt.write(
+                    f"{cue_count}\n{format_timestamp(start, True, ',')} --> "
+                    f"{format_timestamp(end, True, ',')}\n{text}\n\n"
+                )
+
+        vtt.write("WEBVTT\n\n")
+        tsv.write("start\tend\ttext\n")
+
+        # json.dump(result) with the segments written one at a time
+        json_file.write("{")
+        for i, (key, value) in enumerate(result.items()):
+            json_file.write(f"{', ' if i else ''}{json.dumps(key)}: ")
+            if key != "segments":
+                json_file.write(json.dumps(value))
+                continue
+
+            json_file.write("[")
+            # some segments of a selectively aligned result don't have words
+            subtitles = Subtitles(
+                options, any(segment.get("words") for segment in value) or None
+            )
+            for j, segment in enumerate(value):
+                json_file.write(f"{', ' if j else ''}{json.dumps(segment)}")
+
+                text = segment["text"].strip()
+                txt.write(f"{text}\n")
+                start = round(1000 * segment["start"])
+                end = round(1000 * segment["end"])
+                tsv_text = text.replace("\t", " ")
+                tsv.write(f"{start}\t{end}\t{tsv_text}\n")
+                write_cues(subtitles.add(segment))
+            write_cues(subtitles.finish())
+            json_file.write("]")
+        json_file.write("}")
+
+
+class Subtitles:
+    """
+    Turns Whisper segments, added one at a time, into (start, end, text) cues
+    for subtitle files. This follows SubtitlesWriter.iterate_result from
+    whisper.utils, which needs all the segments up front, and uses the same
+    writer options: max_line_width, max_line_count, highlight_words and
+    max_words_per_line.
+
+    Cues are made from words when the segments have them. Segments without
+    words (see align_words) are treated as a single word.
+    """
+
+    def __init__(self, options: dict | None = None, words: bool | None = None):
+        options = options or {}
+        self.max_line_count = options.get("max_line_count")
+        self.highlight_words = options.get("highlight_words", False)
+        self.preserve_segments = (
+            self.max_line_count is None or options.get("max_line_width") is None
+        )
+        self.max_line_width = options.get("max_line_width") or 1000
+        self.max_words_per_line = options.get("max_words_per_line") or 1000
+
+        # whether cues are made from words, which unless it is given is decided
+        # by the first segment
+        self.words = words
+
+        self.line_len = 0
+        self.line_count = 1
+        self.subtitle: list[dict] = []
+        self.last: float | None = None
+
+    def add(self, segment: dict) -> list[tuple[float, float, str]]:
+        if self.words is None:
+            self.words = "words" in segment
+
+        if not self.words:
+            text = segment["text"].strip().replace("-->", "->")
+            return [(segment["start"], segment["end"], text)]
+
+        cues = []
+        if "words" in segment:
+            words = segment["words"]
+        elif segment["text"].strip():
+            words = [
+                {
+                    "word": segment["text"],
+                    "start": segment["start"],
+                    "end": segment["end"],
+                }
+            ]
+        else:
+            words = []
+        chunk_index = 0
+        words_count = self.max_words_per_line
+        while chunk_index < len(words):
+            remaining_words = len(words) - chunk_index
+            if self.max_words_per_line > remaining_words:
+                words_count = remaining_words
+            for i, original_timing in enumerate(
+                words[chunk_index : chunk_index + words_count]
+            ):
+                timing = original_timing.copy()
+                # the first word starts where the subtitles start
+                last = timing["start"] if self.last is None else self.last
+                long_pause = not self.preserve_segments and timing["start"] - last > 3.0
+                has_room = self.line_len + len(timing["word"]) <= self.max_line_width
+                seg_break = i == 0 and len(self.subtitle) > 0 and self.preserve_segments
+                if self.line_len > 0 and has_room and not long_pause and not seg_break:
+                    # line continuation
+                    self.line_len += len(timing["word"])
+                else:
+                    # new line
+                    timing["word"] = timing["word"].strip()
+                    if (
+                        len(self.subtitle) > 0
+                        and self.max_line_count is not None
+                        and (long_pause or self.line_count >= self.max_line_count)
+                        or seg_break
+                    ):
+                        # subtitle break
+                        cues += self.cues(self.subtitle)
+                        self.subtitle = []
+                        self.line_count = 1
+                    elif self.line_len > 0:
+                        # line break
+                        self.line_count += 1
+                        timing["word"] = "\n" + timing["word"]
+                    self.line_len = len(timing["word"].strip())
+                self.subtitle.append(timing)
+                self.last = timing["start"]
+            chunk_index += self.max_words_per_line
+
+        return cues
+
+    def finish(self) -> list[tuple[float, float, str]]:
+        cues = self.cues(self.subtitle) if self.subtitle else []
+        self.subtitle = []
+        return cues
+
+    def cues(self, subtitle: list[dict]) -> list[tuple[float, float, str]]:
+        start = subtitle[0]["start"]
+        end = subtitle[-1]["end"]
+        text = "".join(word["word"] for word in subtitle)
+        if not self.highlight_words:
+            return [(start, end, text)]
+
+        # timestamps are compared at the millisecond precision they are written in
+        cues = []
+        last = start
+        all_words = [timing["word"] for timing in subtitle]
+        for i, this_word in enumerate(subtitle):
+            if round(last * 1000) != round(this_word["start"] * 1000):
+                cues.append((last, this_word["start"], text))
+            highlighted = "".join(
+                re.sub(r"^(\s*)(.*)$", r"\1<u>\2</u>", word) if j == i else word
+                for j, word in enumerate(all_words)
+            )
+            cues.append((this_word["start"], this_word["end"], highlighted))
+            last = this_word["end"]
+
+        return cues
+
+
+def output_files(job: dict) -> list[Path]:
+    """
+    Returns the Whisper output files for the job, in the order of the job's
+    media so that the job's output list is deterministic.
+    """
+    output_dir = get_output_dir(job)
+    paths = []
+    for media in job["media"]:
+        stem = Path(media["name"]).stem
+        for ext in ["vtt", "srt", "json", "txt", "tsv"]:
+            path = output_dir / f"{stem}.{ext}"
+            if path.is_file():
+                paths.append(path)
+
+    return paths
+
+
+def finish_job(job: dict) -> dict:
+    queue = get_done_queue()
+    logging.info(f"sending message to done queue: {job}")
+    # the time taken to send the message can only be exported, since it
+    # happens after the job has been serialized
+    with measure(job, "send"):
+        queue.send_message(MessageBody=json.dumps(job))
+
+    return job
+
+
+# serializes updates to job metrics from the download threads
+metrics_lock = threading.Lock()
+
+# metrics for all the jobs this process has run, for the Prometheus export
+metrics_totals: dict = {}
+
+
+@contextmanager
+def measure(job: dict, stage: str) -> Generator[dict, None, None]:
+    """
+    Time a stage of running a job, adding it to the stage's total time in
+    job["metrics"] along with the peak memory (and GPU memory) used by the
+    process during the stage. Counts added to the yielded dictionary are added
+    to the stage's metrics too.
+
+    The peaks are only tracked for stages run on the main thread, where the
+    model is loaded and used. They are shared by the whole process, so
+    resetting them for the download and decode stages, which run in other
+    threads at the same time, would lose the peaks for transcription. The peak
+    memory can only be reset on Linux.
+    """
+    counts: dict = {}
+    main_thread = threading.current_thread() is threading.main_thread()
+    gpu = torch.cuda.is_available() and main_thread
+    if gpu:
+        torch.cuda.reset_peak_memory_stats()
+    rss = main_thread and reset_peak_rss()
+    started = time.monotonic()
+
+    try:
+        yield counts
+    finally:
+        seconds = time.monotonic() - started
+        max_rss = peak_rss_mb() if rss else None
+
+        with metrics_lock:
+            stages = job.setdefault("metrics", {}).setdefault("stages", {})
+            metrics = stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            metrics["calls"] += 1
+            metrics["seconds"] = round(metrics["seconds"] + seconds, 3)
+            if max_rss is not None:
+                metrics["max_rss_mb"] = max(
+                    metrics.get("max_rss_mb", 0), round(max_rss)
+                )
+            if gpu:
+                max_gpu = torch.cuda.max_memory_allocated() / 2**20
+                metrics["max_gpu_mb"] = max(
+                    metrics.get("max_gpu_mb", 0), round(max_gpu)
+                )
+            for name, count in counts.items():
+                metrics[name] = metrics.get(name, 0) + count
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident memory of the process (VmHWM), returning whether
+    that is possible here.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float | None:
+    """
+    Returns the peak resident memory of the process since it was last reset.
+    """
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmHWM:"):
+                # the size is in kilobytes
+                return int(line.split()[1]) / 1024
+
+    return None
+
+
+def export_metrics(job: dict) -> None:
+    """
+    When SPEECH_TO_TEXT_METRICS_FILE is set, write the job's metrics to it. If
+    the file name ends with .prom the totals for all the jobs this process has
+    run are written in the Prometheus text format (for node_exporter's textfile
+    collector). Otherwise the job's metrics are appended as a line of JSON.
+    """
+    path = os.environ.get("SPEECH_TO_TEXT_METRICS_FILE")
+    if not path:
+        return
+
+    metrics = job.get("metrics", {})
+
+    if not path.endswith(".prom"):
+        with open(path, "a") as fh:
+            fh.write(json.dumps({"id": job["id"], "finished": now(), **metrics}))
+            fh.write("\n")
+        return
+
+    totals = metrics_totals
+    totals["jobs"] = totals.get("jobs", 0) + 1
+    for stage, stage_metrics in metrics.get("stages", {}).items():
+        totals.setdefault("seconds", {})[stage] = round(
+            totals.get("seconds", {}).get(stage, 0) + stage_metrics["seconds"], 3
+        )
+        totals["max_rss_mb"] = max(
+            totals.get("max_rss_mb", 0), stage_metrics.get("max_rss_mb", 0)
+        )
+    for media in metrics.get("media", []):
+        totals["media_seconds"] = round(
+            totals.get("media_seconds", 0) + media["duration"], 3
+        )
+        totals["transcribe_seconds"] = round(
+            totals.get("transcribe_seconds", 0) + media["seconds"], 3
+        )
+
+    lines = [
+        "# TYPE speech_to_text_jobs_total counter",
+        f"speech_to_text_jobs_total {totals['jobs']}",
+        "# TYPE speech_to_text_stage_seconds_total counter",
+    ]
+    for stage, seconds in sorted(totals.get("seconds", {}).items()):
+        lines.append(f'speech_to_text_stage_seconds_total{{stage="{stage}"}} {seconds}')
+    lines += [
+        "# TYPE speech_to_text_media_seconds_total counter",
+        f"speech_to_text_media_seconds_total {totals.get('media_seconds', 0)}",
+        "# TYPE speech_to_text_transcribe_seconds_total counter",
+        f"speech_to_text_transcribe_seconds_total {totals.get('transcribe_seconds', 0)}",
+        "# TYPE speech_to_text_max_rss_bytes gauge",
+        f"speech_to_text_max_rss_bytes {totals.get('max_rss_mb', 0) * 2**20}",
+    ]
+
+    # replace the file in one go so the collector never reads half of it
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def get_transfer_config() -> TransferConfig:
+    """
+    Returns the configuration used for S3 uploads and downloads. Large files
+    are transferred in parts, several parts at a time.
+    """
+    mb = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=int(
+            os.environ.get("SPEECH_TO_TEXT_MULTIPART_THRESHOLD_MB", "16")
+        )
+        * mb,
+        multipart_chunksize=int(
+            os.environ.get("SPEECH_TO_TEXT_MULTIPART_CHUNKSIZE_MB", "16")
+        )
+        * mb,
+        max_concurrency=int(
+            os.environ.get("SPEECH_TO_TEXT_MULTIPART_CONCURRENCY", "8")
+        ),
+    )
+
+
+def retry(func, *args, **kwargs):
+    """
+    Call a function that talks to AWS, retrying it with exponential backoff
+    (and some jitter) when it fails. The error is raised if the last attempt
+    fails too.
+    """
+    attempts = int(os.environ.get("SPEECH_TO_TEXT_RETRY_ATTEMPTS", "5"))
+    backoff = float(os.environ.get("SPEECH_TO_TEXT_RETRY_BACKOFF", "1"))
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            logging.warning(
+                f"attempt {attempt} of {attempts} failed ({e}), retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+
+def get_s3() -> S3ServiceResource:
+    return get_resource("s3")
+
+
+# A single boto3 session is shared by the whole process, along with the clients
+# created from it. Resources are not thread safe, so they are kept per thread.
+aws_lock = threading.Lock()
+aws_session: boto3.Session | None = None
+aws_session_expires: datetime.datetime | None = None
+aws_clients: dict = {}
+aws_queue_urls: dict[str, str] = {}
+aws_local = threading.local()
+
+
+def get_session() -> boto3.Session:
+    """
+    Returns the boto3 session for the process. If AWS_ROLE_ARN is set the
+    session uses credentials for the assumed role, which are refreshed a few
+    minutes before they expire.
+    """
+    global aws_session, aws_session_expires
+
+    with aws_lock:
+        refresh_at = None
+        if aws_session_expires is not None:
+            refresh_at = aws_session_expires - datetime.timedelta(minutes=5)
+
+        if aws_session is None or (refresh_at is not None and now_dt() >= refresh_at):
+            aws_session, aws_session_expires = new_session()
+            aws_clients.clear()
+
+        return aws_session
+
+
+def new_session() -> tuple[boto3.Session, datetime.datetime | None]:
+    # This would be a lot easier if boto3 read AWS_ROLE_ARN like it does other
+    # environment variables:
+    #
+    # see: https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use_switch-role-api.html
+    role = os.environ.get("AWS_ROLE_ARN")
+
+    if not role:
+        return boto3.Session(), None
+
+    logging.info(f"assuming role {role}")
+    sts_client = boto3.client("sts")
+    response = sts_client.assume_role(RoleArn=role, RoleSessionName="speech-to-text")
+    session = boto3.Session(
+        aws_access_key_id=response["Credentials"]["AccessKeyId"],
+        aws_secret_access_key=response["Credentials"]["SecretAccessKey"],
+        aws_session_token=response["Credentials"]["SessionToken"],
+    )
+
+    return session, response["Credentials"]["Expiration"]
+
+
+def get_client_config() -> botocore.config.Config:
+    # the connection pool needs to be big enough for the concurrent transfers
+    return botocore.config.Config(
+        max_pool_connections=int(
+            os.environ.get("SPEECH_TO_TEXT_MAX_POOL_CONNECTIONS", "50")
+        )
+    )
+
+
+def get_client(service: str):
+    """
+    Returns a shared client for an AWS service. Clients are thread safe.
+    """
+    session = get_session()
+    with aws_lock:
+        if service not in aws_clients:
+            aws_clients[service] = session.client(  # type: ignore[call-overload]
+                service, config=get_client_config()
+            )
+        return aws_clients[service]
+
+
+def get_resource(service: str):
+    """
+    Returns a resource for an AWS service that is reused by the current thread
+    for as long as the session lasts.
+    """
+    session = get_session()
+    if getattr(aws_local, "session", None) is not session:
+        aws_local.session = session
+        aws_local.resources = {}
+
+    if service not in aws_local.resources:
+        aws_local.resources[service] = session.resource(  # type: ignore[call-overload]
+            service, config=get_client_config()
+        )
+
+    return aws_local.resources[service]
+
+
+def get_bucket() -> Bucket:
+    s3 = get_s3()
+    bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET", "")
+    return s3.Bucket(bucket_name)
+
+
+def get_object(key: str) -> dict | None:
+    """
+    Returns the get_object response for a key in the bucket, or None if there
+    is no such object.
+    """
+    try:
+        return get_client("s3").get_object(
+            Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"), Key=key
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise
+
+
+def head_object(key: str) -> dict | None:
+    """
+    Returns the head_object response for a key in the bucket, or None if there
+    is no such object.
+    """
+    try:
+        return get_client("s3").head_object(
+            Bucket=os.environ.get("SPEECH_TO_TEXT_S3_BUCKET"), Key=key
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise
+
+
+def get_queue(queue_name: str) -> Queue:
+    """
+    Returns an SQS queue, only looking up its URL the first time.
+    """
+    sqs = get_resource("sqs")
+    if queue_name not in aws_queue_urls:
+        aws_queue_urls[queue_name] = sqs.get_queue_by_name(QueueName=queue_name).url
+    return sqs.Queue(aws_queue_urls[queue_name])
+
+
+def get_done_queue() -> Queue:
+    return get_queue(os.environ.get("SPEECH_TO_TEXT_DONE_SQS_QUEUE", ""))
+
+
+def get_todo_queue() -> Queue:
+    return get_queue(os.environ.get("SPEECH_TO_TEXT_TODO_SQS_QUEUE", ""))
+
+
+# noted on errors once they have been sent to the done queue
+REPORTED = "The error was sent to the done queue"
+
+
+def report_error(message: str, job: dict | None, e: Exception) -> None:
+    """
+    Add the job to the done queue with an error.
+
+    The error for a shard of a sharded job is saved in place of its part of the
+    job instead, and isn't raised, so that the child of the array job succeeds
+    and the aggregate job runs and sends a single error message for the job.
+    """
+    stacktrace = traceback.format_exc()
+    full_message = message + "\n" + stacktrace
+    logging.exception(full_message)
+
+    # it's possible that we are reporting an error without a job
+    # we can only send a message to the DONE queue if we have a job!
+    if job is not None and "shard" in job:
+        job["error"] = full_message
+
+        key = f"{job['id']}/shards/{job['shard']}.json"
+        logging.error(f"saving error for shard to {key}: {job}")
+        retry(get_bucket().put_object, Key=key, Body=json.dumps(job, indent=2))
+        e.add_note(REPORTED)
+    elif job is not None:
+        job["error"] = full_message
+
+        queue = get_done_queue()
+        logging.error(f"sending error message to done queue: {job}")
+        queue.send_message(MessageBody=json.dumps(job))
+        e.add_note(REPORTED)
+
+    hb_key = os.environ.get("HONEYBADGER_API_KEY", "")
+    hb_env = os.environ.get("HONEYBADGER_ENV", "stage")
+    honeybadger.configure(api_key=hb_key, environment=hb_env)
+
+    honeybadger.notify(
+        error_class="SpeechToTextError",
+        error_message="Whisper AWS process \n" + message,
+        context={"job": job, "traceback": stacktrace},
+    )
+
+    if job is not None and "shard" in job:
+        return
+
+    raise e
+
+
+def check_env() -> None:
+    names = ["SPEECH_TO_TEXT_S3_BUCKET", "SPEECH_TO_TEXT_DONE_SQS_QUEUE"]
+    for name in names:
+        if os.environ.get(name) is None:
+            sys.exit(f"{name} is not defined in the environment")
+
+
+def now() -> str:
+    return now_dt().isoformat()
+
+
+def now_dt() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+def get_output_dir(job) -> Path:
+    return Path(job["id"])
+
+
+def decode_media(
+    path: str,
+    scratch_dir: Path,
+    stream: Callable[[], Iterable[bytes]] | None = None,
+) -> tuple[dict, Path]:
+    """
+    Decode a media file to the 16kHz mono float32 PCM audio that Whisper uses,
+    in a single ffmpeg pass that also reports the duration, format and size of
+    the media (like inspect_media). The audio is saved as a .npy file in the
+    scratch directory so that it can be memory mapped, and the audio and media
+    information are reused if the file has already been decoded.
+
+    If a stream function is passed in the media is read from the chunks of bytes
+    it returns, rather than from the file at path. An error reading the stream
+    is raised as a SpeechToTextException, even if ffmpeg managed to decode the
+    media it was given.
+    """
+    pcm_path = get_pcm_path(path, scratch_dir)
+    info_path = pcm_path.with_suffix(".json")
+
+    if pcm_path.is_file() and info_path.is_file():
+        return json.loads(info_path.read_text()), pcm_path
+
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    raw_path = pcm_path.with_suffix(".s16")
+
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-i",
+        "pipe:0" if stream else path,
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(whisper.audio.SAMPLE_RATE),
+        "-f",
+        "s16le",
+        "-",
+    ]
+
+    size = 0
+    stream_error: Exception | None = None
+
+    def feed(stdin, chunks: Iterable[bytes]) -> None:
+        nonlocal size, stream_error
+        try:
+            for chunk in chunks:
+                stdin.write(chunk)
+                size += len(chunk)
+        except BrokenPipeError:
+            # ffmpeg gave up, which is reported by its exit code
+            pass
+        except Exception as e:
+            # the stream failed partway through
+            stream_error = e
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # open the stream before starting ffmpeg so that ffmpeg isn't left running
+    # if it can't be opened
+    chunks = stream() if stream else None
+
+    with raw_path.open("wb") as raw:
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if chunks is not None else subprocess.DEVNULL,
+            stdout=raw,
+            stderr=subprocess.PIPE,
+        )
+        feeder = None
+        try:
+            if chunks is not None:
+                feeder = threading.Thread(target=feed, args=(process.stdin, chunks))
+                feeder.start()
+            assert process.stderr is not None
+            stderr = process.stderr.read().decode("utf-8", errors="replace")
+            process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raw_path.unlink(missing_ok=True)
+            raise
+        finally:
+            if feeder:
+                feeder.join()
+
+    if stream_error is not None:
+        raw_path.unlink(missing_ok=True)
+        raise SpeechToTextException(
+            f"Unable to read {path}: {stream_error}"
+        ) from stream_error
+
+    if process.returncode != 0:
+        raw_path.unlink()
+        raise SpeechToTextException(f"Invalid media file {path}")
+
+    info = media_info(stderr, raw_path.stat().st_size // 2)
+    info["size"] = size if stream else os.path.getsize(path)
+
+    write_npy(raw_path, pcm_path)
+    info_path.write_text(json.dumps(info))
+
+    return info, pcm_path
+
+
+def media_info(ffmpeg_stderr: str, samples: int) -> dict:
+    """
+    Get the duration and format of the input from ffmpeg's log output. If ffmpeg
+    doesn't know the duration the length of the decoded audio is used.
+    """
+    duration = samples / whisper.audio.SAMPLE_RATE
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", ffmpeg_stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    match = re.search(r"Input #0, (.+?), from '", ffmpeg_stderr)
+    media_format = match.group(1) if match else None
+
+    return {"duration": duration, "format": media_format}
+
+
+def write_npy(raw_path: Path, npy_path: Path) -> None:
+    """
+    Turn a file of raw 16-bit samples into a .npy file of float32 samples,
+    converted the same way as whisper.audio.load_audio, without reading all of
+    it into memory at once.
+    """
+    samples = raw_path.stat().st_size // 2
+    header = {"descr": "<f4", "fortran_order": False, "shape": (samples,)}
+
+    with npy_path.open("wb") as npy, raw_path.open("rb") as raw:
+        numpy.lib.format.write_array_header_1_0(npy, header)
+        while block := raw.read(2**20):
+            pcm = numpy.frombuffer(block, numpy.int16)
+            npy.write((pcm.astype(numpy.float32) / 32768.0).tobytes())
+
+    raw_path.unlink()
+
+
+def load_audio(job: dict, media_file: str) -> numpy.ndarray:
+    """
+    Returns the decoded audio for a media file in the job as a memory mapped
+    array, decoding it first if that hasn't happened already.
+    """
+    _, pcm_path = decode_media(media_file, get_scratch_dir(job))
+
+    # copy-on-write so that torch can use the array without copying it first
+    return numpy.load(pcm_path, mmap_mode="c")
+
+
+def get_scratch_dir(job: dict) -> Path:
+    return get_output_dir(job) / ".pcm"
+
+
+def get_pcm_path(media_file: str, scratch_dir: Path) -> Path:
+    return scratch_dir / (media_file.replace("/", "__") + ".npy")
+
+
+def is_decoded(job: dict, media_file: str) -> bool:
+    pcm_path = get_pcm_path(media_file, get_scratch_dir(job))
+    return pcm_path.is_file() and pcm_path.with_suffix(".json").is_file()
+
+
+def inspect_media(path) -> dict:
+    try:
+        output = subprocess.check_output(
+            ["ffprobe", "-show_format", "-print_format", "json", "-v", "quiet", path]
+        )
+        result = json.loads(output)
+        return {
+            "duration": float(result["format"]["duration"]),
+            "format": result["format"]["format_name"],
+            "size": int(result["format"]["size"]),
+        }
+    except subprocess.CalledProcessError:
+        raise SpeechToTextException(f"Invalid media file {path}")
+
+
+class Engine(ABC):
+    """
+    A speech recognition backend that jobs can be transcribed with, chosen with
+    the engine option. An engine loads models by name and returns results in
+    the same form as whisper.transcribe, so that the transcripts are written
+    and logged the same way whichever engine is used.
+    """
+
+    name: str
+
+    @abstractmethod
+    def version(self) -> str: ...
+
+    @abstractmethod
+    def load(self, model_name: str) -> Any: ...
+
+    @abstractmethod
+    def transcribe(self, model: Any, audio: numpy.ndarray, options: dict) -> dict: ...
+
+    def transcribe_batch(
+        self, model: Any, audios: list[numpy.ndarray], options: dict
+    ) -> list[dict]:
+        return [self.transcribe(model, audio, options) for audio in audios]
+
+    def detect_language(self, model: Any, audio: numpy.ndarray) -> str:
+        result = self.transcribe(model, audio[: whisper.audio.N_SAMPLES], {})
+        return result["language"]
+
+
+class WhisperEngine(Engine):
+    """
+    OpenAI's Whisper, which is the default engine.
+    """
+
+    name = "whisper"
+
+    def version(self) -> str:
+        return whisper.version.__version__
+
+    def load(self, model_name: str) -> whisper.model.Whisper:
+        return load_whisper_model(model_name)
+
+    def transcribe(
+        self, model: whisper.model.Whisper, audio: numpy.ndarray, options: dict
+    ) -> dict:
+        return whisper.transcribe(audio=audio, model=model, **options)
+
+    def transcribe_batch(
+        self, model: whisper.model.Whisper, audios: list[numpy.ndarray], options: dict
+    ) -> list[dict]:
+        if any(
+            len(audio) > whisper.audio.N_SAMPLES for audio in audios
+        ) and can_batch_windows(options):
+            return transcribe_windows(model, audios, options)
+        return transcribe_batch(model, audios, options)
+
+    def detect_language(
+        self, model: whisper.model.Whisper, audio: numpy.ndarray
+    ) -> str:
+        return detect_language(model, audio)
+
+
+class FakeEngine(Engine):
+    """
+    An engine that doesn't recognize any speech. Its transcripts have a segment
+    for every five seconds of audio (or of the clip_timestamps), which says
+    what model and seconds it is for. It loads instantly and always returns the
+    same result, which is useful for testing how jobs are run.
+    """
+
+    name = "fake"
+
+    segment_duration = 5.0
+
+    def version(self) -> str:
+        return "1"
+
+    def load(self, model_name: str) -> str:
+        return model_name
+
+    def transcribe(self, model: str, audio: numpy.ndarray, options: dict) -> dict:
+        duration = len(audio) / whisper.audio.SAMPLE_RATE
+
+        clips = options.get("clip_timestamps", [0.0])
+        if isinstance(clips, str):
+            clips = [float(t) for t in clips.split(",") if t]
+        if len(clips) % 2 == 1:
+            clips = [*clips, duration]
+
+        segments: list[dict] = []
+        for clip_start, clip_end in zip(clips[::2], clips[1::2]):
+            start = clip_start
+            while start < min(clip_end, duration):
+                end = min(start + self.segment_duration, clip_end, duration)
+                segment = {
+                    "id": len(segments),
+                    "seek": round(start * whisper.audio.FRAMES_PER_SECOND),
+                    "start": round(start, 3),
+                    "end": round(end, 3),
+                    "text": f" {model} {start:.1f} to {end:.1f}",
+                    "tokens": [],
+                    "temperature": 0.0,
+                    "avg_logprob": 0.0,
+                    "compression_ratio": 1.0,
+                    "no_speech_prob": 0.0,
+                }
+                if options.get("word_timestamps"):
+                    words = segment["text"].split()
+                    step = (end - start) / len(words)
+                    segment["words"] = [
+                        {
+                            "word": f" {word}",
+                            "start": round(start + i * step, 3),
+                            "end": round(start + (i + 1) * step, 3),
+                            "probability": 1.0,
+                        }
+                        for i, word in enumerate(words)
+                    ]
+                segments.append(segment)
+                start = end
+
+        return {
+            "text": "".join(segment["text"] for segment in segments),
+            "segments": segments,
+            "language": options.get("language") or "en",
+        }
+
+
+# the engines that can be chosen with the engine option
+engines: dict[str, Engine] = {
+    engine.name: engine for engine in [WhisperEngine(), FakeEngine()]
+}
+
+
+def get_engine(engine_name: str) -> Engine:
+    if engine_name not in engines:
+        raise SpeechToTextException(
+            f"Unknown engine {engine_name}, expected one of: {', '.join(engines)}"
+        )
+
+    return engines[engine_name]
+
+
+# Models that have been loaded, least recently used first. In worker mode this
+# saves loading a model again for every job. Models for engines other than
+# Whisper are cached under names like fake/tiny.
+models: OrderedDict[str, Any] = OrderedDict()
+
+
+# The small model used to identify the language of audio, which is kept apart
+# from the models cache so that it doesn't push out the transcription models.
+language_model: tuple[str, whisper.model.Whisper] | None = None
+
+
+def get_language_model(model_name) -> whisper.model.Whisper:
+    global language_model
+
+    if language_model is None or language_model[0] != model_name:
+        language_model = (model_name, load_whisper_model(model_name))
+
+    return language_model[1]
+
+
+def get_whisper_model(model_name, engine_name: str = "whisper") -> Any:
+    key = model_name if engine_name == "whisper" else f"{engine_name}/{model_name}"
+    if key in models:
+        models.move_to_end(key)
+        return models[key]
+
+    evict_whisper_models()
+    models[key] = get_engine(engine_name).load(model_name)
+
+    return models[key]
+
+
+def evict_whisper_models() -> None:
+    """
+    Make room for a new model by dropping the least recently used models when
+    the cache is full or when free memory is getting low.
+    """
+    max_models = int(os.environ.get("SPEECH_TO_TEXT_MODEL_CACHE_SIZE", "2"))
+    min_free = float(os.environ.get("SPEECH_TO_TEXT_MIN_FREE_MEMORY_GB", "4")) * 2**30
+
+    while len(models) > 0 and (
+        len(models) >= max_models or available_memory() < min_free
+    ):
+        model_name, _ = models.popitem(last=False)
+        logging.info(f"evicting {model_name} Whisper model from the cache")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def available_memory() -> int:
+    """
+    Returns the number of bytes available on the device models are loaded on.
+    """
+    if torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free
+
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def load_whisper_model(model_name) -> whisper.model.Whisper:
+    if torch.cuda.is_available():
+        device = "cuda"
+    else:
+        device = "cpu"
+
+    logging.info(f"loading {model_name} Whisper model for {device}")
+    start = time.monotonic()
+
+    # quantized models are named like medium:int8
+    name, _, quantize = model_name.partition(":")
+    if quantize:
+        model = load_quantized_model(name, quantize)
+    else:
+        model = load_model(name, device)
+
+    logging.info(
+        f"loaded {model_name} Whisper model in {time.monotonic() - start:.2f} seconds"
+    )
+
+    return model
+
+
+def load_model(model_name: str, device: str) -> whisper.model.Whisper:
+    model_store = os.environ.get("SPEECH_TO_TEXT_MODEL_STORE")
+    if model_store:
+        return load_stored_model(model_name, Path(model_store), device)
+
+    return whisper.load_model(model_name, download_root="whisper_models", device=device)
+
+
+# the model store files that have been checked against their checksums
+verified_models: set[tuple[str, int, int]] = set()
+
+
+def matches_checksum(path: Path, sha256: str) -> bool:
+    """
+    Whether a file matches its checksum. Files are only hashed the first time
+    the process sees them (unless they change).
+    """
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in verified_models:
+        if file_sha256(path) != sha256:
+            return False
+        verified_models.add(key)
+
+    return True
+
+
+def load_quantized_model(model_name: str, quantize: str) -> whisper.model.Whisper:
+    """
+    Load a quantized CPU model, which is saved to the model store (or the
+    whisper_models directory) the first time it is made. The saved model is
+    made again if it doesn't match the checksum in its manifest, or was made
+    with other versions of torch or whisper.
+    """
+    model_dir = Path(os.environ.get("SPEECH_TO_TEXT_MODEL_STORE") or "whisper_models")
+    path = model_dir / f"{model_name}-{quantize}.pt"
+    manifest_path = path.with_suffix(".json")
+    versions = {"torch": torch.__version__, "whisper": whisper.version.__version__}
+
+    if path.is_file() and manifest_path.is_file():
+        manifest = json.loads(manifest_path.read_text())
+        if all(
+            manifest.get(name) == version for name, version in versions.items()
+        ) and matches_checksum(path, manifest["sha256"]):
+            # this is a whole pickled model, since quantized modules can't be
+            # loaded into a model's state dict
+            return torch.load(path, map_location="cpu", weights_only=False)
+        logging.warning(f"{path} doesn't match its manifest, quantizing it again")
+
+    model = quantize_model(load_model(model_name, "cpu"))
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+
+    manifest_path.write_text(
+        json.dumps(
+            {
+                "model": model_name,
+                "quantize": quantize,
+                **versions,
+                "sha256": file_sha256(path),
+            }
+        )
+    )
+
+    return model
+
+
+def quantize_model(model: whisper.model.Whisper) -> whisper.model.Whisper:
+    """
+    Apply PyTorch's dynamic int8 quantization to the model's linear layers.
+    """
+    # Whisper's Linear layers only differ from torch's by casting their weights
+    # to the input's dtype, which isn't needed on the CPU, and quantize_dynamic
+    # only converts torch's own Linear class
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def load_stored_model(
+    model_name: str, model_store: Path, device: str
+) -> whisper.model.Whisper:
+    """
+    Load a model that has been converted with convert_model. The checkpoint is
+    memory mapped, and its tensors are used as the model's parameters without
+    being copied (on the CPU) or initialized first. The model is converted if
+    it isn't in the store yet, or if it doesn't match its checksum.
+    """
+    path = model_store / f"{model_name}.pt"
+    manifest_path = path.with_suffix(".json")
+    if not (path.is_file() and manifest_path.is_file()):
+        convert_model(model_name, model_store)
+
+    manifest = json.loads(manifest_path.read_text())
+    if not matches_checksum(path, manifest["sha256"]):
+        logging.warning(f"{path} doesn't match its checksum, converting it again")
+        convert_model(model_name, model_store)
+
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+    # build the model without allocating or initializing its tensors, the way
+    # whisper.model.Whisper.__init__ does (which can't be run on the meta device
+    # since it makes a sparse tensor)
+    dims = whisper.model.ModelDimensions(**checkpoint["dims"])
+    model = whisper.model.Whisper.__new__(whisper.model.Whisper)
+    torch.nn.Module.__init__(model)
+    model.dims = dims
+    with torch.device("meta"):
+        model.encoder = whisper.model.AudioEncoder(
+            dims.n_mels,
+            dims.n_audio_ctx,
+            dims.n_audio_state,
+            dims.n_audio_head,
+            dims.n_audio_layer,
+        )
+        model.decoder = whisper.model.TextDecoder(
+            dims.n_vocab,
+            dims.n_text_ctx,
+            dims.n_text_state,
+            dims.n_text_head,
+            dims.n_text_layer,
+        )
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+
+    # buffers that aren't part of the state dict, like the attention mask
+    for name, tensor in checkpoint["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        if name in checkpoint["sparse"]:
+            tensor = tensor.to_sparse()
+        model.get_submodule(module_name).register_buffer(
+            buffer_name, tensor, persistent=False
+        )
+
+    return model.to(device)
+
+
+def convert_model(model_name: str, model_store: Path) -> Path:
+    """
+    Save a Whisper model to the model store with its tensors already in the
+    dtype the model uses, in a format that can be memory mapped, and write its
+    checksum alongside it.
+    """
+    logging.info(f"converting {model_name} Whisper model for the model store")
+    model = whisper.load_model(model_name, download_root="whisper_models", device="cpu")
+
+    persistent = model.state_dict()
+    buffers = {
+        name: tensor.to_dense() if tensor.is_sparse else tensor
+        for name, tensor in model.named_buffers()
+        if name not in persistent
+    }
+    checkpoint = {
+        "dims": dataclasses.asdict(model.dims),
+        "state_dict": persistent,
+        "buffers": buffers,
+        "sparse": [name for name, tensor in model.named_buffers() if tensor.is_sparse],
+    }
+
+    model_store.mkdir(parents=True, exist_ok=True)
+    path = model_store / f"{model_name}.pt"
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+    path.with_suffix(".json").write_text(
+        json.dumps(
+            {
+                "model": model_name,
+                "whisper": whisper.version.__version__,
+                "sha256": file_sha256(path),
+            }
+        )
+    )
+
+    return path
+
+
+def file_sha256(path: Path) -> str:
+    with open(path, "rb") as fh:
+        return hashlib.file_digest(fh, "sha256").hexdigest()
+
+
+# the functions below are for initiating a speech-to-text job
+# this functionality is here mostly for testing but the idea is that
+# you would upload files to s3 and initiate the batch job using
+# an AWS client library
+
+
+def create(
+    media_paths: list[Path], shards: int = 1, target_minutes: float | None = None
+) -> None:
+    """
+    Create a job for the given media files by placing the media files in S3 and
+    then creating a batch job which can be picked up to perform transcription
+    using boilerplate options. The job can be split into shards that are
+    transcribed in parallel (see submit_job).
+
+    With a target runtime the media is ordered longest first, and the job is
+    split into enough shards that each is estimated to take about that long.
+    """
+    job_id = str(uuid.uuid4())
+
+    if target_minutes:
+        estimates = estimate_media([Path(path) for path in media_paths], job_options())
+        media_paths = sorted(media_paths, key=lambda path: -estimates[Path(path)])
+        shards = max(shards, plan_shards(list(estimates.values()), target_minutes))
 
-    output_dir = get_output_dir(job)
-    if not output_dir.is_dir():
-        output_dir.mkdir()
+    names = [add_media(media_path, job_id) for media_path in media_paths]
 
-    for media in job["media"]:
-        # note the media_file is expected to be the full path in the bucket
-        # e.g. pg879tb2706-v2/video_1.mp4
-        media_file = media["name"]
-        bucket.download_file(media_file, media_file)
+    submit_job(new_job(job_id, names), shards)
 
-        media_info = inspect_media(media_file)
-        logging.info(f"downloaded {media_file}: {json.dumps(media_info)}")
 
-    return job
+def is_manifest(path: Path) -> bool:
+    return path.is_dir() or path.suffix.lower() in [".csv", ".json"]
 
 
-def run_whisper(job: dict) -> dict:
-    # the code for interacting with whisper here was adapted from
-    # https://github.com/openai/whisper/blob/main/whisper/transcribe.py
+def new_job(job_id: str, names: list[str]) -> dict:
+    """
+    Returns a job with boilerplate options for media that has been uploaded
+    with the job ID as its prefix.
+    """
+    return {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/{name}"} for name in names],
+        "options": job_options(),
+    }
 
-    options = job.get("options", {}).copy()
 
-    model_name = options.get("model", "large")
-    model = load_whisper_model(model_name)
+def job_options() -> dict:
+    return {
+        "model": "large",
+        "word_timestamps": True,
+        "condition_on_previous_text": False,
+        "writer": {"max_line_width": 42, "max_line_count": 1},
+    }
 
-    # configure the whisper writer that will take the whisper JSON output and
-    # convert to other formats like vtt, txt, etc
-    output_dir = get_output_dir(job)
-    writer = get_writer(output_format="all", output_dir=output_dir)
 
-    # accumulate the options that were used for transcription and writing
-    runs = []
+def create_bulk(
+    manifest: Path,
+    files_per_job: int = 1,
+    shards: int = 1,
+    rate: float = 5,
+    target_minutes: float | None = None,
+) -> dict:
+    """
+    Create jobs for the media in a manifest (see read_manifest). Media that is
+    given a job in the manifest is grouped into that job, and the rest is put
+    into jobs of files_per_job files each, or with a target runtime is packed
+    into jobs that are estimated to take about that long (see pack_media). The
+    media is uploaded concurrently, skipping files that are already in the
+    bucket, and each job is submitted as soon as its media is uploaded, at most
+    rate jobs a second. Prints and returns a summary of the jobs.
+    """
+    entries = read_manifest(manifest)
+    if target_minutes:
+        estimates = estimate_media([entry["path"] for entry in entries], job_options())
+        jobs = pack_media(entries, estimates, target_minutes)
+    else:
+        jobs = group_media(entries, files_per_job)
+    logging.info(f"creating {len(jobs)} jobs for {len(entries)} media files")
 
-    for media in job["media"]:
-        media_file = media["name"]
+    started = time.monotonic()
+    summary: dict = {"jobs": [], "uploaded": 0, "skipped": 0}
+    concurrency = int(os.environ.get("SPEECH_TO_TEXT_UPLOAD_CONCURRENCY", "8"))
+    with ThreadPoolExecutor(max_workers=concurrency) as uploader:
+        uploads = {
+            job_id: [
+                uploader.submit(upload_media, path, f"{job_id}/{path.name}")
+                for path in paths
+            ]
+            for job_id, paths in jobs.items()
+        }
 
-        whisper_options = {**options, **media.get("options", {})}
+        last_submit = 0.0
+        for job_id, paths in jobs.items():
+            for future in uploads[job_id]:
+                summary["uploaded" if future.result() else "skipped"] += 1
 
-        writer_options = whisper_options.get("writer", {})
-        if len(writer_options) > 0:
-            whisper_options["word_timestamps"] = True
+            # stay under the Batch API's rate limit
+            time.sleep(max(0, last_submit + 1 / rate - time.monotonic()))
+            last_submit = time.monotonic()
 
-        # remove model and writer from options that are passed to whisper
-        whisper_options.pop("model", None)
-        whisper_options.pop("writer", None)
+            job_shards = shards
+            if target_minutes:
+                job_estimates = [estimates[path] for path in paths]
+                job_shards = max(shards, plan_shards(job_estimates, target_minutes))
 
-        try:
-            logging.info(
-                f"running whisper on {media_file} with model={model_name} options={whisper_options}"
+            batch_job_ids = submit_job(
+                new_job(job_id, [path.name for path in paths]), job_shards
             )
-            result = whisper.transcribe(
-                audio=media_file, model=model, **whisper_options
+            summary["jobs"].append(
+                {"id": job_id, "media": len(paths), "batch_jobs": batch_job_ids}
             )
-            logging.info(f"whisper result: {result}")
+            if target_minutes:
+                summary["jobs"][-1]["estimated_minutes"] = round(
+                    (estimate_overhead() + sum(job_estimates)) / 60, 1
+                )
 
-            logging.info(f"writing output using writer_options: {writer_options}")
-            writer(result, media_file, writer_options)
-        except Exception as e:
-            raise SpeechToTextException(str(e))
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    print(json.dumps(summary, indent=2))
 
-        runs.append(
-            {
-                "media": media_file,
-                "transcribe": {"model": model_name, **whisper_options},
-                "write": writer_options,
-            }
-        )
+    return summary
 
-    job["finished"] = now()
 
-    job["log"] = {
-        "name": "whisper",
-        "version": whisper.version.__version__,
-        "runs": runs,
-    }
+def read_manifest(manifest: Path) -> list[dict]:
+    """
+    Returns the media files listed in a manifest, as dictionaries with the
+    path and (if it was given) the ID of the job to put it in. The manifest is
+    either a directory of media files (including subdirectories), or a CSV file
+    with path and optional job columns, or a JSON list of paths or of objects
+    with path and optional job keys. Relative paths in a manifest file are
+    relative to the manifest.
+    """
+    if manifest.is_dir():
+        return [
+            {"path": path, "job": None}
+            for path in sorted(manifest.rglob("*"))
+            if path.is_file()
+            and not any(
+                part.startswith(".") for part in path.relative_to(manifest).parts
+            )
+        ]
 
-    return job
+    if manifest.suffix.lower() == ".csv":
+        with open(manifest, newline="") as fh:
+            rows: list = list(csv.DictReader(fh))
+    elif manifest.suffix.lower() == ".json":
+        with open(manifest) as fh:
+            rows = json.load(fh)
+    else:
+        raise SpeechToTextException(f"Unsupported manifest {manifest}")
 
+    entries = []
+    for row in rows:
+        if isinstance(row, str):
+            row = {"path": row}
+        path = Path(row["path"])
+        if not path.is_absolute():
+            path = manifest.parent / path
+        entries.append({"path": path, "job": row.get("job") or None})
 
-def upload_results(job: dict) -> dict:
+    return entries
+
+
+def group_media(entries: list[dict], files_per_job: int) -> dict[str, list[Path]]:
     """
-    Upload the Whisper output to S3, and put the job file there too. The job
-    file will have the output key added to it, which will contain a list of
-    bucket path names for the results.
+    Returns the media paths for each job ID, in the order of the manifest.
     """
-    bucket = get_bucket()
+    jobs: dict[str, list[Path]] = {}
+    ungrouped = []
+    for entry in entries:
+        if entry["job"]:
+            jobs.setdefault(entry["job"], []).append(entry["path"])
+        else:
+            ungrouped.append(entry["path"])
 
-    job["output"] = []
-    output_dir = get_output_dir(job)
-    for path in output_dir.iterdir():
-        # ignore non output files
-        if path.suffix not in [".vtt", ".srt", ".json", ".txt", ".tsv"]:
-            continue
+    for start in range(0, len(ungrouped), files_per_job):
+        jobs[str(uuid.uuid4())] = ungrouped[start : start + files_per_job]
 
-        key = f"{job['id']}/output/{path.name}"
-        logging.info(f"wrote whisper result to s3://{bucket.name}/{key}")
-        bucket.upload_file(str(path), key)
-        job["output"].append(key)
+    check_media_names(jobs)
 
-    bucket.put_object(Key=f"{job['id']}/job.json", Body=json.dumps(job, indent=2))
+    return jobs
 
-    # the files have landed in s3 so the local copies can be deleted so they
-    # don't accumulate in the docker container over time
-    logging.info(f"deleting local files for job: {output_dir}")
-    shutil.rmtree(output_dir)
 
-    return job
+def pack_media(
+    entries: list[dict], estimates: dict[Path, float], target_minutes: float
+) -> dict[str, list[Path]]:
+    """
+    Returns the media paths for each job ID. Media that is given a job in the
+    manifest stays in that job, and the rest is packed into jobs that are
+    estimated to take at most target_minutes, taking the longest files first
+    and putting each in the first job it fits in. The media in each job is
+    ordered longest first.
+    """
+    capacity = target_minutes * 60 - estimate_overhead()
 
+    jobs: dict[str, list[Path]] = {}
+    ungrouped = []
+    for entry in entries:
+        if entry["job"]:
+            jobs.setdefault(entry["job"], []).append(entry["path"])
+        else:
+            ungrouped.append(entry["path"])
 
-def finish_job(job: dict) -> dict:
-    queue = get_done_queue()
-    logging.info(f"sending message to done queue: {job}")
-    queue.send_message(MessageBody=json.dumps(job))
+    packed: dict[str, float] = {}
+    for path in sorted(ungrouped, key=lambda path: -estimates[path]):
+        job_id = next(
+            (
+                job_id
+                for job_id, seconds in packed.items()
+                if seconds + estimates[path] <= capacity
+            ),
+            None,
+        )
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+            jobs[job_id] = []
+            packed[job_id] = 0
+        jobs[job_id].append(path)
+        packed[job_id] += estimates[path]
 
-    return job
+    for paths in jobs.values():
+        paths.sort(key=lambda path: -estimates[path])
 
+    check_media_names(jobs)
 
-def get_s3() -> S3ServiceResource:
-    return boto3.resource("s3", **get_session())
+    return jobs
 
 
-def get_session() -> dict:
-    # This would be a lot easier if boto3 read AWS_ROLE_ARN like it does other
-    # environment variables:
-    #
-    # see: https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use_switch-role-api.html
-    session = {}
+def check_media_names(jobs: dict[str, list[Path]]) -> None:
+    # media is stored under its file name in the job's prefix
+    for job_id, paths in jobs.items():
+        if len({path.name for path in paths}) < len(paths):
+            raise SpeechToTextException(f"Job {job_id} has media with the same name")
 
-    role = os.environ.get("AWS_ROLE_ARN")
 
-    if role:
-        sts_client = boto3.client("sts")
-        response = sts_client.assume_role(
-            RoleArn=role, RoleSessionName="speech-to-text"
-        )
-        session = {
-            "aws_access_key_id": response["Credentials"]["AccessKeyId"],
-            "aws_secret_access_key": response["Credentials"]["SecretAccessKey"],
-            "aws_session_token": response["Credentials"]["SessionToken"],
+def plan_shards(estimates: list[float], target_minutes: float) -> int:
+    """
+    Returns the number of shards to split a job into so that each is estimated
+    to take about target_minutes.
+    """
+    seconds = estimate_overhead() + sum(estimates)
+    return max(1, math.ceil(seconds / (target_minutes * 60)))
+
+
+def estimate_media(paths: list[Path], options: dict) -> dict[Path, float]:
+    """
+    Returns the estimated number of seconds it will take to transcribe each of
+    the local media files with the options, using their durations.
+    """
+    calibration = get_calibration()
+    with ThreadPoolExecutor(max_workers=8) as inspector:
+        infos = inspector.map(inspect_media, [str(path) for path in paths])
+
+        return {
+            path: estimate_seconds(info["duration"], options, calibration)
+            for path, info in zip(paths, infos)
         }
 
-    return session
 
+# Rough real-time factors for each size of model on a GPU, which are used to
+# estimate how long transcription will take until there are calibrated ones.
+REAL_TIME_FACTORS = {
+    "tiny": 0.02,
+    "base": 0.03,
+    "small": 0.06,
+    "medium": 0.12,
+    "turbo": 0.06,
+    "large": 0.2,
+}
 
-def get_bucket() -> Bucket:
-    s3 = get_s3()
-    bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET", "")
-    return s3.Bucket(bucket_name)
 
+def estimate_keys(options: dict) -> list[str]:
+    """
+    Returns the keys for the real-time factors that apply to transcription with
+    the options, from the most to the least specific. The model (and whether it
+    is quantized) and word timestamps make the most difference to the time it
+    takes.
+    """
+    model_key = options.get("model", "large")
+    if options.get("engine", "whisper") != "whisper":
+        model_key = f"{options['engine']}/{model_key}"
+    if options.get("quantize"):
+        model_key += f":{options['quantize']}"
+
+    if options.get("word_timestamps"):
+        return [f"{model_key}+words", model_key]
 
-def get_done_queue() -> Queue:
-    sqs = boto3.resource("sqs", **get_session())
-    return sqs.get_queue_by_name(
-        QueueName=os.environ.get("SPEECH_TO_TEXT_DONE_SQS_QUEUE", "")
+    return [model_key]
+
+
+def estimate_seconds(duration: float, options: dict, calibration: dict) -> float:
+    """
+    Estimate the number of seconds it will take to transcribe media of a given
+    duration with the options, using the calibrated real-time factors if there
+    are any.
+    """
+    factors = calibration.get("real_time_factors", {})
+    for key in estimate_keys(options):
+        if key in factors:
+            return duration * factors[key]["median"]
+
+    model_name = options.get("model", "large")
+    factor = next(
+        (f for name, f in REAL_TIME_FACTORS.items() if model_name.startswith(name)),
+        REAL_TIME_FACTORS["large"],
     )
 
+    return duration * factor
 
-def report_error(message: str, job: dict | None, e: Exception) -> None:
+
+def estimate_overhead() -> float:
     """
-    Add the job to the done queue with an error.
+    The estimated number of seconds a job takes on top of transcribing its media.
     """
-    stacktrace = traceback.format_exc()
-    full_message = message + "\n" + stacktrace
-    logging.exception(full_message)
+    return get_calibration().get("overhead_seconds", 0)
 
-    # it's possible that we are reporting an error without a job
-    # we can only send a message to the DONE queue if we have a job!
-    if job is not None:
-        job["error"] = full_message
 
-        queue = get_done_queue()
-        logging.error(f"sending error message to done queue: {job}")
-        queue.send_message(MessageBody=json.dumps(job))
+# The calibration loaded from the bucket, with its key and when it was loaded.
+calibration_cache: tuple[str, float, dict] | None = None
 
-    hb_key = os.environ.get("HONEYBADGER_API_KEY", "")
-    hb_env = os.environ.get("HONEYBADGER_ENV", "stage")
-    honeybadger.configure(api_key=hb_key, environment=hb_env)
 
-    honeybadger.notify(
-        error_class="SpeechToTextError",
-        error_message="Whisper AWS process \n" + message,
-        context={"job": job, "traceback": stacktrace},
-    )
+def get_calibration() -> dict:
+    """
+    Returns the calibration that was saved to SPEECH_TO_TEXT_CALIBRATION_KEY in
+    the bucket by calibrate, or an empty one if it isn't set. In worker mode it
+    is loaded again every hour.
+    """
+    global calibration_cache
 
-    raise e
+    key = os.environ.get("SPEECH_TO_TEXT_CALIBRATION_KEY")
+    if not key:
+        return {}
 
+    if (
+        calibration_cache is None
+        or calibration_cache[0] != key
+        or time.monotonic() - calibration_cache[1] > 3600
+    ):
+        response = get_object(key)
+        calibration = json.loads(response["Body"].read()) if response else {}
+        calibration_cache = (key, time.monotonic(), calibration)
 
-def check_env() -> None:
-    names = ["SPEECH_TO_TEXT_S3_BUCKET", "SPEECH_TO_TEXT_DONE_SQS_QUEUE"]
-    for name in names:
-        if os.environ.get(name) is None:
-            sys.exit(f"{name} is not defined in the environment")
+    return calibration_cache[2]
 
 
-def now() -> str:
-    return datetime.datetime.now(datetime.UTC).isoformat()
+def calibrate(max_jobs: int = 1000) -> dict:
+    """
+    Work out the real-time factors and overhead for estimating how long jobs
+    will take from the logs of the most recent jobs in the bucket, and save
+    them to SPEECH_TO_TEXT_CALIBRATION_KEY. The median of each is used so that
+    the odd slow job doesn't throw the estimates off.
+    """
+    global calibration_cache
 
+    s3 = get_client("s3")
+    bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET", "")
 
-def get_output_dir(job) -> Path:
-    return Path(job["id"])
+    job_files = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket_name):
+        for obj in page.get("Contents", []):
+            if re.fullmatch(r"[^/]+/job\.json", obj["Key"]):
+                job_files.append(obj)
+    job_files.sort(key=lambda obj: obj["LastModified"])
+    job_files = job_files[-max_jobs:]
+
+    factors: dict[str, list[float]] = {}
+    overheads = []
+    for obj in job_files:
+        response = get_object(obj["Key"])
+        if response is None:
+            continue
+        log = json.loads(response["Body"].read()).get("log", {})
 
+        for run in log.get("runs", []):
+            runtime = run.get("runtime", {})
+            if "actual" not in runtime or runtime["duration"] <= 0:
+                continue
+            for key in estimate_keys(run["transcribe"]):
+                factors.setdefault(key, []).append(
+                    runtime["actual"] / runtime["duration"]
+                )
+
+        if "runtime" in log:
+            overheads.append(log["runtime"]["overhead"])
+
+    calibration = {
+        "updated": now(),
+        "jobs": len(job_files),
+        "real_time_factors": {
+            key: {"median": round(statistics.median(values), 4), "count": len(values)}
+            for key, values in sorted(factors.items())
+        },
+        "overhead_seconds": round(statistics.median(overheads), 3) if overheads else 0,
+    }
+
+    key = os.environ.get("SPEECH_TO_TEXT_CALIBRATION_KEY", "calibration.json")
+    retry(get_bucket().put_object, Key=key, Body=json.dumps(calibration, indent=2))
+    calibration_cache = None
+    print(json.dumps(calibration, indent=2))
+
+    return calibration
+
+
+def upload_media(media_path: Path, key: str) -> bool:
+    """
+    Upload a media file to the bucket unless the object is already there with
+    the same size and ETag. Returns whether the file was uploaded.
+    """
+    bucket = get_bucket()
+    config = get_transfer_config()
 
-def inspect_media(path) -> dict:
     try:
-        output = subprocess.check_output(
-            ["ffprobe", "-show_format", "-print_format", "json", "-v", "quiet", path]
-        )
-        result = json.loads(output)
-        return {
-            "duration": float(result["format"]["duration"]),
-            "format": result["format"]["format_name"],
-            "size": int(result["format"]["size"]),
-        }
-    except subprocess.CalledProcessError:
-        raise SpeechToTextException(f"Invalid media file {path}")
+        head = retry(get_client("s3").head_object, Bucket=bucket.name, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        head = None
 
+    if (
+        head is not None
+        and head["ContentLength"] == media_path.stat().st_size
+        and head["ETag"].strip('"') == s3_etag(media_path, config)
+    ):
+        logging.info(f"s3://{bucket.name}/{key} is already uploaded")
+        return False
 
-def load_whisper_model(model_name) -> whisper.model.Whisper:
-    if torch.cuda.is_available():
-        device = "cuda"
-    else:
-        device = "cpu"
+    logging.info(f"uploading {media_path} to s3://{bucket.name}/{key}")
+    retry(bucket.upload_file, str(media_path), key, Config=config)
 
-    logging.info(f"loading {model_name} Whisper model for {device}")
+    return True
 
-    return whisper.load_model(model_name, download_root="whisper_models", device=device)
 
+def s3_etag(path: Path, config: TransferConfig) -> str:
+    """
+    Returns the ETag S3 would give the file if it was uploaded with the
+    transfer config: the MD5 of the file, or for a multipart upload the MD5 of
+    the parts' MD5s followed by the number of parts.
+    """
+    with open(path, "rb") as fh:
+        if path.stat().st_size < config.multipart_threshold:
+            return hashlib.md5(fh.read(), usedforsecurity=False).hexdigest()
 
-# the functions below are for initiating a speech-to-text job
-# this functionality is here mostly for testing but the idea is that
-# you would upload files to s3 and initiate the batch job using
-# an AWS client library
+        digests = []
+        while chunk := fh.read(config.multipart_chunksize):
+            digests.append(hashlib.md5(chunk, usedforsecurity=False).digest())
 
+    digest = hashlib.md5(b"".join(digests), usedforsecurity=False).hexdigest()
+    return f"{digest}-{len(digests)}"
 
-def create(media_path: Path):
+
+def submit_job(job: dict, shards: int = 1) -> list[str]:
     """
-    Create a job for a given media file by placing the media file in S3 and then
-    creating a batch job which can be picked up to perform transcription using
-    boilerplate options.
+    Submit a job to AWS Batch, and return the Batch job IDs.
+
+    When shards is more than one the job is submitted as an array job of that
+    many children, which each transcribe and upload their share of the media
+    (see get_shard). A second job that depends on the array job combines their
+    results into a single job once they have all finished (see aggregate).
     """
-    job_id = str(uuid.uuid4())
+    batch = get_client("batch")
+    job_queue = os.environ.get("SPEECH_TO_TEXT_BATCH_JOB_QUEUE")
+    job_definition = os.environ.get("SPEECH_TO_TEXT_BATCH_JOB_DEFINITION")
 
-    add_media(media_path, job_id)
+    shards = min(shards, len(job["media"]))
+    if shards <= 1:
+        result = retry(
+            batch.submit_job,
+            jobName=job["id"],
+            jobQueue=job_queue,
+            jobDefinition=job_definition,
+            parameters={"job": str(json.dumps(job))},
+        )
+        logging.info(f"started batch job: {json.dumps(result)}")
+        return [result["jobId"]]
 
-    batch = boto3.client("batch", **get_session())
+    job = {**job, "shards": shards}
+    job_json = json.dumps(job)
 
-    job = {
-        "id": job_id,
-        "media": [{"name": f"{job_id}/{Path(media_path).name}"}],
-        "options": {
-            "model": "large",
-            "word_timestamps": True,
-            "condition_on_previous_text": False,
-            "writer": {"max_line_width": 42, "max_line_count": 1},
-        },
-    }
+    result = retry(
+        batch.submit_job,
+        jobName=job["id"],
+        jobQueue=job_queue,
+        jobDefinition=job_definition,
+        arrayProperties={"size": shards},
+        parameters={"job": job_json},
+    )
+    logging.info(f"started batch array job: {json.dumps(result)}")
 
-    result = batch.submit_job(
-        jobName=job_id,
-        jobQueue=os.environ.get("SPEECH_TO_TEXT_BATCH_JOB_QUEUE"),
-        jobDefinition=os.environ.get("SPEECH_TO_TEXT_BATCH_JOB_DEFINITION"),
-        parameters={"job": str(json.dumps(job))},
+    aggregate_result = retry(
+        batch.submit_job,
+        jobName=f"{job['id']}-aggregate",
+        jobQueue=job_queue,
+        jobDefinition=job_definition,
+        dependsOn=[{"jobId": result["jobId"]}],
+        parameters={"job": job_json},
+        containerOverrides={"command": ["--aggregate", "--job", job_json]},
     )
+    logging.info(f"started batch aggregate job: {json.dumps(aggregate_result)}")
+
+    return [result["jobId"], aggregate_result["jobId"]]
+
+
+def get_shard(job: dict) -> dict:
+    """
+    Returns the part of a sharded job that this child of the Batch array job
+    should transcribe. The media is dealt out to the shards in turn, so when it
+    is ordered longest first (see create) the shards take about as long as each
+    other.
+    """
+    index = os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX")
+    if index is None:
+        raise SpeechToTextException("Sharded jobs must be run as a Batch array job")
+
+    return {
+        **job,
+        "shard": int(index),
+        "media": job["media"][int(index) :: job["shards"]],
+    }
+
+
+def aggregate(job: dict) -> None:
+    """
+    Combine the job files uploaded by the shards of a job into the job's
+    job.json, and send it to the done queue in the same form as an unsharded
+    job.
+    """
+    try:
+        logging.info(f"aggregating {job['shards']} shards for job {job['id']}")
+        keys = [f"{job['id']}/shards/{index}.json" for index in range(job["shards"])]
+
+        shards = []
+        for key in keys:
+            response = get_object(key)
+            if response is None:
+                raise SpeechToTextException(f"Missing results for shard {key}")
+            shards.append(json.loads(response["Body"].read()))
+
+        # the shards that failed saved their errors rather than sending them
+        errors = [
+            f"Shard {index} failed: {shard['error']}"
+            for index, shard in enumerate(shards)
+            if "error" in shard
+        ]
+        if errors:
+            raise SpeechToTextException("\n".join(errors))
+
+        # put everything back in the order of the job's media
+        position = {media["name"]: i for i, media in enumerate(job["media"])}
+        stems = {Path(name).stem: i for name, i in position.items()}
+
+        def in_order(items: list, media_name: Callable) -> list:
+            return sorted(items, key=lambda item: position[media_name(item)])
+
+        job = {k: v for k, v in job.items() if k != "shards"}
+        job["finished"] = max(shard["finished"] for shard in shards)
+        job["output"] = sorted(
+            [key for shard in shards for key in shard["output"]],
+            key=lambda key: stems[Path(key).stem],
+        )
+        job["log"] = {
+            **shards[0]["log"],
+            "runs": in_order(
+                [run for shard in shards for run in shard["log"]["runs"]],
+                lambda run: run["media"],
+            ),
+        }
+        # the shards run at the same time
+        if all("runtime" in shard["log"] for shard in shards):
+            job["log"]["runtime"] = {
+                name: max(shard["log"]["runtime"][name] for shard in shards)
+                for name in ["estimated", "actual", "overhead"]
+            }
+        job["metrics"] = combine_metrics([shard["metrics"] for shard in shards])
+        job["metrics"]["media"] = in_order(
+            job["metrics"]["media"], lambda media: media["media"]
+        )
+
+        bucket = get_bucket()
+        retry(
+            bucket.put_object,
+            Key=f"{job['id']}/job.json",
+            Body=json.dumps(job, indent=2),
+        )
+        for key in keys:
+            retry(bucket.Object(key).delete)
+
+        finish_job(job)
+        logging.info(f"finished job {job}")
+    except SpeechToTextException as e:
+        report_error(f"Unexpected error while aggregating job: {e}", job, e)
+    except Exception as e:
+        report_error(f"Unexpected error: {e}", job, e)
+
+
+def combine_metrics(shard_metrics: list[dict]) -> dict:
+    """
+    Add up the metrics for the shards of a job. The peak memory is the largest
+    peak of any shard, since they ran on separate machines.
+    """
+    stages: dict[str, dict] = {}
+    for metrics in shard_metrics:
+        for stage, stage_metrics in metrics.get("stages", {}).items():
+            combined = stages.setdefault(stage, {})
+            for name, value in stage_metrics.items():
+                if name.startswith("max_"):
+                    combined[name] = max(combined.get(name, 0), value)
+                else:
+                    combined[name] = round(combined.get(name, 0) + value, 3)
 
-    logging.info(f"started batch job: {json.dumps(result)}")
+    return {
+        "stages": stages,
+        "media": [
+            media for metrics in shard_metrics for media in metrics.get("media", [])
+        ],
+    }
 
 
 def add_media(media_path, job_id) -> str:
@@ -347,6 +4290,104 @@ def get_done() -> None:
         print(f"downloaded {local_file}")
 
 
+def drain_done(
+    max_jobs: int | None = None, wait: int = 20, visibility: int = 900
+) -> dict:
+    """
+    Receive messages from the done SQS queue until it is empty, or max_jobs
+    have been drained. Each job's JSON is saved, and its output files are
+    downloaded, to a directory named after the job.
+
+    Messages are long polled ten at a time and the files for all of them are
+    downloaded concurrently with a shared S3 client. The messages are then
+    deleted in a batch, apart from those whose files couldn't be downloaded.
+    Those are counted as failed and left to be received again, but they are
+    hidden for visibility seconds so that this drain doesn't receive them
+    again before the queue is empty. Prints and returns the throughput.
+    """
+    queue = get_done_queue()
+    s3 = get_client("s3")
+    bucket_name = os.environ.get("SPEECH_TO_TEXT_S3_BUCKET", "")
+    config = get_transfer_config()
+    concurrency = int(os.environ.get("SPEECH_TO_TEXT_DOWNLOAD_CONCURRENCY", "4"))
+
+    def download(key: str, path: Path) -> int:
+        retry(s3.download_file, bucket_name, key, str(path), Config=config)
+        return path.stat().st_size
+
+    summary: dict = {"jobs": 0, "errors": 0, "failed": 0, "files": 0, "bytes": 0}
+    started = time.monotonic()
+
+    # messages that couldn't be downloaded, in case they reappear in the queue
+    # after all
+    failed: set[str] = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as downloader:
+        while max_jobs is None or summary["jobs"] < max_jobs:
+            count = 10 if max_jobs is None else min(10, max_jobs - summary["jobs"])
+            received = queue.receive_messages(
+                MaxNumberOfMessages=count,
+                WaitTimeSeconds=wait,
+                VisibilityTimeout=visibility,
+            )
+            if len(received) == 0:
+                break
+            messages = [m for m in received if m.message_id not in failed]
+
+            downloads = []
+            for message in messages:
+                job = json.loads(message.body)
+                job_dir = Path(job["id"])
+                job_dir.mkdir(parents=True, exist_ok=True)
+                (job_dir / "job.json").write_text(json.dumps(job, indent=2))
+                downloads.append(
+                    [
+                        downloader.submit(download, key, job_dir / Path(key).name)
+                        for key in job.get("output", [])
+                    ]
+                )
+
+            # only delete the messages for jobs whose files have all landed
+            entries: list[DeleteMessageBatchRequestEntryTypeDef] = []
+            for message, futures in zip(messages, downloads):
+                try:
+                    sizes = [future.result() for future in futures]
+                except Exception as e:
+                    failed.add(message.message_id)
+                    summary["failed"] += 1
+                    logging.error(f"unable to download output for {message.body}: {e}")
+                    continue
+
+                summary["jobs"] += 1
+                summary["files"] += len(sizes)
+                summary["bytes"] += sum(sizes)
+                if "error" in json.loads(message.body):
+                    summary["errors"] += 1
+                entries.append(
+                    {
+                        "Id": str(len(entries)),
+                        "ReceiptHandle": message.receipt_handle,
+                    }
+                )
+
+            if entries:
+                response = queue.delete_messages(Entries=entries)
+                for failure in response.get("Failed", []):
+                    logging.error(f"unable to delete message: {failure}")
+
+            logging.info(
+                f"received {summary['jobs']} done jobs ({summary['failed']} failed)"
+            )
+
+    seconds = time.monotonic() - started
+    summary["seconds"] = round(seconds, 3)
+    summary["jobs_per_second"] = round(summary["jobs"] / max(seconds, 0.001), 2)
+    summary["mb_per_second"] = round(summary["bytes"] / 2**20 / max(seconds, 0.001), 2)
+    print(json.dumps(summary, indent=2))
+
+    return summary
+
+
 class SpeechToTextException(Exception):
     pass
 
@@ -360,23 +4401,88 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%dT%H:%M:%S%z",
     )
 
-    check_env()
-
     parser = argparse.ArgumentParser(prog="speech_to_text")
     parser.add_argument(
         "-j",
         "--job",
         help="A JSON string for a job, or path to a JSON file",
     )
-    parser.add_argument("-c", "--create", help="Create the Job in the Batch queue")
+    parser.add_argument(
+        "-c",
+        "--create",
+        help="Create a Job for media files (or Jobs for a directory or CSV/JSON manifest)",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--files-per-job",
+        help="The number of media files to put in each Job created from a manifest",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--target-minutes",
+        help="Plan created Jobs so that each is estimated to take this long",
+        type=float,
+    )
+    parser.add_argument(
+        "--calibrate",
+        help="Calibrate the runtime estimates from the logs of recent jobs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rate",
+        help="The maximum number of Jobs to submit per second from a manifest",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--shards",
+        help="Split the created Job into this many Batch array job children",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--aggregate",
+        help="Combine the results of a sharded Job's children",
+        action="store_true",
+    )
     parser.add_argument(
         "-d",
         "--done",
         help="Look for completed jobs and download the results",
         action="store_true",
     )
+    parser.add_argument(
+        "--drain",
+        help="With --done, download the results for every job in the done queue",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--worker",
+        help="Process jobs from the todo SQS queue until it is empty",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-jobs",
+        help="The maximum number of jobs to process in worker or drain mode",
+        type=int,
+    )
+    parser.add_argument(
+        "--convert-model",
+        help="Convert a Whisper model for the SPEECH_TO_TEXT_MODEL_STORE",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        help="Delete expired transcripts from the cache",
+        action="store_true",
+    )
     args = parser.parse_args()
 
+    # models are converted when the Docker image is built, without AWS
+    if not args.convert_model:
+        check_env()
+
     # get the job either from a JSON string or file
     try:
         if args.job and Path(args.job).is_file():
@@ -388,9 +4494,37 @@ if __name__ == "__main__":
     except json.decoder.JSONDecodeError as e:
         sys.exit(f"Invalid job {e} for JSON {args.job}")
 
-    if args.create:
-        create(args.create)
+    if args.create and len(args.create) == 1 and is_manifest(Path(args.create[0])):
+        create_bulk(
+            Path(args.create[0]),
+            args.files_per_job,
+            args.shards,
+            args.rate,
+            args.target_minutes,
+        )
+    elif args.create:
+        create(args.create, args.shards, args.target_minutes)
+    elif args.calibrate:
+        if os.environ.get("SPEECH_TO_TEXT_CALIBRATION_KEY") is None:
+            sys.exit("SPEECH_TO_TEXT_CALIBRATION_KEY is not defined in the environment")
+        calibrate()
+    elif args.aggregate:
+        aggregate(job)
+    elif args.done and args.drain:
+        drain_done(max_jobs=args.max_jobs)
     elif args.done:
         get_done()
+    elif args.worker:
+        if os.environ.get("SPEECH_TO_TEXT_TODO_SQS_QUEUE") is None:
+            sys.exit("SPEECH_TO_TEXT_TODO_SQS_QUEUE is not defined in the environment")
+        worker(max_jobs=args.max_jobs)
+    elif args.convert_model:
+        if os.environ.get("SPEECH_TO_TEXT_MODEL_STORE") is None:
+            sys.exit("SPEECH_TO_TEXT_MODEL_STORE is not defined in the environment")
+        convert_model(
+            args.convert_model, Path(os.environ["SPEECH_TO_TEXT_MODEL_STORE"])
+        )
+    elif args.prune_cache:
+        prune_cache()
     else:
         main(job)
@@ -0,0 +1,61 @@
+from unittest.mock import patch
+
+import numpy
+import pytest
+import whisper
+
+from speech_to_text import SpeechToTextException, decode_media
+
+
+def test_media_info(tmp_path):
+    info, _ = decode_media("tests/data/en.wav", tmp_path)
+    assert info["duration"] == 3.22
+    assert info["format"] == "wav"
+    assert info["size"] == 618318
+
+
+def test_audio(tmp_path):
+    _, pcm_path = decode_media("tests/data/en.wav", tmp_path)
+    audio = numpy.load(pcm_path, mmap_mode="r")
+    assert audio.dtype == numpy.float32
+    assert numpy.array_equal(audio, whisper.audio.load_audio("tests/data/en.wav"))
+
+
+def test_cached(tmp_path):
+    first = decode_media("tests/data/en.wav", tmp_path)
+
+    # the second time ffmpeg isn't run
+    with patch("speech_to_text.subprocess.Popen") as popen:
+        second = decode_media("tests/data/en.wav", tmp_path)
+        popen.assert_not_called()
+
+    assert first == second
+
+
+def test_invalid_media(tmp_path):
+    with pytest.raises(SpeechToTextException):
+        decode_media("README.md", tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_stream(tmp_path):
+    def stream():
+        with open("tests/data/en.wav", "rb") as media:
+            while chunk := media.read(1000):
+                yield chunk
+
+    info, pcm_path = decode_media("job/en.wav", tmp_path / "streamed", stream)
+    assert info["format"] == "wav"
+    assert info["size"] == 618318
+    assert abs(info["duration"] - 3.22) < 0.01
+
+    _, file_pcm_path = decode_media("tests/data/en.wav", tmp_path / "file")
+    assert numpy.array_equal(numpy.load(pcm_path), numpy.load(file_pcm_path))
+
+
+def test_invalid_stream(tmp_path):
+    def stream():
+        yield b"this is not media"
+
+    with pytest.raises(SpeechToTextException):
+        decode_media("job/en.wav", tmp_path, stream)
@@ -0,0 +1,145 @@
+import pytest
+import report
+
+VTT = """WEBVTT
+
+STYLE
+::cue {
+  color: yellow;
+}
+
+NOTE This transcript was
+made by hand
+
+1
+00:00.000 --> 00:02.000 align:start position:0%
+Hello there,
+General Kenobi.
+
+intro-2
+00:02.500 --> 01:00:04.000
+You are a bold one!
+"""
+
+
+def cues(*texts: str, start: float = 0.0) -> list[dict]:
+    return [
+        {"start": start + i * 2, "end": start + i * 2 + 2, "text": text}
+        for i, text in enumerate(texts)
+    ]
+
+
+def test_seconds():
+    assert report.seconds("00:02.500") == 2.5
+    assert report.seconds("01:02.500") == 62.5
+    assert report.seconds("1:01:02.500") == 3662.5
+
+
+def test_read_cues(tmp_path):
+    vtt_file = tmp_path / "test.vtt"
+    vtt_file.write_text(VTT)
+
+    # identifiers, NOTE and STYLE blocks aren't part of the text
+    assert report.read_cues(vtt_file) == [
+        {"start": 0.0, "end": 2.0, "text": "Hello there, General Kenobi."},
+        {"start": 2.5, "end": 3604.0, "text": "You are a bold one!"},
+    ]
+
+
+def test_tokenize():
+    words, times, cue_indexes = report.tokenize(cues("Hello, World!", "It's me"))
+    assert words == ["hello", "world", "it's", "me"]
+    assert times == [0.0, 1.0, 2.0, 3.0]
+    assert cue_indexes == [0, 0, 1, 1]
+
+
+@pytest.mark.parametrize(
+    "words1,words2,counts",
+    [
+        ("a b c", "a b c", (0, 0, 0)),
+        ("a b c", "a x c", (1, 0, 0)),
+        ("a b c", "a c", (0, 1, 0)),
+        ("a b c", "a b x c", (0, 0, 1)),
+        ("a b c d e", "x b d e y z", (1, 1, 2)),
+        ("", "a b", (0, 0, 2)),
+        ("a b", "", (0, 2, 0)),
+    ],
+)
+def test_edit_counts(words1, words2, counts):
+    assert report.edit_counts(words1.split(), words2.split()) == counts
+
+
+def test_align():
+    # anchored runs of words are matched, and the gaps between them aligned
+    words1 = [
+        "one",
+        "two",
+        "three",
+        "four",
+        "five",
+        "six",
+        "seven",
+        "eight",
+        "nine",
+        "ten",
+    ]
+    words2 = [
+        "one",
+        "too",
+        "three",
+        "four",
+        "five",
+        "six",
+        "seven",
+        "ate",
+        "nine",
+        "ten",
+        "eleven",
+    ]
+    assert report.align(words1, words2) == [
+        (0, 0),
+        (1, 1),
+        (2, 2),
+        (3, 3),
+        (4, 4),
+        (5, 5),
+        (6, 6),
+        (7, 7),
+        (8, 8),
+        (9, 9),
+        (None, 10),
+    ]
+
+
+def test_compare_vtt():
+    reference = cues("the quick brown fox", "jumps over the lazy dog")
+    transcript = cues("the quick brown box", "jumps over lazy dog today", start=0.5)
+
+    comparison = report.compare_vtt(reference, transcript)
+
+    assert comparison["words"] == 9
+    assert comparison["substitutions"] == 1
+    assert comparison["deletions"] == 1
+    assert comparison["insertions"] == 1
+    assert comparison["wer"] == pytest.approx(3 / 9)
+    assert [(r["reference"], r["transcript"]) for r in comparison["regions"]] == [
+        (["fox"], ["box"]),
+        (["the"], []),
+        ([], ["today"]),
+    ]
+
+    # the transcript's cues start half a second late, but the words of the
+    # second cue are spread differently
+    assert comparison["mean_drift"] == pytest.approx((0.5 + 0.3) / 2)
+    assert comparison["max_drift"] == pytest.approx(0.5)
+
+
+def test_compare_unrelated_vtt():
+    # every word is wrong, but no more than that
+    reference = cues("a b c d e f g h")
+    transcript = cues("s t u v w x y z")
+
+    comparison = report.compare_vtt(reference, transcript)
+
+    assert comparison["substitutions"] == 8
+    assert comparison["wer"] == 1.0
@@ -1,18 +1,29 @@
 import json
 import os
+import random
 import re
+import shutil
+import threading
+import time
 import uuid
+import wave
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import boto3
 import moto
+import numpy
 import pytest
+import torch
+import whisper
+from botocore.exceptions import ClientError
 
 import speech_to_text
 
 BUCKET = "bucket"
 DONE_QUEUE = "done"
+TODO_QUEUE = "todo"
 
 
 @pytest.fixture
@@ -24,6 +35,7 @@ def aws_credentials():
     os.environ["AWS_SESSION_TOKEN"] = "testing"
     os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
     os.environ["SPEECH_TO_TEXT_DONE_SQS_QUEUE"] = DONE_QUEUE
+    os.environ["SPEECH_TO_TEXT_TODO_SQS_QUEUE"] = TODO_QUEUE
     os.environ["SPEECH_TO_TEXT_S3_BUCKET"] = BUCKET
 
 
@@ -59,6 +71,43 @@ def bucket(s3):
 @pytest.fixture
 def queues(sqs):
     sqs.create_queue(QueueName=DONE_QUEUE)
+    sqs.create_queue(QueueName=TODO_QUEUE)
+
+
+@pytest.fixture
+def batch(aws_credentials, monkeypatch):
+    # the Batch jobs aren't run, they are just recorded
+    with moto.mock_aws(config={"batch": {"use_docker": False}}):
+        iam = boto3.client("iam")
+        role = iam.create_role(RoleName="batch", AssumeRolePolicyDocument="{}")
+        client = boto3.client("batch")
+        env = client.create_compute_environment(
+            computeEnvironmentName="speech-to-text",
+            type="UNMANAGED",
+            state="ENABLED",
+            serviceRole=role["Role"]["Arn"],
+        )
+        client.create_job_queue(
+            jobQueueName="speech-to-text",
+            state="ENABLED",
+            priority=1,
+            computeEnvironmentOrder=[
+                {"order": 1, "computeEnvironment": env["computeEnvironmentArn"]}
+            ],
+        )
+        client.register_job_definition(
+            jobDefinitionName="speech-to-text",
+            type="container",
+            containerProperties={
+                "image": "speech-to-text",
+                "vcpus": 1,
+                "memory": 1024,
+                "command": ["--job", "Ref::job"],
+            },
+        )
+        monkeypatch.setenv("SPEECH_TO_TEXT_BATCH_JOB_QUEUE", "speech-to-text")
+        monkeypatch.setenv("SPEECH_TO_TEXT_BATCH_JOB_DEFINITION", "speech-to-text")
+        yield client
 
 
 # ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
@@ -99,6 +148,10 @@ def test_happy_path(bucket, queues):
     assert job["log"]["runs"][0]["transcribe"]["word_timestamps"] is True
     assert job["log"]["runs"][0]["write"]["max_line_width"] == 42
 
+    # was the upload recorded?
+    assert job["metrics"]["stages"]["upload"]["files"] == 5
+    assert job["metrics"]["stages"]["upload"]["seconds"] >= 0
+
     # is there a message in the "done" queue?
     queue = speech_to_text.get_done_queue()
     msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
@@ -202,3 +255,1894 @@ def test_honeybadger_notification(mock_honeybadger, bucket, queues, honeybadger_
     assert "Whisper AWS process" in kwargs["error_message"]
     assert "job" in kwargs["context"]
     assert "traceback" in kwargs["context"]
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_worker(bucket, queues):
+    speech_to_text.models.clear()
+
+    # put two jobs in the todo queue
+    todo_queue = speech_to_text.get_todo_queue()
+    job_ids = []
+    for _ in range(2):
+        job_id = str(uuid.uuid4())
+        speech_to_text.add_media("tests/data/en.wav", job_id)
+        job = {
+            "id": job_id,
+            "media": [{"name": f"{job_id}/en.wav"}],
+            "options": {"model": "tiny"},
+        }
+        todo_queue.send_message(MessageBody=json.dumps(job))
+        job_ids.append(job_id)
+
+    with patch(
+        "speech_to_text.load_whisper_model",
+        wraps=speech_to_text.load_whisper_model,
+    ) as load_whisper_model:
+        assert speech_to_text.worker() == 2, "processed both jobs"
+
+    # the model was only loaded once
+    load_whisper_model.assert_called_once_with("tiny")
+
+    # both jobs finished
+    done_queue = speech_to_text.get_done_queue()
+    msgs = done_queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=10)
+    assert sorted(json.loads(msg.body)["id"] for msg in msgs) == sorted(job_ids)
+    assert all("error" not in json.loads(msg.body) for msg in msgs)
+
+    # the todo queue is empty
+    assert len(todo_queue.receive_messages(MaxNumberOfMessages=1)) == 0
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_worker_errors(bucket, queues, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_VISIBILITY_TIMEOUT", "30")
+    todo_queue = speech_to_text.get_todo_queue()
+
+    # a job that fails is reported to the done queue and removed
+    job = {"id": str(uuid.uuid4()), "media": [{"name": "missing.wav"}]}
+    todo_queue.send_message(MessageBody=json.dumps(job))
+    assert speech_to_text.worker(max_jobs=1) == 1
+
+    done_queue = speech_to_text.get_done_queue()
+    msgs = done_queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    assert "error" in json.loads(msgs[0].body)
+    todo_queue.reload()
+    assert todo_queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "0"
+
+    # when the error can't be reported the job is left in the queue, hidden
+    # until its visibility timeout runs out
+    todo_queue.send_message(MessageBody=json.dumps(job))
+    failing_queue = Mock()
+    failing_queue.send_message.side_effect = ClientError(
+        {"Error": {"Code": "ServiceUnavailable", "Message": "outage"}}, "SendMessage"
+    )
+    with patch("speech_to_text.get_done_queue", return_value=failing_queue):
+        assert speech_to_text.worker(max_jobs=1) == 1
+
+    todo_queue.reload()
+    assert todo_queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "1"
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_worker_invalid_message(bucket, queues):
+    todo_queue = speech_to_text.get_todo_queue()
+
+    # a message that isn't a job is skipped, and the worker carries on
+    job = {"id": str(uuid.uuid4()), "media": [{"name": "missing.wav"}]}
+    todo_queue.send_message(MessageBody="{not json")
+    todo_queue.send_message(MessageBody=json.dumps(job))
+    assert speech_to_text.worker(max_jobs=1) == 1
+
+    done_queue = speech_to_text.get_done_queue()
+    msgs = done_queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    assert json.loads(msgs[0].body)["id"] == job["id"]
+
+    # the invalid message is left for the dead letter queue
+    todo_queue.reload()
+    assert todo_queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "1"
+
+
+def test_model_cache_eviction(monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_MODEL_CACHE_SIZE", "2")
+    speech_to_text.models.clear()
+
+    with patch("speech_to_text.load_whisper_model", side_effect=lambda name: name):
+        speech_to_text.get_whisper_model("tiny")
+        speech_to_text.get_whisper_model("base")
+        speech_to_text.get_whisper_model("tiny")
+        speech_to_text.get_whisper_model("small")
+
+    # base was the least recently used so it was evicted
+    assert list(speech_to_text.models.keys()) == ["tiny", "small"]
+
+    # models are evicted when memory is low
+    with (
+        patch("speech_to_text.load_whisper_model", side_effect=lambda name: name),
+        patch("speech_to_text.available_memory", return_value=0),
+    ):
+        speech_to_text.get_whisper_model("medium")
+
+    assert list(speech_to_text.models.keys()) == ["medium"]
+
+    speech_to_text.models.clear()
+
+
+decode_media = speech_to_text.decode_media
+
+
+def slow_decode_media(path, scratch_dir):
+    # make the first file land last
+    if Path(path).name == "a.wav":
+        time.sleep(1)
+    return decode_media(path, scratch_dir)
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_iter_media(bucket):
+    job_id = str(uuid.uuid4())
+    for name in ["a.wav", "b.wav"]:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/a.wav"}, {"name": f"{job_id}/b.wav"}],
+    }
+
+    with patch("speech_to_text.decode_media", side_effect=slow_decode_media):
+        landed = list(speech_to_text.iter_media(job))
+
+    # files are yielded as soon as they are downloaded
+    assert landed == [(1, job["media"][1]), (0, job["media"][0])]
+    assert Path(f"{job_id}/a.wav").is_file()
+    assert Path(f"{job_id}/b.wav").is_file()
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_iter_media_unused(bucket, queues, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_DOWNLOAD_CONCURRENCY", "2")
+    job_id = str(uuid.uuid4())
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/{i}.wav"} for i in range(6)],
+        "options": {"model": "tiny", "engine": "nope"},
+    }
+    threads = set(threading.enumerate())
+
+    # the job fails before the media is asked for, so none is downloaded
+    with (
+        patch("speech_to_text.fetch_media") as fetch_media,
+        pytest.raises(speech_to_text.SpeechToTextException),
+    ):
+        speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    assert "error" in json.loads(msgs[0].body)
+    assert fetch_media.call_count == 0
+    assert not [
+        thread
+        for thread in set(threading.enumerate()) - threads
+        if thread.name.startswith("ThreadPoolExecutor")
+    ]
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_multiple_media_order(bucket, queues):
+    job_id = str(uuid.uuid4())
+    for name in ["a.wav", "b.wav"]:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/a.wav"}, {"name": f"{job_id}/b.wav"}],
+        "options": {"model": "tiny"},
+    }
+
+    with patch("speech_to_text.decode_media", side_effect=slow_decode_media):
+        speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    # the log and output follow the order of the media in the job
+    assert [run["media"] for run in job["log"]["runs"]] == [
+        f"{job_id}/a.wav",
+        f"{job_id}/b.wav",
+    ]
+    assert job["output"] == [
+        f"{job_id}/output/{stem}.{ext}"
+        for stem in ["a", "b"]
+        for ext in ["vtt", "srt", "json", "txt", "tsv"]
+    ]
+
+
+@patch("speech_to_text.time.sleep")
+def test_retry(sleep):
+    error = ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+
+    # succeeds after failing twice
+    func = Mock(side_effect=[error, error, "ok"])
+    assert speech_to_text.retry(func, "a", b="c") == "ok"
+    assert func.call_count == 3
+    func.assert_called_with("a", b="c")
+    assert sleep.call_count == 2
+
+    # gives up after the last attempt
+    func = Mock(side_effect=error)
+    with pytest.raises(ClientError):
+        speech_to_text.retry(func)
+    assert func.call_count == 5
+
+    # other errors are not retried
+    func = Mock(side_effect=ValueError("bad"))
+    with pytest.raises(ValueError):
+        speech_to_text.retry(func)
+    assert func.call_count == 1
+
+
+def test_session_cache(sts, monkeypatch):
+    monkeypatch.setenv("AWS_ROLE_ARN", "arn:aws:iam::123456789012:role/speech-to-text")
+    monkeypatch.setattr(speech_to_text, "aws_session", None)
+    monkeypatch.setattr(speech_to_text, "aws_session_expires", None)
+    monkeypatch.setattr(speech_to_text, "aws_clients", {})
+
+    with patch("speech_to_text.boto3.client", wraps=boto3.client) as client:
+        session = speech_to_text.get_session()
+        assert speech_to_text.get_session() is session, "session is reused"
+        assert speech_to_text.get_client("s3") is speech_to_text.get_client("s3")
+        assert client.call_count == 1, "role was only assumed once"
+
+        # the credentials are refreshed shortly before they expire
+        speech_to_text.aws_session_expires = speech_to_text.now_dt()
+        assert speech_to_text.get_session() is not session
+        assert client.call_count == 2, "role was assumed again"
+        assert speech_to_text.get_session().get_credentials().access_key != (
+            session.get_credentials().access_key
+        )
+
+
+def test_chunk_boundaries():
+    silences = [(9.0, 11.0), (18.0, 18.5), (25.0, 26.0)]
+
+    # cut in the middle of the silence closest to each chunk's target length
+    assert speech_to_text.chunk_boundaries(30, silences, 10) == [
+        (0.0, 10.0),
+        (10.0, 18.25),
+        (18.25, 25.5),
+        (25.5, 30),
+    ]
+
+    # cut at the target length when there are no silences
+    assert speech_to_text.chunk_boundaries(25, [], 10) == [
+        (0.0, 10),
+        (10, 20),
+        (20, 25),
+    ]
+
+    # short media is a single chunk
+    assert speech_to_text.chunk_boundaries(5, silences, 10) == [(0.0, 5)]
+
+
+def test_stitch_results():
+    results = [
+        {
+            "text": " Hello.",
+            "language": "en",
+            "segments": [
+                {
+                    "id": 0,
+                    "seek": 0,
+                    "start": 0.0,
+                    "end": 1.0,
+                    "text": " Hello.",
+                    "words": [{"word": " Hello.", "start": 0.1, "end": 0.9}],
+                }
+            ],
+        },
+        {
+            "text": " World.",
+            "language": "en",
+            "segments": [
+                {
+                    "id": 0,
+                    "seek": 0,
+                    "start": 0.5,
+                    "end": 1.5,
+                    "text": " World.",
+                    "words": [{"word": " World.", "start": 0.6, "end": 1.4}],
+                }
+            ],
+        },
+    ]
+
+    result = speech_to_text.stitch_results(results, [0.0, 10.0])
+
+    assert result["text"] == " Hello. World."
+    assert result["language"] == "en"
+    assert [s["id"] for s in result["segments"]] == [0, 1]
+    assert result["segments"][1]["start"] == 10.5
+    assert result["segments"][1]["end"] == 11.5
+    assert result["segments"][1]["seek"] == 1000
+    assert result["segments"][1]["words"][0]["start"] == 10.6
+    assert result["segments"][1]["words"][0]["end"] == 11.4
+
+
+def test_find_silences():
+    # en.wav has some silence at the end
+    job = {"id": str(uuid.uuid4())}
+    audio = speech_to_text.load_audio(job, "tests/data/en.wav")
+    silences = speech_to_text.find_silences(audio, min_silence=0.2)
+    assert len(silences) > 0
+    for start, end in silences:
+        assert 0 <= start < end <= 3.3
+
+    shutil.rmtree(job["id"])
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_chunking(bucket, queues):
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {
+            "model": "tiny",
+            "chunking": {"min_duration": 0, "chunk_duration": 1, "processes": 2},
+        },
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    assert job["log"]["runs"][0]["chunks"] > 1
+    assert job["log"]["runs"][0]["transcribe"]["chunking"]["chunk_duration"] == 1
+    assert "chunking" not in job["log"]["runs"][0]["write"]
+    assert len(job["output"]) == 5
+
+
+def atom(atom_type: bytes, size: int) -> bytes:
+    return size.to_bytes(4, "big") + atom_type + b"\0" * (size - 8)
+
+
+def test_needs_seeking(bucket):
+    s3 = speech_to_text.get_client("s3")
+
+    # moov before mdat can be streamed
+    s3.put_object(
+        Bucket=BUCKET,
+        Key="fast-start.mp4",
+        Body=atom(b"ftyp", 24) + atom(b"moov", 100) + atom(b"mdat", 1000),
+    )
+    assert not speech_to_text.needs_seeking(BUCKET, "fast-start.mp4")
+
+    # moov after mdat needs seeking
+    s3.put_object(
+        Bucket=BUCKET,
+        Key="moov-at-end.mp4",
+        Body=atom(b"ftyp", 24)
+        + atom(b"free", 8)
+        + atom(b"mdat", 1000)
+        + atom(b"moov", 100),
+    )
+    assert speech_to_text.needs_seeking(BUCKET, "moov-at-end.mp4")
+
+    # other formats can always be streamed
+    assert not speech_to_text.needs_seeking(BUCKET, "audio.wav")
+
+
+def test_stream_media(bucket, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_STREAM_MEDIA", "true")
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {"id": job_id, "media": [{"name": f"{job_id}/en.wav"}]}
+
+    speech_to_text.download_media(job)
+
+    # the audio was decoded without writing the media file to disk
+    assert not Path(f"{job_id}/en.wav").exists()
+    audio = speech_to_text.load_audio(job, f"{job_id}/en.wav")
+    assert len(audio) == 51520
+
+    shutil.rmtree(job_id)
+
+
+def test_stream_media_error(bucket, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_STREAM_MEDIA", "true")
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {"id": job_id, "media": [{"name": f"{job_id}/en.wav"}]}
+
+    # the stream stops after the first chunk of the media, with an error or
+    # as though it had finished
+    s3 = speech_to_text.get_client("s3")
+    reset = True
+
+    def get_object(**kwargs):
+        response = s3.get_object(**kwargs)
+        chunks = response["Body"].iter_chunks(100_000)
+
+        def iter_chunks(chunk_size):
+            yield next(chunks)
+            if reset:
+                raise ConnectionResetError("connection reset by peer")
+
+        response["Body"] = Mock(iter_chunks=iter_chunks)
+        return response
+
+    def stream():
+        return get_object(Bucket=BUCKET, Key=f"{job_id}/en.wav")["Body"].iter_chunks(
+            1024
+        )
+
+    # decoding the part of the stream that arrived is an error
+    with pytest.raises(speech_to_text.SpeechToTextException, match="reset"):
+        speech_to_text.decode_media(f"{job_id}/en.wav", Path(job_id), stream)
+    assert list(Path(job_id).iterdir()) == []
+
+    # a stream that ends early is noticed, and the media is downloaded instead
+    reset = False
+    client = Mock(wraps=s3, get_object=get_object)
+    monkeypatch.setattr(speech_to_text, "get_client", lambda service: client)
+
+    speech_to_text.download_media(job)
+    assert Path(f"{job_id}/en.wav").exists()
+    audio = speech_to_text.load_audio(job, f"{job_id}/en.wav")
+    assert len(audio) == 51520
+
+    shutil.rmtree(job_id)
+
+
+# ignore utcnow warning until https://github.com/boto/boto3/issues/3889 is resolved
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_batch(bucket, queues):
+    job_id = str(uuid.uuid4())
+    for name in ["a.wav", "b.wav", "c.wav"]:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+
+    job = {
+        "id": job_id,
+        "media": [
+            {"name": f"{job_id}/a.wav"},
+            {"name": f"{job_id}/b.wav", "options": {"language": "fr"}},
+            {"name": f"{job_id}/c.wav"},
+        ],
+        "options": {"model": "tiny", "batch_size": 4},
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    assert len(job["output"]) == 15
+
+    # files with the same options were batched together
+    runs = job["log"]["runs"]
+    assert [run["media"] for run in runs] == [
+        f"{job_id}/a.wav",
+        f"{job_id}/b.wav",
+        f"{job_id}/c.wav",
+    ]
+    assert [run["batch"] for run in runs] == [2, 1, 2]
+    assert runs[0]["transcribe"]["batch_size"] == 4
+
+
+def test_transcribe_batch():
+    model = speech_to_text.get_whisper_model("tiny")
+    audio = whisper.audio.load_audio("tests/data/en.wav")
+    audios = [audio, audio[: len(audio) // 2]]
+    # options that only whisper.transcribe uses can be given when they're unset
+    options = {
+        "language": "en",
+        "temperature": 0.0,
+        "word_timestamps": True,
+        "hallucination_silence_threshold": None,
+    }
+    assert speech_to_text.can_batch(audio, options)
+
+    results = speech_to_text.transcribe_batch(model, audios, options)
+
+    # the results are what whisper.transcribe produces for each file
+    for audio, result in zip(audios, results):
+        expected = whisper.transcribe(model=model, audio=audio, **options)
+        assert result["text"] == expected["text"]
+        assert result["language"] == expected["language"]
+        assert [s["text"] for s in result["segments"]] == [
+            s["text"] for s in expected["segments"]
+        ]
+        assert [s["start"] for s in result["segments"]] == [
+            s["start"] for s in expected["segments"]
+        ]
+        assert [w["word"] for s in result["segments"] for w in s["words"]] == [
+            w["word"] for s in expected["segments"] for w in s["words"]
+        ]
+
+
+def test_transcribe_windows():
+    model = speech_to_text.get_whisper_model("tiny")
+    audio = whisper.audio.load_audio("tests/data/en.wav")
+    audios = [numpy.concatenate([audio] * 12), audio]
+    options = {
+        "language": "en",
+        "temperature": 0.0,
+        "hallucination_silence_threshold": None,
+    }
+    assert speech_to_text.can_batch_windows(options)
+
+    results = speech_to_text.transcribe_windows(model, audios, options)
+
+    # the results are what whisper.transcribe produces for each file, though
+    # the first one needs more than one window
+    for audio, result in zip(audios, results):
+        assert result == whisper.transcribe(model=model, audio=audio, **options)
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_language_routing(bucket, queues, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_LANGUAGE_MODEL", "tiny")
+    monkeypatch.setenv("SPEECH_TO_TEXT_ENGLISH_MODEL", "tiny.en")
+
+    job_id = str(uuid.uuid4())
+    for name in ["a.wav", "b.wav"]:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+
+    job = {
+        "id": job_id,
+        "media": [
+            {"name": f"{job_id}/a.wav"},
+            {"name": f"{job_id}/b.wav", "options": {"language": "fr"}},
+        ],
+        "options": {"model": "tiny"},
+    }
+
+    with patch("speech_to_text.language_probability", return_value=("en", 0.97)):
+        speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    runs = job["log"]["runs"]
+
+    # english was sent to the english model
+    assert runs[0]["language"] == {
+        "model": "tiny",
+        "detected": "en",
+        "probability": 0.97,
+    }
+    assert runs[0]["transcribe"]["model"] == "tiny.en"
+    assert runs[0]["transcribe"]["language"] == "en"
+
+    # media with a language option isn't identified or routed
+    assert "language" not in runs[1]
+    assert runs[1]["transcribe"]["model"] == "tiny"
+
+
+def test_route_model(monkeypatch):
+    language = {"model": "tiny", "detected": "en", "probability": 0.8}
+    assert speech_to_text.route_model("large", language) == "large"
+
+    monkeypatch.setenv("SPEECH_TO_TEXT_ENGLISH_MODEL", "medium.en")
+    assert speech_to_text.route_model("large", language) == "large"
+
+    monkeypatch.setenv("SPEECH_TO_TEXT_ENGLISH_MIN_PROBABILITY", "0.75")
+    assert speech_to_text.route_model("large", language) == "medium.en"
+    assert (
+        speech_to_text.route_model("large", {**language, "detected": "fr"}) == "large"
+    )
+
+
+def test_find_speech():
+    # audio made of 30ms frames
+    frame = whisper.audio.SAMPLE_RATE * 3 // 100
+    tone = 0.1 * numpy.sin(numpy.arange(40 * frame) * 2 * numpy.pi / 16)
+    silence = numpy.zeros(100 * frame)
+    click = tone[:frame]
+    audio = numpy.concatenate([silence, tone, silence, click, silence, tone, silence])
+
+    speech = speech_to_text.find_speech(audio, padding=0)
+    assert speech == [(100 * frame, 140 * frame), (341 * frame, 381 * frame)]
+
+    # short silences are kept
+    speech = speech_to_text.find_speech(audio, padding=0, min_silence=10)
+    assert speech == [(100 * frame, 381 * frame)]
+
+    speech = speech_to_text.find_speech(audio, padding=0.3)
+    assert speech == [(90 * frame, 150 * frame), (331 * frame, 391 * frame)]
+
+    assert speech_to_text.find_speech(silence) == []
+
+
+def test_restore_timestamps():
+    rate = whisper.audio.SAMPLE_RATE
+    speech = [(3 * rate, 4 * rate), (10 * rate, 12 * rate)]
+    result = {
+        "text": " hello world",
+        "language": "en",
+        "segments": [
+            {
+                "id": 0,
+                "seek": 0,
+                "start": 0.0,
+                "end": 1.0,
+                "text": " hello",
+                "words": [{"word": " hello", "start": 0.5, "end": 1.0}],
+            },
+            {
+                "id": 1,
+                "seek": 0,
+                "start": 1.0,
+                "end": 2.5,
+                "text": " world",
+                "words": [{"word": " world", "start": 1.2, "end": 2.5}],
+            },
+        ],
+    }
+
+    result = speech_to_text.restore_timestamps(result, speech)
+
+    assert [(s["start"], s["end"]) for s in result["segments"]] == [
+        (3.0, 4.0),
+        (10.0, 11.5),
+    ]
+    assert [(s["seek"]) for s in result["segments"]] == [300, 900]
+    assert [(w["start"], w["end"]) for s in result["segments"] for w in s["words"]] == [
+        (3.5, 4.0),
+        (10.2, 11.5),
+    ]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_skip_silence(bucket, queues):
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {"model": "tiny", "skip_silence": {"min_silence": 0.5}},
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    run = job["log"]["runs"][0]
+    assert run["skipped"] == 0
+    assert run["transcribe"]["skip_silence"]["min_silence"] == 0.5
+    assert run["transcribe"]["skip_silence"]["threshold"] == -45
+    assert len(job["output"]) == 5
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_skip_silence_timestamps(bucket, queues, tmp_path):
+    # the speech has several seconds of silence either side of it
+    speech = whisper.audio.load_audio("tests/data/en.wav")
+    silence = numpy.zeros(6 * whisper.audio.SAMPLE_RATE, dtype=numpy.float32)
+    audio = numpy.concatenate([silence, speech, silence])
+    path = tmp_path / "padded.wav"
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(whisper.audio.SAMPLE_RATE)
+        wav.writeframes((audio * 32767).astype(numpy.int16).tobytes())
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media(path, job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/padded.wav"}],
+        "options": {"model": "tiny", "skip_silence": True},
+    }
+
+    def transcribe(audio, model, **options):
+        # a segment and words spanning all of the audio that was kept
+        end = round(len(audio) / whisper.audio.SAMPLE_RATE, 2)
+        return {
+            "text": " hello world",
+            "language": "en",
+            "segments": [
+                {
+                    "id": 0,
+                    "seek": 0,
+                    "start": 0.0,
+                    "end": end,
+                    "text": " hello world",
+                    "words": [
+                        {"word": " hello", "start": 0.0, "end": 1.0},
+                        {"word": " world", "start": 1.0, "end": end},
+                    ],
+                }
+            ],
+        }
+
+    with patch("whisper.transcribe", side_effect=transcribe) as transcribed:
+        speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    assert job["log"]["runs"][0]["skipped"] > 0.5
+
+    # whisper was only given the speech
+    kept = speech_to_text.find_speech(audio)
+    assert len(kept) == 1
+    start, end = (position / whisper.audio.SAMPLE_RATE for position in kept[0])
+    assert start > 5 and end < len(audio) / whisper.audio.SAMPLE_RATE - 5
+    assert len(transcribed.call_args.kwargs["audio"]) == kept[0][1] - kept[0][0]
+
+    # but the timestamps are on the original timeline
+    output = speech_to_text.get_object(f"{job_id}/output/padded.json")
+    segment = json.loads(output["Body"].read())["segments"][0]
+    assert segment["start"] == pytest.approx(start, abs=0.01)
+    assert segment["end"] == pytest.approx(end, abs=0.01)
+    assert [(word["start"], word["end"]) for word in segment["words"]] == [
+        pytest.approx((start, start + 1), abs=0.01),
+        pytest.approx((start + 1, end), abs=0.01),
+    ]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_transcript_cache(bucket, queues, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_CACHE_PREFIX", "cache")
+
+    def run_job(job_id):
+        speech_to_text.add_media("tests/data/en.wav", job_id)
+        job = {
+            "id": job_id,
+            "media": [{"name": f"{job_id}/en.wav"}],
+            "options": {"model": "tiny"},
+        }
+        with (
+            patch("whisper.transcribe", wraps=whisper.transcribe) as transcribe,
+            patch(
+                "speech_to_text.fetch_media", wraps=speech_to_text.fetch_media
+            ) as fetch_media,
+            patch(
+                "speech_to_text.identify_language",
+                wraps=speech_to_text.identify_language,
+            ) as identify_language,
+            patch(
+                "speech_to_text.get_object", wraps=speech_to_text.get_object
+            ) as get_object,
+        ):
+            speech_to_text.main(job)
+
+        queue = speech_to_text.get_done_queue()
+        msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+        msgs[0].delete()
+        calls = {
+            "transcribe": transcribe.call_count,
+            "fetch_media": fetch_media.call_count,
+            "identify_language": identify_language.call_count,
+            "cache_gets": sum(
+                call.args[0].startswith("cache/") for call in get_object.call_args_list
+            ),
+        }
+        return json.loads(msgs[0].body), calls
+
+    job_id = str(uuid.uuid4())
+    job, calls = run_job(f"{job_id}-v1")
+    assert "error" not in job
+    run = job["log"]["runs"][0]
+    assert run["cache"] == "miss"
+    assert calls == {
+        "transcribe": 1,
+        "fetch_media": 1,
+        "identify_language": 1,
+        "cache_gets": 1,
+    }
+
+    # the language isn't logged when there is no model to identify it
+    assert "language" not in run
+
+    # the same media in a new version uses the cached transcript, without
+    # decoding the media or identifying its language
+    job, calls = run_job(f"{job_id}-v2")
+    assert "error" not in job
+    cached_run = job["log"]["runs"][0]
+    assert cached_run["cache"] == "hit"
+    assert cached_run["transcribe"] == run["transcribe"]
+    # the cached transcript is only fetched once
+    assert calls == {
+        "transcribe": 0,
+        "fetch_media": 0,
+        "identify_language": 0,
+        "cache_gets": 1,
+    }
+    assert len(job["output"]) == 5
+
+    # routing media to another model by its language changes the key, unless
+    # the language was given
+    def cache_key(options):
+        return speech_to_text.transcript_cache_key(f"{job_id}-v2/en.wav", options)
+
+    routed_options = {"model": "tiny"}
+    english_options = {"model": "tiny", "language": "en"}
+    keys = [cache_key(routed_options), cache_key(english_options)]
+    monkeypatch.setenv("SPEECH_TO_TEXT_ENGLISH_MODEL", "tiny.en")
+    assert cache_key(routed_options) != keys[0]
+    assert cache_key(english_options) == keys[1]
+    monkeypatch.delenv("SPEECH_TO_TEXT_ENGLISH_MODEL")
+
+    # expired transcripts are deleted
+    assert speech_to_text.prune_cache() == 0
+    monkeypatch.setenv("SPEECH_TO_TEXT_CACHE_TTL_DAYS", "0")
+    assert speech_to_text.prune_cache() == 1
+    job, calls = run_job(f"{job_id}-v3")
+    assert job["log"]["runs"][0]["cache"] == "miss"
+    assert calls["transcribe"] == 1
+
+
+def fake_transcribe(audio, model, clip_timestamps, **options):
+    """
+    Stands in for whisper.transcribe, returning a 10 second segment for every
+    10 seconds of the clip. The text of each segment is the time it starts in
+    the test audio, whose samples are their time in seconds.
+    """
+    start, end = clip_timestamps
+    offset = float(audio[0])
+    segments = []
+    t = start
+    while t < end:
+        segments.append(
+            {
+                "id": len(segments),
+                "seek": round(start * 100),
+                "start": t,
+                "end": min(end, t + 10),
+                "text": f" {offset + t:.0f}",
+            }
+        )
+        t += 10
+    return {
+        "text": "".join(s["text"] for s in segments),
+        "segments": segments,
+        "language": options.get("language") or "en",
+    }
+
+
+def test_checkpoint(bucket):
+    audio = (
+        numpy.arange(100 * whisper.audio.SAMPLE_RATE, dtype=numpy.float32)
+        / whisper.audio.SAMPLE_RATE
+    )
+    key = "job/checkpoints/0.json"
+    options = {"model": "tiny"}
+
+    with patch("whisper.transcribe", side_effect=fake_transcribe):
+        expected, resumed = speech_to_text.transcribe_checkpointed(
+            None, audio, {}, 1, key, options
+        )
+    assert resumed == 0
+    assert [s["start"] for s in expected["segments"]] == [
+        0,
+        10,
+        20,
+        30,
+        40,
+        50,
+        60,
+        70,
+        80,
+        90,
+    ]
+    assert speech_to_text.get_checkpoint(key) is None
+
+    # interrupt the transcription after two spans
+    transcribe = Mock(
+        side_effect=[
+            fake_transcribe(audio, None, [0, 30]),
+            fake_transcribe(
+                audio[20 * whisper.audio.SAMPLE_RATE :], None, [0, 30], language="en"
+            ),
+            RuntimeError("spot instance interrupted"),
+        ]
+    )
+    with patch("whisper.transcribe", transcribe), pytest.raises(RuntimeError):
+        speech_to_text.transcribe_checkpointed(None, audio, {}, 1, key, options)
+    assert speech_to_text.get_checkpoint(key)["seek"] == 40
+
+    # the previous text is used as the prompt when resuming
+    with patch("whisper.transcribe", side_effect=fake_transcribe) as transcribe:
+        result, resumed = speech_to_text.transcribe_checkpointed(
+            None, audio, {}, 1, key, options
+        )
+    assert resumed == 40
+
+    # whisper is only given the audio for the span
+    assert transcribe.call_args_list[0].kwargs["clip_timestamps"] == [0, 30]
+    assert (
+        len(transcribe.call_args_list[0].kwargs["audio"])
+        == 30 * whisper.audio.SAMPLE_RATE + whisper.audio.N_FFT
+    )
+    assert transcribe.call_args_list[0].kwargs["initial_prompt"] == " 0 10 20 30"
+    assert result == expected
+    assert speech_to_text.get_checkpoint(key) is None
+
+    # a checkpoint for different options isn't used
+    speech_to_text.put_checkpoint(
+        key,
+        {"options": {"model": "base"}, "seek": 40, "language": "en", "segments": []},
+    )
+    with patch("whisper.transcribe", side_effect=fake_transcribe):
+        result, resumed = speech_to_text.transcribe_checkpointed(
+            None, audio, {}, 1, key, options
+        )
+    assert resumed == 0
+    assert result == expected
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_metrics(bucket, queues, monkeypatch, tmp_path):
+    metrics_file = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("SPEECH_TO_TEXT_METRICS_FILE", str(metrics_file))
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {"model": "tiny"},
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    stages = job["metrics"]["stages"]
+    for stage in ["download", "decode", "model_load", "transcribe", "write", "upload"]:
+        assert stages[stage]["calls"] >= 1
+        assert stages[stage]["seconds"] >= 0
+
+    # the peak memory is only measured for the stages on the main thread
+    for stage in ["model_load", "transcribe", "write", "upload"]:
+        assert stages[stage]["max_rss_mb"] > 0
+    for stage in ["download", "decode"]:
+        assert "max_rss_mb" not in stages[stage]
+    assert stages["write"]["calls"] == 1
+
+    assert len(job["metrics"]["media"]) == 1
+    media = job["metrics"]["media"][0]
+    assert media["media"] == f"{job_id}/en.wav"
+    assert media["duration"] == 3.22
+    assert media["real_time_factor"] == pytest.approx(
+        media["seconds"] / media["duration"], abs=0.001
+    )
+
+    # the exported metrics include sending the job to the done queue
+    exported = json.loads(metrics_file.read_text())
+    assert exported["id"] == job_id
+    assert exported["stages"]["send"]["calls"] == 1
+
+    # prometheus metrics are totals for the process
+    prom_file = tmp_path / "speech_to_text.prom"
+    monkeypatch.setenv("SPEECH_TO_TEXT_METRICS_FILE", str(prom_file))
+    speech_to_text.metrics_totals.clear()
+    speech_to_text.export_metrics(job)
+    speech_to_text.export_metrics(job)
+    prom = prom_file.read_text()
+    assert "speech_to_text_jobs_total 2" in prom
+    assert 'speech_to_text_stage_seconds_total{stage="transcribe"}' in prom
+    assert "speech_to_text_media_seconds_total 6.44\n" in prom
+
+
+def test_measure_gpu(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    reset = Mock()
+    monkeypatch.setattr(torch.cuda, "reset_peak_memory_stats", reset)
+    monkeypatch.setattr(torch.cuda, "max_memory_allocated", lambda: 2**30)
+
+    job: dict = {}
+
+    def download():
+        with speech_to_text.measure(job, "download"):
+            pass
+
+    # the peaks aren't reset (or reported) for stages in background threads
+    with ThreadPoolExecutor() as executor:
+        executor.submit(download).result()
+    reset.assert_not_called()
+    assert "max_gpu_mb" not in job["metrics"]["stages"]["download"]
+    assert "max_rss_mb" not in job["metrics"]["stages"]["download"]
+
+    with speech_to_text.measure(job, "transcribe"):
+        pass
+    reset.assert_called_once()
+    assert job["metrics"]["stages"]["transcribe"]["max_gpu_mb"] == 1024
+
+
+def test_measure_rss():
+    job: dict = {}
+
+    # memory used in one stage isn't counted as the peak of the next
+    with speech_to_text.measure(job, "transcribe"):
+        memory = numpy.ones(2**28, dtype=numpy.uint8)
+        del memory
+    with speech_to_text.measure(job, "write"):
+        pass
+
+    stages = job["metrics"]["stages"]
+    assert stages["transcribe"]["max_rss_mb"] > stages["write"]["max_rss_mb"] + 200
+
+
+def make_result(words: bool) -> dict:
+    """
+    Make a Whisper result with segments of words, some with long pauses between
+    them.
+    """
+    rng = random.Random(1)
+    segments: list[dict] = []
+    t = 0.0
+    for i in range(30):
+        segment_words: list[dict] = []
+        for _ in range(rng.randint(0, 12)):
+            t += rng.choice([0.1, 0.25, 0.5, 4.0])
+            word = " " + "".join(rng.choices("abcdefghij\t", k=rng.randint(1, 9)))
+            segment_words.append(
+                {"word": word, "start": round(t, 2), "end": round(t + 0.2, 2)}
+            )
+            t += 0.2
+        segment = {
+            "id": i,
+            "seek": 0,
+            "start": segment_words[0]["start"] if segment_words else round(t, 2),
+            "end": round(t, 2),
+            "text": "".join(w["word"] for w in segment_words) + " -->",
+        }
+        if words:
+            segment["words"] = segment_words
+        segments.append(segment)
+
+    return {
+        "text": "".join(s["text"] for s in segments),
+        "segments": segments,
+        "language": "en",
+    }
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"max_line_width": 42},
+        {"max_line_width": 30, "max_line_count": 2},
+        {"max_line_width": 30, "max_line_count": 1, "highlight_words": True},
+        {"max_words_per_line": 3},
+        {"highlight_words": True},
+    ],
+)
+@pytest.mark.parametrize("words", [True, False])
+def test_write_transcript(tmp_path, options, words):
+    result = make_result(words)
+
+    expected_dir = tmp_path / "expected"
+    expected_dir.mkdir()
+    whisper.utils.get_writer("all", str(expected_dir))(
+        result, "media/test.mp4", options
+    )
+
+    speech_to_text.write_transcript(tmp_path, "media/test.mp4", result, options)
+
+    for ext in ["vtt", "srt", "txt", "tsv", "json"]:
+        assert (tmp_path / f"test.{ext}").read_text() == (
+            expected_dir / f"test.{ext}"
+        ).read_text(), ext
+
+
+def test_summarize():
+    result = make_result(words=True)
+    summary = speech_to_text.summarize(result)
+    assert summary.startswith("language=en segments=30 end=")
+    assert len(summary) < 200
+
+
+def test_model_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_MODEL_STORE", str(tmp_path))
+    expected = whisper.load_model("tiny", download_root="whisper_models")
+
+    model = speech_to_text.load_whisper_model("tiny")
+
+    # the model was converted and saved with a checksum
+    assert (tmp_path / "tiny.pt").is_file()
+    manifest = json.loads((tmp_path / "tiny.json").read_text())
+    assert manifest["sha256"] == speech_to_text.file_sha256(tmp_path / "tiny.pt")
+
+    # the loaded model is the same as the one whisper loads
+    assert model.dims == expected.dims
+    for name, tensor in expected.state_dict().items():
+        assert torch.equal(model.state_dict()[name], tensor), name
+    expected_buffers = dict(expected.named_buffers())
+    for name, tensor in model.named_buffers():
+        assert tensor.device.type != "meta", name
+        assert torch.equal(tensor.to_dense(), expected_buffers[name].to_dense()), name
+
+    mel = torch.randn(1, expected.dims.n_mels, 3000)
+    tokens = torch.tensor([[50258, 50259, 50359]])
+    with torch.no_grad():
+        assert torch.allclose(model(mel, tokens), expected(mel, tokens))
+
+    # the model is converted again if it doesn't match its checksum
+    (tmp_path / "tiny.pt").write_bytes(b"corrupt")
+    with patch(
+        "speech_to_text.convert_model", wraps=speech_to_text.convert_model
+    ) as convert_model:
+        speech_to_text.load_whisper_model("tiny")
+        convert_model.assert_called_once()
+
+
+def test_quantize(tmp_path, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_MODEL_STORE", str(tmp_path))
+    expected = whisper.load_model("tiny", download_root="whisper_models")
+
+    model = speech_to_text.load_whisper_model("tiny:int8")
+
+    # the linear layers were quantized
+    quantized = torch.ao.nn.quantized.dynamic.Linear
+    assert isinstance(model.decoder.blocks[0].mlp[0], quantized)
+    assert isinstance(model.encoder.blocks[0].attn.query, quantized)
+    assert not any(isinstance(m, whisper.model.Linear) for m in model.modules())
+
+    # the output is close to the unquantized model's
+    mel = torch.randn(1, expected.dims.n_mels, 3000)
+    with torch.no_grad():
+        features = model.encoder(mel)
+        expected_features = expected.encoder(mel)
+    assert (
+        torch.nn.functional.cosine_similarity(
+            features.flatten(), expected_features.flatten(), dim=0
+        )
+        > 0.9
+    )
+
+    # the quantized model was saved and is loaded again from disk
+    assert (tmp_path / "tiny-int8.pt").is_file()
+    with patch("speech_to_text.quantize_model") as quantize_model:
+        model = speech_to_text.load_whisper_model("tiny:int8")
+        quantize_model.assert_not_called()
+    assert isinstance(model.decoder.blocks[0].mlp[0], quantized)
+
+    # it's quantized again if it has changed, or was made by another torch
+    manifest_path = tmp_path / "tiny-int8.json"
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["torch"] == torch.__version__
+    assert manifest["whisper"] == whisper.version.__version__
+    with open(tmp_path / "tiny-int8.pt", "ab") as fh:
+        fh.write(b"tampered")
+    with patch(
+        "speech_to_text.quantize_model", wraps=speech_to_text.quantize_model
+    ) as quantize_model:
+        speech_to_text.load_quantized_model("tiny", "int8")
+        assert quantize_model.call_count == 1
+        manifest_path.write_text(json.dumps({**manifest, "torch": "1.0"}))
+        speech_to_text.load_quantized_model("tiny", "int8")
+        assert quantize_model.call_count == 2
+        speech_to_text.load_quantized_model("tiny", "int8")
+        assert quantize_model.call_count == 2
+
+    audio = whisper.audio.load_audio("tests/data/en.wav")
+    result = whisper.transcribe(model=model, audio=audio, language="en")
+    assert result["language"] == "en"
+
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.get_quantize_option("int4")
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_quantize_job(bucket, queues, monkeypatch, tmp_path):
+    monkeypatch.setenv("SPEECH_TO_TEXT_MODEL_STORE", str(tmp_path))
+    speech_to_text.models.clear()
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {"model": "tiny", "quantize": True},
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    assert job["log"]["runs"][0]["transcribe"]["model"] == "tiny"
+    assert job["log"]["runs"][0]["transcribe"]["quantize"] == "int8"
+    assert list(speech_to_text.models.keys()) == ["tiny:int8"]
+    assert len(job["output"]) == 5
+
+    speech_to_text.models.clear()
+
+
+def test_incomplete_engine():
+    class NoTranscribeEngine(speech_to_text.Engine):
+        name = "incomplete"
+
+        def version(self) -> str:
+            return "1"
+
+        def load(self, model_name: str) -> str:
+            return model_name
+
+    # an engine that doesn't implement the interface can't be made
+    with pytest.raises(TypeError):
+        NoTranscribeEngine()  # type: ignore[abstract]
+
+
+def test_fake_engine():
+    engine = speech_to_text.get_engine("fake")
+    audio = numpy.zeros(12 * whisper.audio.SAMPLE_RATE, dtype=numpy.float32)
+
+    result = engine.transcribe(engine.load("tiny"), audio, {"word_timestamps": True})
+    assert [(s["start"], s["end"]) for s in result["segments"]] == [
+        (0, 5),
+        (5, 10),
+        (10, 12),
+    ]
+    assert result["segments"][0]["text"] == " tiny 0.0 to 5.0"
+    assert [w["word"] for w in result["segments"][0]["words"]] == [
+        " tiny",
+        " 0.0",
+        " to",
+        " 5.0",
+    ]
+    assert result["language"] == "en"
+
+    result = engine.transcribe("tiny", audio, {"clip_timestamps": "3,6,11"})
+    assert [(s["start"], s["end"]) for s in result["segments"]] == [
+        (3, 6),
+        (11, 12),
+    ]
+
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.get_engine("nope")
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_engine(bucket, queues):
+    speech_to_text.models.clear()
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {
+            "model": "tiny",
+            "engine": "fake",
+            "writer": {"max_line_width": 42},
+            "chunking": {"min_duration": 0, "chunk_duration": 1, "processes": 2},
+        },
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    assert job["log"]["name"] == "fake"
+    assert job["log"]["version"] == "1"
+    assert job["log"]["runs"][0]["transcribe"]["engine"] == "fake"
+    assert job["log"]["runs"][0]["chunks"] > 1
+
+    # on a CPU the chunks are transcribed by the replicas, so the model is only
+    # loaded here when there is a GPU
+    models = ["fake/tiny"] if torch.cuda.is_available() else []
+    assert list(speech_to_text.models.keys()) == models
+    assert len(job["output"]) == 5
+
+    vtt = speech_to_text.get_bucket().Object(f"{job_id}/output/en.vtt")
+    assert "tiny 0.0 to" in vtt.get()["Body"].read().decode("utf-8")
+
+    # unknown engines are reported as errors
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {"model": "tiny", "engine": "nope"},
+    }
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.main(job)
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    assert "Unknown engine nope" in json.loads(msgs[0].body)["error"]
+
+    speech_to_text.models.clear()
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_replicas(bucket, queues, tmp_path):
+    speech_to_text.models.clear()
+
+    job_id = str(uuid.uuid4())
+    durations = {"a.wav": 5, "b.wav": 20, "c.wav": 10}
+    for name, duration in durations.items():
+        path = tmp_path / name
+        with wave.open(str(path), "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(whisper.audio.SAMPLE_RATE)
+            wav.writeframes(b"\0\0" * duration * whisper.audio.SAMPLE_RATE)
+        speech_to_text.add_media(path, job_id)
+
+    def run_job():
+        job = {
+            "id": job_id,
+            "media": [{"name": f"{job_id}/{name}"} for name in durations],
+            "options": {"model": "tiny", "engine": "fake", "replicas": 2},
+        }
+        speech_to_text.main(job)
+
+        queue = speech_to_text.get_done_queue()
+        msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+        msgs[0].delete()
+        return json.loads(msgs[0].body)
+
+    job = run_job()
+
+    assert "error" not in job
+    # the results are in the same order as the media
+    assert [run["media"] for run in job["log"]["runs"]] == [
+        f"{job_id}/{name}" for name in durations
+    ]
+    assert [run["transcribe"]["replicas"] for run in job["log"]["runs"]] == [2] * 3
+    assert [m["duration"] for m in job["metrics"]["media"]] == [5, 20, 10]
+    assert len(job["output"]) == 15
+    assert speech_to_text.replica_pool_key == ("fake", "tiny", 2)
+    # the model is only loaded by the replicas
+    assert len(speech_to_text.models) == 0
+
+    txt = speech_to_text.get_bucket().Object(f"{job_id}/output/b.txt")
+    assert txt.get()["Body"].read().decode("utf-8").splitlines() == [
+        "tiny 0.0 to 5.0",
+        "tiny 5.0 to 10.0",
+        "tiny 10.0 to 15.0",
+        "tiny 15.0 to 20.0",
+    ]
+
+    # the longest media is transcribed first
+    submitted = []
+
+    def submit(func, audio, options):
+        submitted.append(len(audio) // whisper.audio.SAMPLE_RATE)
+        future = Future()
+        future.set_result(func(audio, options))
+        return future
+
+    pool = Mock(submit=submit)
+    with (
+        patch("speech_to_text.get_replica_pool", return_value=pool),
+        patch("speech_to_text.replica_engine", speech_to_text.get_engine("fake")),
+        patch("speech_to_text.replica_model", "tiny"),
+    ):
+        job = run_job()
+
+    assert "error" not in job
+    assert submitted == [20, 10, 5]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_fan_out(bucket, queues, batch, monkeypatch):
+    job_id = str(uuid.uuid4())
+    names = ["a.wav", "b.wav", "c.wav"]
+    for name in names:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+    media = [f"{job_id}/{name}" for name in names]
+    job = {
+        "id": job_id,
+        "media": [{"name": name} for name in media],
+        "options": {"model": "tiny", "engine": "fake"},
+    }
+
+    # jobs that aren't sharded are submitted as they are
+    (single_id,) = speech_to_text.submit_job(job)
+    single = batch.describe_jobs(jobs=[single_id])["jobs"][0]
+    assert json.loads(single["parameters"]["job"]) == job
+    assert "arrayProperties" not in single
+
+    array_id, aggregate_id = speech_to_text.submit_job(job, shards=2)
+    array_job, aggregate_job = batch.describe_jobs(jobs=[array_id, aggregate_id])[
+        "jobs"
+    ]
+    assert array_job["arrayProperties"]["size"] == 2
+    assert aggregate_job["dependsOn"] == [{"jobId": array_id}]
+
+    # run the children of the array job
+    for index in range(2):
+        monkeypatch.setenv("AWS_BATCH_JOB_ARRAY_INDEX", str(index))
+        speech_to_text.main(json.loads(array_job["parameters"]["job"]))
+    monkeypatch.delenv("AWS_BATCH_JOB_ARRAY_INDEX")
+
+    # the shards don't send done messages
+    queue = speech_to_text.get_done_queue()
+    assert queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=0) == []
+
+    command = aggregate_job["container"]["command"]
+    assert command[:2] == ["--aggregate", "--job"]
+    speech_to_text.aggregate(json.loads(command[2]))
+
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    done = json.loads(msgs[0].body)
+
+    assert "error" not in done
+    assert "shards" not in done
+    assert done["output"] == [
+        f"{job_id}/output/{Path(name).stem}.{ext}"
+        for name in names
+        for ext in ["vtt", "srt", "json", "txt", "tsv"]
+    ]
+    assert done["log"]["name"] == "fake"
+    assert [run["media"] for run in done["log"]["runs"]] == media
+    assert [m["media"] for m in done["metrics"]["media"]] == media
+    assert done["metrics"]["stages"]["transcribe"]["calls"] == 3
+
+    job_file = speech_to_text.get_bucket().Object(f"{job_id}/job.json").get()
+    assert json.loads(job_file["Body"].read()) == done
+    assert speech_to_text.get_object(f"{job_id}/shards/0.json") is None
+
+    # a shard that didn't finish is reported
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.aggregate(json.loads(command[2]))
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    assert "Missing results for shard" in json.loads(msgs[0].body)["error"]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_fan_out_errors(bucket, queues, monkeypatch):
+    job_id = str(uuid.uuid4())
+    speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/a.wav")
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/a.wav"}, {"name": f"{job_id}/missing.wav"}],
+        "options": {"model": "tiny", "engine": "fake"},
+        "shards": 2,
+    }
+
+    # the second shard fails, but saves its error instead of raising it
+    for index in range(2):
+        monkeypatch.setenv("AWS_BATCH_JOB_ARRAY_INDEX", str(index))
+        speech_to_text.main(job)
+    monkeypatch.delenv("AWS_BATCH_JOB_ARRAY_INDEX")
+
+    queue = speech_to_text.get_done_queue()
+    assert queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=0) == []
+    shard = speech_to_text.get_object(f"{job_id}/shards/1.json")
+    assert "error" in json.loads(shard["Body"].read())
+
+    # aggregate sends a single error message for the job
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.aggregate(job)
+
+    msgs = queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=10)
+    assert len(msgs) == 1
+    done = json.loads(msgs[0].body)
+    assert done["id"] == job_id
+    assert "Shard 1 failed" in done["error"]
+    assert "Shard 0" not in done["error"]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_worker_shard(bucket, queues, monkeypatch):
+    job_id = str(uuid.uuid4())
+    for name in ["a.wav", "b.wav", "c.wav"]:
+        speech_to_text.get_bucket().upload_file("tests/data/en.wav", f"{job_id}/{name}")
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/{name}"} for name in ["a.wav", "b.wav", "c.wav"]],
+        "options": {"model": "tiny", "engine": "fake"},
+        "shards": 2,
+    }
+    speech_to_text.get_todo_queue().send_message(MessageBody=json.dumps(job))
+
+    monkeypatch.setenv("AWS_BATCH_JOB_ARRAY_INDEX", "1")
+    assert speech_to_text.worker(max_jobs=1) == 1
+
+    # the worker only transcribed the media for its shard
+    shard = json.loads(
+        speech_to_text.get_object(f"{job_id}/shards/1.json")["Body"].read()
+    )
+    assert "error" not in shard
+    assert [run["media"] for run in shard["log"]["runs"]] == [f"{job_id}/b.wav"]
+    assert shard["output"] == [
+        f"{job_id}/output/b.{ext}" for ext in ["vtt", "srt", "json", "txt", "tsv"]
+    ]
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_create_bulk(bucket, batch, tmp_path, capsys):
+    media_dir = tmp_path / "media"
+    (media_dir / "sub").mkdir(parents=True)
+    for name in ["a.wav", "b.wav", "c.wav", "sub/d.wav"]:
+        shutil.copy("tests/data/en.wav", media_dir / name)
+    (media_dir / ".DS_Store").write_text("")
+
+    entries = speech_to_text.read_manifest(media_dir)
+    assert [entry["path"].name for entry in entries] == [
+        "a.wav",
+        "b.wav",
+        "c.wav",
+        "d.wav",
+    ]
+
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "path,job\n"
+        "media/a.wav,\n"
+        "media/b.wav,druid-1\n"
+        "media/c.wav,\n"
+        "media/sub/d.wav,druid-1\n"
+    )
+
+    # b.wav is already in the bucket
+    speech_to_text.get_bucket().upload_file(str(media_dir / "b.wav"), "druid-1/b.wav")
+
+    summary = speech_to_text.create_bulk(manifest, files_per_job=2, rate=100)
+
+    assert summary["uploaded"] == 3
+    assert summary["skipped"] == 1
+    assert [job["media"] for job in summary["jobs"]] == [2, 2]
+    assert summary["jobs"][0]["id"] == "druid-1"
+    assert json.loads(capsys.readouterr().out) == summary
+
+    batch_jobs = batch.describe_jobs(
+        jobs=[job["batch_jobs"][0] for job in summary["jobs"]]
+    )["jobs"]
+    jobs = [json.loads(batch_job["parameters"]["job"]) for batch_job in batch_jobs]
+    assert [job["media"] for job in jobs] == [
+        [{"name": "druid-1/b.wav"}, {"name": "druid-1/d.wav"}],
+        [
+            {"name": f"{jobs[1]['id']}/a.wav"},
+            {"name": f"{jobs[1]['id']}/c.wav"},
+        ],
+    ]
+    for job in jobs:
+        for media in job["media"]:
+            assert speech_to_text.get_object(media["name"]) is not None
+
+    # media with the same name can't be in the same job
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(["media/a.wav", "media/a.wav"]))
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.create_bulk(manifest, files_per_job=2)
+
+
+def test_s3_etag(bucket, tmp_path, monkeypatch):
+    monkeypatch.setenv("SPEECH_TO_TEXT_MULTIPART_THRESHOLD_MB", "5")
+    monkeypatch.setenv("SPEECH_TO_TEXT_MULTIPART_CHUNKSIZE_MB", "5")
+    config = speech_to_text.get_transfer_config()
+
+    for size in [1000, 12 * 1024 * 1024]:
+        path = tmp_path / f"{size}.bin"
+        path.write_bytes(random.randbytes(size))
+        speech_to_text.get_bucket().upload_file(str(path), path.name, Config=config)
+
+        head = speech_to_text.get_client("s3").head_object(Bucket=BUCKET, Key=path.name)
+        assert head["ETag"].strip('"') == speech_to_text.s3_etag(path, config)
+        assert not speech_to_text.upload_media(path, path.name)
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_drain_done(bucket, queues, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    queue = speech_to_text.get_done_queue()
+
+    job_ids = [str(uuid.uuid4()) for _ in range(13)]
+    for job_id in job_ids:
+        output = [f"{job_id}/output/en.{ext}" for ext in ["vtt", "txt"]]
+        for key in output:
+            speech_to_text.get_bucket().put_object(Key=key, Body=b"WEBVTT")
+        queue.send_message(MessageBody=json.dumps({"id": job_id, "output": output}))
+    error_id = str(uuid.uuid4())
+    queue.send_message(MessageBody=json.dumps({"id": error_id, "error": "oops"}))
+
+    summary = speech_to_text.drain_done(max_jobs=12, wait=1)
+    assert summary["jobs"] == 12
+    assert json.loads(capsys.readouterr().out) == summary
+
+    summary = speech_to_text.drain_done(wait=1)
+    assert summary["jobs"] == 2
+    assert summary["errors"] == 1
+    assert summary["files"] == 2
+    assert summary["bytes"] == 12
+
+    for job_id in job_ids:
+        assert (tmp_path / job_id / "en.vtt").read_text() == "WEBVTT"
+        assert json.loads((tmp_path / job_id / "job.json").read_text())["id"] == job_id
+    assert "error" in json.loads((tmp_path / error_id / "job.json").read_text())
+
+    # messages are only deleted once their files have been downloaded, and a
+    # failure doesn't count towards the jobs or stop the drain
+    queue.send_message(
+        MessageBody=json.dumps({"id": "missing", "output": ["missing/output/en.vtt"]})
+    )
+    for job_id in job_ids[:3]:
+        queue.send_message(MessageBody=json.dumps({"id": job_id}))
+    monkeypatch.setenv("SPEECH_TO_TEXT_RETRY_ATTEMPTS", "1")
+    summary = speech_to_text.drain_done(max_jobs=1, wait=1)
+    assert summary["jobs"] == 1
+    assert summary["failed"] == 1
+
+    # the failed message stays hidden while the rest of the queue is drained
+    summary = speech_to_text.drain_done(wait=1)
+    assert summary["jobs"] == 2
+    assert summary["failed"] == 0
+    queue.reload()
+    assert queue.attributes["ApproximateNumberOfMessages"] == "0"
+    assert queue.attributes["ApproximateNumberOfMessagesNotVisible"] == "1"
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_runtime_estimate(bucket, queues, monkeypatch, capsys):
+    # until there is a calibration the rough real-time factors are used
+    assert speech_to_text.get_calibration() == {}
+    assert speech_to_text.estimate_seconds(100, {"model": "tiny.en"}, {}) == 2
+    assert speech_to_text.estimate_keys(
+        {"model": "tiny", "engine": "fake", "word_timestamps": True}
+    ) == ["fake/tiny+words", "fake/tiny"]
+
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {"model": "tiny", "engine": "fake"},
+    }
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    runtime = job["log"]["runs"][0]["runtime"]
+    assert runtime["duration"] == pytest.approx(3.2, abs=0.1)
+    assert runtime["estimated"] == pytest.approx(runtime["duration"] * 0.02, abs=0.001)
+    assert runtime["actual"] >= 0
+    assert job["log"]["runtime"]["actual"] >= runtime["actual"]
+
+    # calibrating uses the logs of the jobs in the bucket
+    monkeypatch.setenv("SPEECH_TO_TEXT_CALIBRATION_KEY", "calibration.json")
+    calibration = speech_to_text.calibrate()
+    assert json.loads(capsys.readouterr().out) == calibration
+    assert calibration["jobs"] == 1
+    factor = calibration["real_time_factors"]["fake/tiny"]
+    assert factor["count"] == 1
+    assert factor["median"] == pytest.approx(
+        runtime["actual"] / runtime["duration"], abs=0.0001
+    )
+    assert calibration["overhead_seconds"] == job["log"]["runtime"]["overhead"]
+
+    assert speech_to_text.get_calibration() == calibration
+    assert speech_to_text.estimate_seconds(
+        100, {"model": "tiny", "engine": "fake"}, calibration
+    ) == pytest.approx(100 * factor["median"])
+
+    speech_to_text.calibration_cache = None
+
+
+def test_pack_media(monkeypatch):
+    paths = [Path(f"{name}.wav") for name in "abcdef"]
+    estimates = dict(zip(paths, [50.0, 20.0, 30.0, 40.0, 10.0, 60.0]))
+    entries = [{"path": path, "job": None} for path in paths]
+    entries[4]["job"] = "druid-1"
+
+    jobs = speech_to_text.pack_media(entries, estimates, target_minutes=1.5)
+
+    assert list(jobs.values()) == [
+        [Path("e.wav")],
+        [Path("f.wav"), Path("c.wav")],
+        [Path("a.wav"), Path("d.wav")],
+        [Path("b.wav")],
+    ]
+    assert next(iter(jobs)) == "druid-1"
+
+    assert speech_to_text.plan_shards([60.0, 50.0, 40.0], target_minutes=1) == 3
+    assert speech_to_text.plan_shards([], target_minutes=1) == 1
+
+    # the media is dealt out to the shards in turn
+    job = {"id": "druid-1", "shards": 2, "media": [{"name": n} for n in "abc"]}
+    monkeypatch.setenv("AWS_BATCH_JOB_ARRAY_INDEX", "0")
+    assert speech_to_text.get_shard(job)["media"] == [{"name": "a"}, {"name": "c"}]
+
+
+def test_align_words(tmp_path):
+    model = speech_to_text.get_whisper_model("tiny")
+    speech = whisper.audio.load_audio("tests/data/en.wav")
+    silence = numpy.zeros(30 * whisper.audio.SAMPLE_RATE, dtype=numpy.float32)
+    audio = numpy.concatenate([speech, silence, speech])
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        True, num_languages=model.num_languages, language="en", task="transcribe"
+    )
+
+    def segment(seek: int, start: float, end: float, text: str) -> dict:
+        return {
+            "seek": seek,
+            "start": start,
+            "end": end,
+            "text": text,
+            "tokens": tokenizer.encode(text),
+        }
+
+    # a result transcribed without word timestamps, with three windows
+    result = {
+        "text": "",
+        "language": "en",
+        "segments": [
+            segment(0, 0.0, 1.5, " This is a test for whisper"),
+            segment(0, 1.5, 3.2, " reading in English."),
+            segment(
+                3000, 30.0, 31.5, " This is a test for whisper reading in English."
+            ),
+            segment(6000, 60.0, 61.0, " Short."),
+        ],
+    }
+
+    # whisper aligns the words of each window as it transcribes it
+    expected = json.loads(json.dumps(result))
+    mel = whisper.log_mel_spectrogram(
+        audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES
+    )
+    content_frames = mel.shape[-1] - whisper.audio.N_FRAMES
+    last_speech_timestamp = 0.0
+    for seek in [0, 3000, 6000]:
+        segments = [s for s in expected["segments"] if s["seek"] == seek]
+        num_frames = min(whisper.audio.N_FRAMES, content_frames - seek)
+        whisper.timing.add_word_timestamps(
+            segments=segments,
+            model=model,
+            tokenizer=tokenizer,
+            mel=whisper.pad_or_trim(
+                mel[:, seek : seek + num_frames], whisper.audio.N_FRAMES
+            ),
+            num_frames=num_frames,
+            last_speech_timestamp=last_speech_timestamp,
+        )
+        last_speech_timestamp = whisper.utils.get_end(segments)
+
+    # when every segment needs words the windows are aligned the same way
+    aligned = json.loads(json.dumps(result))
+    stats = speech_to_text.align_words(
+        model, audio, aligned, {"max_line_width": 1}, {"fp16": False}
+    )
+    assert stats["windows"] == 3
+    assert stats["skipped_windows"] == 0
+    for segment, expected_segment in zip(aligned["segments"], expected["segments"]):
+        assert segment["start"] == expected_segment["start"]
+        assert segment["end"] == expected_segment["end"]
+        assert [(w["word"], w["start"], w["end"]) for w in segment["words"]] == [
+            (w["word"], w["start"], w["end"]) for w in expected_segment["words"]
+        ]
+
+    # only the window with a segment that is too long for a line is aligned,
+    # with the segments of the other windows ending where their words would
+    writer_options = {"max_line_width": 42}
+    aligned = json.loads(json.dumps(result))
+    for segment, expected_segment in zip(aligned["segments"], expected["segments"]):
+        segment["start"] = expected_segment["start"]
+        segment["end"] = expected_segment["end"]
+    stats = speech_to_text.align_words(
+        model, audio, aligned, writer_options, {"fp16": False}
+    )
+    assert stats["windows"] == 1
+    assert stats["skipped_windows"] == 2
+    assert stats["segments"] == 1
+    assert stats["saved_seconds"] > 0
+    assert ["words" in segment for segment in aligned["segments"]] == [
+        False,
+        False,
+        True,
+        False,
+    ]
+
+    # and its words are the same as with full alignment
+    assert aligned["segments"][2] == expected["segments"][2]
+
+    # the segment that is split is written the same way as with full alignment
+    speech_to_text.write_transcript(tmp_path, "aligned.wav", aligned, writer_options)
+    speech_to_text.write_transcript(tmp_path, "full.wav", expected, writer_options)
+    aligned_cues = (tmp_path / "aligned.vtt").read_text().split("\n\n")
+    full_cues = (tmp_path / "full.vtt").read_text().split("\n\n")
+    assert aligned_cues[3] == full_cues[3]
+    first = aligned["segments"][0]
+    assert aligned_cues[1] == (
+        f"{whisper.utils.format_timestamp(first['start'])} --> "
+        f"{whisper.utils.format_timestamp(first['end'])}\nThis is a test for whisper"
+    )
+    assert len(aligned_cues) == len(full_cues)
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_selective_alignment(bucket, queues):
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+    job = {
+        "id": job_id,
+        "media": [{"name": f"{job_id}/en.wav"}],
+        "options": {
+            "model": "tiny",
+            "alignment": "selective",
+            "writer": {"max_line_width": 42},
+        },
+    }
+
+    speech_to_text.main(job)
+
+    queue = speech_to_text.get_done_queue()
+    msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+    job = json.loads(msgs[0].body)
+
+    assert "error" not in job
+    run = job["log"]["runs"][0]
+    assert run["transcribe"]["alignment"] == "selective"
+    assert run["transcribe"]["word_timestamps"] is False
+    assert run["alignment"]["windows"] + run["alignment"]["skipped_windows"] >= 1
+    assert "align" in job["metrics"]["stages"]
+    assert len(job["output"]) == 5
+
+    # unknown alignment options are reported as errors
+    job["options"]["alignment"] = "nope"
+    with pytest.raises(speech_to_text.SpeechToTextException):
+        speech_to_text.main(job)
+
+
+@pytest.mark.filterwarnings("ignore:datetime.datetime.utcnow")
+def test_selective_alignment_default_writer(bucket, queues):
+    job_id = str(uuid.uuid4())
+    speech_to_text.add_media("tests/data/en.wav", job_id)
+
+    # with the default writer options every segment needs its words, so the
+    # output is the same as with full alignment
+    outputs = {}
+    for alignment in ["full", "selective"]:
+        job = {
+            "id": job_id,
+            "media": [{"name": f"{job_id}/en.wav"}],
+            "options": {
+                "model": "tiny",
+                "alignment": alignment,
+                "temperature": 0.0,
+                "writer": {"max_line_width": 42, "max_line_count": 1},
+            },
+        }
+        speech_to_text.main(job)
+
+        queue = speech_to_text.get_done_queue()
+        msgs = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=10)
+        job = json.loads(msgs[0].body)
+        msgs[0].delete()
+
+        assert "error" not in job
+        assert "alignment" not in job["log"]["runs"][0]
+        outputs[alignment] = {
+            key: speech_to_text.get_bucket().Object(key).get()["Body"].read()
+            for key in job["output"]
+        }
+
+    assert outputs["selective"] == outputs["full"]